@@ -4,6 +4,15 @@ from thespian.actors import *
 import traceback
 from datetime import timedelta
 import inspect
+import heapq
+import collections
+import itertools
+import logging
+import math
+import time
+import weakref
+
+from latency import LatencyHistogram
 
 class CoActor(Actor):
     """CoActor is a subclass of Thespian's Actor which emulates an event
@@ -12,8 +21,10 @@ class CoActor(Actor):
     Refer to the methods for the features this enables.
     """
     class MessageWaiter:
-        def __init__(self, mtype):
+        def __init__(self, mtype, validator=None, key=None):
             self.mtype = mtype
+            self.validator = validator
+            self.key = key
         def __await__(self):
             return (yield self)
 
@@ -21,102 +32,492 @@ class CoActor(Actor):
     class CallSoon:
         pass
 
+    class Timer:
+        """A timer from call_later. Cancel it with timer.cancel().
+        If it was made without a function, a coroutine can await it
+        to sleep until it's due. Awaiting one that's already gone off
+        returns right away."""
+
+        def __init__(self, actor, deadline, fn):
+            self.actor = actor
+            self.deadline = deadline
+            self.fn = fn
+            self.cancelled = False
+            self.done = False
+            # the coroutine awaiting the timer, if any
+            self._awaiter = None
+
+        def cancel(self):
+            """Stop the timer from going off. Does nothing if it already has.
+            A coroutine awaiting the timer gets a CancelledError."""
+
+            if not self.cancelled and not self.done:
+                self.cancelled = True
+                self.actor._timer_cancelled()
+                coro, self._awaiter = self._awaiter, None
+                if coro is not None:
+                    self.actor._send_coro(coro, None, CancelledError())
+
+        def __await__(self):
+            if self.cancelled:
+                raise CancelledError()
+            if not self.done:
+                yield self
+
+    # payload of the WakeupMessage that runs the timers
+    class TimerWakeup:
+        def __init__(self, deadline):
+            self.deadline = deadline
+
+    # several messages sent together with send_batched
+    class Envelope:
+        def __init__(self, msgs):
+            self.msgs = msgs
+
+    # ask any CoActor about where its time goes. it responds with
+    # a ProfileReport
+    class ProfileRequest:
+        def __init__(self, enable=None, reset=False):
+            # True to start profiling, False to stop, None to leave it
+            self.enable = enable
+            # True to throw out what's been recorded so far
+            self.reset = reset
+
+    class ProfileReport:
+        def __init__(self, enabled, report):
+            self.enabled = enabled
+            # printable report, see CoActorProfile.report
+            self.report = report
+        def __repr__(self):
+            return self.report
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         # initialize our own state
         self._callbacks = []
+        # concrete message type -> tuple of callbacks that handle it,
+        # filled in as types are seen and cleared when callbacks change
+        self._dispatch = {}
+        # message type -> list of (MessageWaiter, coro) waiting on it
         self._pending_coros = {}
-        self._call_soon = []
+        # message type -> key -> list of (MessageWaiter, coro),
+        # for waiters that only want messages with one key
+        self._keyed_coros = {}
+        # message type -> function that gets the key of a message
+        self._msg_keys = {}
+        # coros that just started waiting on a message, see _send_coro
+        self._new_coros = []
+        # coroutine object -> Task, for the coros started with create_task
+        self._tasks = {}
+        self._call_soon = collections.deque()
         self._call_soon_sent = False
+        # True while in receiveMessage, where call soon callbacks run
+        # before it returns and don't need a CallSoon message
+        self._in_receive = False
+
+        # heap of (deadline, tiebreak, Timer) for call_later and sleep
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._timers_cancelled = 0
+        # deadlines of the timer wakeups that are on their way
+        self._timer_wakeups = set()
+
+        # CoActorProfile while profiling, see enable_profiling
+        self._profile = None
+
+        # messages waiting to go out from send_batched,
+        # as [address, list of messages]
+        self._batches = []
+        self._batch_timer = None
 
     def receiveMessage(self, msg, sender):
         # we've got a message
+        self._in_receive = True
+        try:
+            if isinstance(msg, CoActor.Envelope):
+                # several messages sent together, handle them
+                # like they came one at a time
+                for m in msg.msgs:
+                    try:
+                        self._process_timed(m, sender)
+                    except:
+                        # don't lose the rest because of one
+                        traceback.print_exc()
+            else:
+                self._process_timed(msg, sender)
+        finally:
+            self._in_receive = False
+            # send what's been batched up while handling the message,
+            # unless it's meant to wait a bit for more
+            if self._batches and self.BATCH_DELAY <= 0:
+                self.flush_batches()
+            # if there's too much to do, the rest is left for a CallSoon
+            # message so other messages get a turn
+            if self._call_soon and not self._call_soon_sent:
+                self._call_soon_sent = True
+                self.send(self.myAddress, CoActor.CallSoon())
 
-        # did something handle it?
-        was_handled = False
-
-        # keep list of coros made from this message so they don't see
-        # the message twice
-        new_coros = []
+    def _process_timed(self, msg, sender):
+        prof = self._profile
+        if prof is None:
+            self._process(msg, sender)
+        else:
+            start = time.perf_counter()
+            self._process(msg, sender)
+            prof.add(prof.dispatch, type(msg).__name__,
+                time.perf_counter()-start)
 
-        # helper function to send a new value into a coroutine
-        # then deal with the thing it wants to await on
-        def send_coro(coro, obj):
-            try:
-                wobj = coro.send(obj)
-            except StopIteration:
-                # coro is completely finished
-                return
-            except:
-                # oh heck
-                traceback.print_exc()
-                return
+    def _process(self, msg, sender):
+        # note when it got here if it's being traced
+        trace = getattr(msg, 'trace', None)
+        if trace is not None:
+            trace.stamp(type(self).__name__)
 
-            if isinstance(wobj, Future):
-                # it wants to wait on a future
-                # add it to the future's waiters
-                wobj._waiters.append(coro)
-            else:
-                # something else, handle that once all coros
-                # are processed
-                new_coros.append((wobj, coro))
+        # did something handle it?
+        was_handled = False
 
         if isinstance(msg, CoActor.CallSoon):
             self._call_soon_sent = False
             was_handled = True
+        elif isinstance(msg, CoActor.ProfileRequest):
+            was_handled = True
+            self._profile_request(msg, sender)
+        elif isinstance(msg, WakeupMessage) and \
+                isinstance(msg.payload, CoActor.TimerWakeup):
+            was_handled = True
+            # the due timers get called with the call soon callbacks
+            self._timer_wakeups.discard(msg.payload.deadline)
+            self._run_timers()
 
         # 0th step: execute the call soon callbacks
-        if len(self._call_soon) > 0:
-            cs = self._call_soon
-            self._call_soon = []
-            for coro in cs:
-                if hasattr(coro, 'send'):
-                    # it's a coroutine object that needs a new value
-                    # send a new one into it
-                    send_coro(coro, None)
-                elif not inspect.iscoroutinefunction(coro):
-                    # it's a boring old function
-                    # just call it
-                    coro()
-                else:
-                    # it's a coroutine function, which needs to be called
-                    # to produce a coroutine object, so do that then send
-                    # a new value into it
-                    send_coro(coro(), None)
+        # left over from last time
+        self._run_ready()
 
         # first step: see if any callbacks need to be processed
-        for mtype, cb in self._callbacks:
-            if isinstance(msg, mtype):
-                was_handled = True
-                # call the callback and get a coroutine
-                coro = cb(msg, sender)
-                if hasattr(coro, 'send'):
-                    # now send to it to get it running
-                    send_coro(coro, None)
-
-        # second step: see if any coros were waiting on that message
         mtype = type(msg)
-        if mtype in self._pending_coros:
+        cbs = self._dispatch.get(mtype)
+        if cbs is None:
+            cbs = self._resolve_callbacks(mtype)
+        prof = self._profile
+        for cb in cbs:
             was_handled = True
-            coros = self._pending_coros[mtype]
-            del self._pending_coros[mtype]
-            for coro in coros:
-                # send the new message into the coroutine
-                send_coro(coro, (msg, sender))
-        
+            # call the callback and get a coroutine
+            if prof is None:
+                coro = cb(msg, sender)
+            else:
+                start = time.perf_counter()
+                coro = cb(msg, sender)
+                prof.add(prof.callbacks, getattr(cb, '__qualname__',
+                    repr(cb)), time.perf_counter()-start)
+            if hasattr(coro, 'send'):
+                # now send to it to get it running
+                self._send_coro(coro, None)
+
+        # second step: see if any coros were waiting on that message,
+        # or on any of its base classes
+        if self._pending_coros or self._keyed_coros:
+            for wtype in mtype.__mro__:
+                if self._wake_waiters(wtype, msg, sender):
+                    was_handled = True
+
         # third step: prepare the coros for next message
+        self._park_new_coros()
+
+        # fourth step: run everything that became ready because of the
+        # message, e.g. coroutines waiting on futures it resolved, until
+        # there's nothing left (or READY_LIMIT is hit)
+        self._run_ready()
+
+        if not was_handled:
+            print("{} didn't handle: {}, {}".format(self.myAddress, msg, sender))
+
+    def _wake_waiters(self, wtype, msg, sender):
+        # resume the coros waiting on wtype that want this message
+        # returns True if any were waiting on wtype at all
+        found = False
+
+        waiters = self._pending_coros.get(wtype)
+        if waiters is not None:
+            found = True
+            left = self._wake(waiters, msg, sender)
+            if left:
+                self._pending_coros[wtype] = left
+            else:
+                del self._pending_coros[wtype]
+
+        keyed = self._keyed_coros.get(wtype)
+        if keyed is not None:
+            found = True
+            # only the waiters on this message's key need to look at it
+            key = self._key_fn(wtype)(msg, sender)
+            waiters = keyed.get(key)
+            if waiters is not None:
+                left = self._wake(waiters, msg, sender)
+                if left:
+                    keyed[key] = left
+                else:
+                    del keyed[key]
+                    if not keyed:
+                        del self._keyed_coros[wtype]
+
+        return found
+
+    def _wake(self, waiters, msg, sender):
+        # send the message into each waiter that accepts it
+        # returns the waiters that are still waiting
+        left = []
+        for w, coro in waiters:
+            if w.validator is not None:
+                # check before resuming the coro, so it doesn't
+                # have to run just to find out it's not interested
+                try:
+                    ok = w.validator(msg, sender)
+                except:
+                    # the coro would have died from this, so it does
+                    traceback.print_exc()
+                    coro.close()
+                    continue
+                if not ok:
+                    left.append((w, coro))
+                    continue
+            # send the new message into the coroutine
+            self._send_coro(coro, (msg, sender))
+        return left
+
+    # most call soon callbacks run in one go before other messages
+    # get a turn
+    READY_LIMIT = 256
+
+    def _run_ready(self):
+        # run call soon callbacks until there are none left,
+        # or READY_LIMIT of them have run
+        ready = self._call_soon
+        ran = 0
+        if self._profile is not None:
+            self._profile.ready_depth(len(ready))
+        while ready and ran < self.READY_LIMIT:
+            coro = ready.popleft()
+            ran += 1
+            if hasattr(coro, 'send'):
+                # it's a coroutine object that needs a new value
+                # send a new one into it
+                self._send_coro(coro, None)
+            elif not inspect.iscoroutinefunction(coro):
+                # it's a boring old function
+                # just call it
+                coro()
+            else:
+                # it's a coroutine function, which needs to be called
+                # to produce a coroutine object, so do that then send
+                # a new value into it
+                self._send_coro(coro(), None)
+        self._park_new_coros()
+
+    # helper function to send a new value (or throw an exception) into
+    # a coroutine then deal with the thing it wants to await on
+    def _send_coro(self, coro, obj, exc=None):
+        task = self._tasks.get(coro) if self._tasks else None
+        while True:
+            if task is not None:
+                task._running = True
+            try:
+                if exc is None:
+                    wobj = coro.send(obj)
+                else:
+                    wobj = coro.throw(exc)
+            except StopIteration as e:
+                # coro is completely finished
+                if task is not None:
+                    self._finish_task(task, e.value, None)
+                return
+            except BaseException as e:
+                if task is not None:
+                    self._finish_task(task, None, e)
+                else:
+                    # oh heck
+                    traceback.print_exc()
+                return
+            finally:
+                if task is not None:
+                    task._running = False
+
+            if task is None or not task._must_cancel:
+                break
+            # it was cancelled while it was running, so instead of
+            # waiting on wobj it gets the CancelledError now
+            task._must_cancel = False
+            if isinstance(wobj, CoActor.Timer):
+                wobj.cancel()
+            obj, exc = None, CancelledError()
+
+        if task is not None:
+            task._waiting = wobj
+
+        if isinstance(wobj, Future):
+            # it wants to wait on a future
+            # add it to the future's waiters
+            wobj._waiters.append(coro)
+        elif isinstance(wobj, CoActor.Timer):
+            # it wants to sleep until the timer goes off
+            wobj._awaiter = coro
+        else:
+            # something else, handle that once all coros
+            # are processed, so coros made from the current message
+            # don't see it twice
+            self._new_coros.append((wobj, coro))
+
+    def _profiled_send_coro(self, coro, obj, exc=None):
+        # _send_coro, timed. enable_profiling puts it in place
+        # of _send_coro so there's no cost when not profiling
+        prof = self._profile
+        if prof is None:
+            return CoActor._send_coro(self, coro, obj, exc)
+        name = coro.__qualname__
+        start = time.perf_counter()
+        parked = prof.parked.pop(coro, None)
+        if parked is not None:
+            prof.add(prof.waits, name, start-parked)
+        CoActor._send_coro(self, coro, obj, exc)
+        end = time.perf_counter()
+        prof.add(prof.steps, name, end-start)
+        if getattr(coro, 'cr_frame', None) is not None or \
+                getattr(coro, 'gi_frame', None) is not None:
+            # not finished, so it's waiting on something now
+            prof.parked[coro] = end
+
+    def enable_profiling(self, enable=True):
+        """Start or stop recording where time goes in this actor.
+
+        It can also be done by sending the actor a CoActor.ProfileRequest.
+        When it's off, it costs next to nothing.
+
+        enable: True to start, False to stop
+
+        returns: the CoActorProfile being recorded into
+        """
+
+        if enable:
+            if self._profile is None:
+                self._profile = CoActorProfile()
+            self._send_coro = self._profiled_send_coro
+        else:
+            self.__dict__.pop('_send_coro', None)
+            self._profile, prof = None, self._profile
+            return prof
+        return self._profile
+
+    def _profile_request(self, msg, sender):
+        if msg.reset and self._profile is not None:
+            self._profile = CoActorProfile()
+        if msg.enable is not None:
+            prof = self.enable_profiling(msg.enable)
+        else:
+            prof = self._profile
+
+        if prof is None:
+            report = "not profiling"
+        else:
+            waiters = sum(len(w) for w in self._pending_coros.values()) + \
+                sum(len(w) for keyed in self._keyed_coros.values()
+                    for w in keyed.values())
+            report = prof.report(live={
+                "message waiters": waiters,
+                "tasks": len(self._tasks),
+                "timers": len(self._timers)-self._timers_cancelled,
+                "call soon": len(self._call_soon),
+            })
+        self.send(sender, CoActor.ProfileReport(self._profile is not None,
+            report))
+
+    def _finish_task(self, task, result, exc):
+        del self._tasks[task.coro]
+        task._waiting = None
+        if exc is None:
+            task.set_result(result)
+            return
+        # it's kept on the task, and only reported if nobody ever looks
+        task.set_exception(exc)
+
+    def _cancel_task(self, task):
+        # stop a task's coroutine from waiting on whatever it's waiting
+        # on, then throw a CancelledError into it
+        coro = task.coro
+        if task._running:
+            # it's cancelling itself. it gets the exception once it
+            # next awaits something
+            task._must_cancel = True
+            return
+
+        wobj = task._waiting
+        task._waiting = None
+        unparked = False
+        if isinstance(wobj, Future):
+            if coro in wobj._waiters:
+                wobj._waiters.remove(coro)
+                unparked = True
+        elif isinstance(wobj, CoActor.Timer):
+            if wobj._awaiter is coro:
+                # it gets its CancelledError below
+                wobj._awaiter = None
+                wobj.cancel()
+                unparked = True
+        elif isinstance(wobj, CoActor.MessageWaiter):
+            unparked = self._remove_waiter(wobj, coro)
+        if not unparked:
+            # it's not started yet or what it was waiting for
+            # already happened, so it's due to run soon
+            try:
+                self._call_soon.remove(coro)
+            except ValueError:
+                pass
+
+        self._send_coro(coro, None, CancelledError())
+
+    def _remove_waiter(self, wobj, coro):
+        # take a coro waiting on a message out of the waiter lists
+        # returns False if it wasn't in them
+        for i, (w, c) in enumerate(self._new_coros):
+            if c is coro:
+                del self._new_coros[i]
+                return True
+        if wobj.key is None:
+            table, key = self._pending_coros, wobj.mtype
+        else:
+            table, key = self._keyed_coros.get(wobj.mtype, {}), wobj.key
+        waiters = table.get(key, [])
+        for i, (w, c) in enumerate(waiters):
+            if c is coro:
+                del waiters[i]
+                if not waiters:
+                    del table[key]
+                    if wobj.key is not None and not table:
+                        del self._keyed_coros[wobj.mtype]
+                return True
+        return False
+
+    def _park_new_coros(self):
+        # file away the coros that are waiting on messages
+        new_coros = self._new_coros
+        self._new_coros = []
         for wobj, coro in new_coros:
             if isinstance(wobj, CoActor.MessageWaiter):
-                mtype = wobj.mtype
-                if mtype not in self._pending_coros:
-                    self._pending_coros[mtype] = []
-                self._pending_coros[mtype].append(coro)
+                if wobj.key is None:
+                    waiters = self._pending_coros.setdefault(wobj.mtype, [])
+                else:
+                    keyed = self._keyed_coros.setdefault(wobj.mtype, {})
+                    waiters = keyed.setdefault(wobj.key, [])
+                waiters.append((wobj, coro))
             else:
                 raise Exception("weird coro: {}".format(coro))
 
-        if not was_handled:
-            print("{} didn't handle: {}, {}".format(self.myAddress, msg, sender))
+    def _resolve_callbacks(self, mtype):
+        # work out which callbacks handle a concrete message type,
+        # in the order they were registered, and remember it
+        cbs = tuple(cb for cbtype, cb in self._callbacks
+            if issubclass(mtype, cbtype))
+        self._dispatch[mtype] = cbs
+        return cbs
 
     def register_cb(self, mtype, cb):
         """Register a callback which is called when the
@@ -132,46 +533,297 @@ class CoActor(Actor):
         """
 
         self._callbacks.append((mtype, cb))
+        self._dispatch.clear()
 
     def unregister_cb(self, mtype, cb):
         """Unregister a callback registered with register_cb."""
 
         self._callbacks.remove((mtype, cb))
+        self._dispatch.clear()
+
+    def register_key(self, mtype, keyfn):
+        """Register how to get the key of a type of message, so
+        wait_msg can wait for only the messages with some key.
+
+        mtype: The type of message. Also used for its subclasses, unless
+          they have their own key function.
+
+        keyfn: Called like keyfn(msg, sender) to get the key of a received
+          message, e.g. an attribute name, correlation id or the sender.
+          The key must be hashable.
+        """
+
+        self._msg_keys[mtype] = keyfn
+
+    def _key_fn(self, mtype):
+        for t in mtype.__mro__:
+            keyfn = self._msg_keys.get(t)
+            if keyfn is not None:
+                return keyfn
+        return None
+
+    def call_later(self, seconds, fn=None):
+        """Call a function after some time.
+
+        seconds: how long to wait
+        fn: the function to be called, like for call_soon. If None, a
+          coroutine can await the returned timer to sleep until it's due.
+
+        returns: the CoActor.Timer, which can be cancelled
+        """
+
+        timer = CoActor.Timer(self, time.monotonic()+seconds, fn)
+        heapq.heappush(self._timers,
+            (timer.deadline, next(self._timer_seq), timer))
+        self._schedule_timers()
+        return timer
+
+    def _run_timers(self):
+        # move every timer that's due onto the call soon list
+        now = time.monotonic()
+        timers = self._timers
+        while timers and timers[0][0] <= now:
+            deadline, seq, timer = heapq.heappop(timers)
+            timer.done = True
+            if timer.cancelled:
+                self._timers_cancelled -= 1
+            elif timer._awaiter is not None:
+                self._call_soon.append(timer._awaiter)
+                timer._awaiter = None
+            elif timer.fn is not None:
+                self._call_soon.append(timer.fn)
+        self._schedule_timers()
+
+    def _schedule_timers(self):
+        # make sure a wakeup is coming for the earliest timer
+        timers = self._timers
+        while timers and timers[0][2].cancelled:
+            heapq.heappop(timers)
+            self._timers_cancelled -= 1
+        if not timers:
+            return
+        deadline = timers[0][0]
+        # a wakeup that's already coming soon enough will do.
+        # thespian can't cancel wakeups, so later ones just arrive
+        # and find nothing to do
+        for d in self._timer_wakeups:
+            if d <= deadline:
+                return
+        self._timer_wakeups.add(deadline)
+        # timedelta rounds to the nearest microsecond, which could wake
+        # us a hair before the deadline, so round up instead
+        delay = math.ceil(max(0, deadline-time.monotonic())*1e6)
+        self.wakeupAfter(timedelta(microseconds=delay),
+            payload=CoActor.TimerWakeup(deadline))
+
+    def _timer_cancelled(self):
+        # throw out cancelled timers once they're most of the heap
+        self._timers_cancelled += 1
+        if self._timers_cancelled > 32 and \
+                self._timers_cancelled*2 > len(self._timers):
+            self._timers = [t for t in self._timers if not t[2].cancelled]
+            heapq.heapify(self._timers)
+            self._timers_cancelled = 0
 
     async def sleep(self, seconds):
         """Asynchronously sleep for a specified number of seconds."""
 
-        # instantiate new message waiter that waits for a WakeupMessage
-        w = CoActor.MessageWaiter(WakeupMessage)
-        # schedule a wakeup to be sent in the specified seconds
-        self.wakeupAfter(timedelta(seconds=seconds), payload=w)
-        while True:
-            # use the message waiter to wait for a WakeupMessage
-            msg, sender = await w
-            # make sure it's for this wakeup
-            if msg.payload == w: break
+        await self.call_later(seconds)
 
-    async def wait_msg(self, mtype, validator=None):
+    async def wait_msg(self, mtype, validator=None, key=None):
         """Asynchronously wait for a specific type of message.
 
         mtype: The type of message. Received message msg is considered the same
-          type when isinstance(msg, mtype) is True.
+          type when isinstance(msg, mtype) is True, the same as for
+          register_cb.
 
         validator: If not None, an additional function to validate the
           received message. Called like validator(msg, sender), where msg
           is the received message and sender is the address of the actor
           that sent it. If validator(msg, sender) == True and the message
-          is the same type, the wait is over.
+          is the same type, the wait is over. It's checked before the
+          coroutine is resumed, so messages it rejects cost very little.
+
+        key: If not None, only messages with this key are considered,
+          as found by the key function registered for mtype with
+          register_key. Messages with other keys never reach the validator.
+
+        returns: (msg, sender) of the message that ended the wait
         """
 
-        # wait for the message type
-        w = CoActor.MessageWaiter(mtype)
-        while True:
-            # wait for a new message of that type
-            msg, sender = await w
-            # make sure it's one we want
-            if validator is None or validator(msg, sender):
-                return msg, sender
+        if key is not None and self._key_fn(mtype) is None:
+            raise ValueError("no key function registered for {}".format(
+                mtype.__name__))
+
+        return await CoActor.MessageWaiter(mtype, validator, key)
+
+    # most messages to one address that are batched into one envelope
+    BATCH_SIZE = 64
+    # how long send_batched holds messages for more to come along, in
+    # seconds. if 0, they're sent once the current message is handled
+    BATCH_DELAY = 0
+
+    def send_batched(self, addr, msg):
+        """Send a message, batched together with others to the same
+        address so they travel as one message. The receiving actor must
+        be a CoActor, which handles them as if they came separately,
+        in the same order.
+
+        The batch is sent once BATCH_SIZE messages are in it, or once
+        the current message is handled (or after BATCH_DELAY seconds,
+        if that's set).
+
+        addr: the actor address to send to
+        msg: the message
+        """
+
+        for batch in self._batches:
+            if batch[0] == addr:
+                break
+        else:
+            batch = [addr, []]
+            self._batches.append(batch)
+            if self.BATCH_DELAY > 0 and self._batch_timer is None:
+                self._batch_timer = self.call_later(self.BATCH_DELAY,
+                    self.flush_batches)
+
+        batch[1].append(msg)
+        if len(batch[1]) >= self.BATCH_SIZE:
+            self._batches.remove(batch)
+            self._send_batch(*batch)
+
+    def flush_batches(self):
+        """Send all the messages batched up by send_batched now."""
+
+        batches = self._batches
+        self._batches = []
+        if self._batch_timer is not None:
+            self._batch_timer.cancel()
+            self._batch_timer = None
+        for addr, msgs in batches:
+            self._send_batch(addr, msgs)
+
+    def _send_batch(self, addr, msgs):
+        if len(msgs) == 1:
+            self.send(addr, msgs[0])
+        else:
+            self.send(addr, CoActor.Envelope(msgs))
+
+    def create_task(self, coro):
+        """Start running a coroutine as a task.
+
+        coro: The coroutine object.
+
+        returns: a Task, which is a Future that gets the coroutine's
+          result (or exception) when it finishes, and can be cancelled
+        """
+
+        task = Task(self, coro)
+        self._tasks[coro] = task
+        self.call_soon(coro)
+        return task
+
+    def _as_future(self, aw):
+        # make something awaitable into a Future
+        if isinstance(aw, Future):
+            return aw
+        if not hasattr(aw, 'send'):
+            aw = self._await(aw)
+        return self.create_task(aw)
+
+    async def _await(self, aw):
+        return await aw
+
+    async def first_completed(self, *aws, timeout=None):
+        """Wait until at least one of several things is done.
+
+        aws: Futures, coroutine objects or other awaitables, like
+          a timer from call_later. Coroutines are started as tasks.
+
+        timeout: If not None, give up after this many seconds.
+
+        returns: (done, pending), lists of the Futures (or Tasks) that are
+          done and not done. done is empty if it timed out. The pending
+          ones are left running, cancel them if they're not wanted.
+        """
+
+        futs = [self._as_future(aw) for aw in aws]
+        if not any(f.has_result for f in futs):
+            waker = Future(self)
+            def wake():
+                if not waker.has_result:
+                    waker.set_result(None)
+            for f in futs:
+                f._waiters.append(wake)
+            timer = None
+            if timeout is not None:
+                timer = self.call_later(timeout, wake)
+            try:
+                await waker
+            finally:
+                for f in futs:
+                    if wake in f._waiters:
+                        f._waiters.remove(wake)
+                if timer is not None:
+                    timer.cancel()
+
+        done = [f for f in futs if f.has_result]
+        pending = [f for f in futs if not f.has_result]
+        return done, pending
+
+    async def wait_for(self, aw, timeout):
+        """Wait for something, but not forever.
+
+        aw: A Future, coroutine object or other awaitable
+
+        timeout: How long to wait, in seconds. If None, it's like
+          awaiting aw.
+
+        returns: the result of aw. If it's not done in time, it's
+          cancelled (if it's a Task) and TimeoutError is raised.
+        """
+
+        fut = self._as_future(aw)
+        try:
+            done, pending = await self.first_completed(fut, timeout=timeout)
+        except CancelledError:
+            fut.cancel()
+            raise
+        if not done:
+            fut.cancel()
+            raise TimeoutError()
+        return await fut
+
+    async def gather(self, *aws):
+        """Run several things at the same time and wait for all of them.
+
+        aws: Futures, coroutine objects or other awaitables.
+          Coroutines are started as tasks.
+
+        returns: a list of their results, in the same order. If one
+          raises an exception (or the gather is cancelled), the rest
+          are cancelled and the exception is raised.
+        """
+
+        futs = [self._as_future(aw) for aw in aws]
+        try:
+            while True:
+                # stop at the first one that fails, not when its turn
+                # comes to be awaited
+                for f in futs:
+                    if f.has_result and f.exception is not None:
+                        raise f.exception
+                pending = [f for f in futs if not f.has_result]
+                if not pending:
+                    return [f.result for f in futs]
+                await self.first_completed(*pending)
+        except:
+            for f in futs:
+                f.cancel()
+                if isinstance(f, Task):
+                    # the exception raised here stands for theirs
+                    f._retrieved = True
+            raise
 
     def call_soon(self, fn):
         """Call a function soon.
@@ -183,19 +835,80 @@ class CoActor(Actor):
 
         # append it to call soon list
         self._call_soon.append(fn)
-        # and send a call soon message to trigger the call,
+        # if we're handling a message, it gets run before that's done.
+        # otherwise send a call soon message to trigger the call,
         # (assuming we haven't sent one since the last time)
         # as call soon routines are only called when any message
         # is received
-        if not self._call_soon_sent:
+        if not self._in_receive and not self._call_soon_sent:
             self._call_soon_sent = True
             self.send(self.myAddress, CoActor.CallSoon())
 
+class CoActorProfile:
+    """Where the time goes in a CoActor, from enable_profiling.
+
+    Every histogram is keyed by a name: the message type for dispatch,
+    the callback for callbacks, and the coroutine function for steps
+    (time spent running each time it's resumed) and waits (time from
+    awaiting something to being resumed).
+    """
+
+    def __init__(self):
+        self.dispatch = {}
+        self.callbacks = {}
+        self.steps = {}
+        self.waits = {}
+        # coroutine -> when it started waiting
+        self.parked = weakref.WeakKeyDictionary()
+        # most call soon callbacks waiting to run at once
+        self.max_ready = 0
+
+    def add(self, hists, name, seconds):
+        h = hists.get(name)
+        if h is None:
+            h = LatencyHistogram()
+            hists[name] = h
+        h.add(seconds)
+
+    def ready_depth(self, depth):
+        if depth > self.max_ready:
+            self.max_ready = depth
+
+    def report(self, live=None):
+        """Get a printable report.
+
+        live: dict of other counts to put in, like how many
+          coroutines are waiting on what
+        """
+
+        lines = []
+        for title, hists in (("dispatch", self.dispatch),
+                ("callbacks", self.callbacks), ("steps", self.steps),
+                ("waits", self.waits)):
+            if not hists:
+                continue
+            lines.append(title+":")
+            width = max(len(name) for name in hists)
+            # slowest in total first
+            for name, h in sorted(hists.items(), key=lambda i: -i[1].sum):
+                lines.append("  {:>{}}: {}".format(name, width, h))
+        lines.append("waiting coroutines: {}".format(len(self.parked)))
+        lines.append("max call soon depth: {}".format(self.max_ready))
+        for name, count in (live or {}).items():
+            lines.append("{}: {}".format(name, count))
+        return "\n".join(lines)
+
 class FutureInvalidState(Exception):
     """Exception raised when an invalid operation is performed on a Future."""
 
     pass
 
+class CancelledError(Exception):
+    """Exception raised in a coroutine when its task is cancelled,
+    and when awaiting a cancelled Future."""
+
+    pass
+
 class Future:
     """Basic Future implementation for CoActors
 
@@ -213,6 +926,10 @@ class Future:
       Gives result to all coroutines awaiting on the future.
       Once result is set, trying to set another result throws
       FutureInvalidState.
+
+    * Or set an exception with fut.set_exception(exc), which is raised
+      in the coroutines awaiting on the future. fut.cancel() sets
+      a CancelledError. has_result is True after either.
     """
 
     def __init__(self, actor):
@@ -227,6 +944,7 @@ class Future:
 
         self.has_result = False
         self.result = None
+        self.exception = None
 
     def set_result(self, result):
         """Set the result of the future.
@@ -239,6 +957,32 @@ class Future:
             raise FutureInvalidState()
 
         self.result = result
+        self._done()
+
+    def set_exception(self, exc):
+        """Set an exception for the future, which is raised in all
+        coroutines that were waiting on it. Throws FutureInvalidState if
+        the result has already been set.
+        """
+
+        if self.has_result:
+            raise FutureInvalidState()
+
+        self.exception = exc
+        self._done()
+
+    def cancel(self):
+        """Cancel the future, if it doesn't have a result yet.
+
+        returns: True if it was cancelled
+        """
+
+        if self.has_result:
+            return False
+        self.set_exception(CancelledError())
+        return True
+
+    def _done(self):
         self.has_result = True
 
         # unwait everybody who was waiting on us
@@ -249,4 +993,60 @@ class Future:
     def __await__(self):
         if not self.has_result:
             yield self
+        if self.exception is not None:
+            raise self.exception
         return self.result
+
+class Task(Future):
+    """A coroutine running in a CoActor, made with actor.create_task(coro).
+
+    It's a Future that gets the coroutine's return value when it finishes,
+    or the exception it raised.
+
+    * Cancel it with task.cancel(). A CancelledError is raised in the
+      coroutine where it's waiting, and it's taken out of whatever it was
+      waiting on. The coroutine can catch it to clean up.
+
+    If the coroutine raises something other than CancelledError and
+    nobody awaits the task or looks at task.exception before it's
+    thrown away, the exception is logged then.
+    """
+
+    def __init__(self, actor, coro):
+        self._exception = None
+        self._retrieved = False
+        super().__init__(actor)
+        self.coro = coro
+        # what the coroutine's waiting on
+        self._waiting = None
+        self._running = False
+        self._must_cancel = False
+
+    @property
+    def exception(self):
+        self._retrieved = True
+        return self._exception
+
+    @exception.setter
+    def exception(self, exc):
+        self._exception = exc
+
+    def __del__(self):
+        exc = self._exception
+        if exc is not None and not self._retrieved and \
+                not isinstance(exc, CancelledError):
+            logging.getLogger(__name__).error(
+                "exception in task %s was never retrieved",
+                getattr(self.coro, '__qualname__', self.coro),
+                exc_info=(type(exc), exc, exc.__traceback__))
+
+    def cancel(self):
+        """Cancel the task, if it hasn't finished.
+
+        returns: True if it was cancelled
+        """
+
+        if self.has_result:
+            return False
+        self.actor._cancel_task(self)
+        return True
@@ -0,0 +1,247 @@
+# recording and replay of depth camera streams
+# lets the sensor pipeline run without a RealSense attached
+
+import os
+import queue
+import struct
+import threading
+import time
+import numpy as np
+
+# file layout:
+# header: magic, version, width, height, depth scale (meters per unit)
+# then one record per frame: timestamp in ms (float64) followed by
+# the raw z16 depth image, all little endian. the frame count comes
+# from the file size, so a recording cut off mid-frame still replays
+MAGIC = b"DSAADPTH"
+VERSION = 1
+_HEADER = struct.Struct("<8sIIId")
+
+# replay modes
+REPLAY_REALTIME = "realtime" # frames come out as fast as they were recorded
+REPLAY_FIXED = "fixed" # frames come out at a fixed rate
+REPLAY_FAST = "fast" # frames come out as fast as they're asked for
+
+def record_dtype(width, height):
+    """Get the NumPy dtype of one frame record."""
+
+    return np.dtype([("timestamp", "<f8"), ("depth", "<u2", (height, width))])
+
+class ReplayFinished(Exception):
+    """Exception raised when a replay runs out of frames."""
+
+    pass
+
+class DepthRecorder:
+    """Writes depth frames to a file that DepthReplay can play back.
+
+    Frames are copied and handed to a thread of its own that writes them
+    out, so recording never waits on the disk.
+
+    * Instantiate with rec = DepthRecorder(path, width, height, depth_scale)
+    * Write frames with rec.write(depth), where depth is an rs.depth_frame
+      or a (height, width) uint16 array of depth units
+    * Close it with rec.close(), or use it as a context manager
+    """
+
+    def __init__(self, path, width, height, depth_scale):
+        """Create the recording.
+
+        path: file to write to. It's overwritten if it exists.
+        width, height: size of the depth frames
+        depth_scale: meters per depth unit, from get_depth_scale()
+        """
+
+        self.width = width
+        self.height = height
+        self.frames = 0
+
+        self._f = open(path, "wb")
+        self._f.write(_HEADER.pack(MAGIC, VERSION, width, height,
+            depth_scale))
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _writer(self):
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            timestamp, data = record
+            self._f.write(struct.pack("<d", timestamp))
+            self._f.write(data.data)
+        self._f.close()
+
+    def write(self, depth, timestamp=None):
+        """Write one frame.
+
+        depth: an rs.depth_frame or a (height, width) uint16 array
+        timestamp: the frame's time in ms. If None, the frame's own
+          timestamp is used, or the current time if it doesn't have one.
+        """
+
+        if timestamp is None:
+            if hasattr(depth, "get_timestamp"):
+                timestamp = depth.get_timestamp()
+            else:
+                timestamp = time.time()*1000
+        if hasattr(depth, "get_data"):
+            depth = depth.get_data()
+        data = np.asanyarray(depth)
+        if data.shape != (self.height, self.width) or data.dtype != np.uint16:
+            raise ValueError("expected {}x{} uint16 frame, got {} {}".format(
+                self.height, self.width, data.shape, data.dtype))
+
+        # our own copy, the frame's buffer is only good while it's alive
+        self._queue.put((timestamp, np.array(data, order="C")))
+        self.frames += 1
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class ReplayFrame:
+    """One replayed frame. Looks like both an rs.composite_frame and
+    the rs.depth_frame inside it, as far as the sensor code cares."""
+
+    def __init__(self, number, timestamp, data, depth_scale):
+        self.number = number
+        self.timestamp = timestamp
+        self.data = data
+        self.depth_scale = depth_scale
+
+    def get_depth_frame(self):
+        return self
+
+    def get_data(self):
+        # a view straight into the memory map
+        return self.data
+
+    def get_width(self):
+        return self.data.shape[1]
+
+    def get_height(self):
+        return self.data.shape[0]
+
+    def get_timestamp(self):
+        return self.timestamp
+
+    def get_frame_number(self):
+        return self.number
+
+    def get_distance(self, x, y):
+        return float(self.data[y, x])*self.depth_scale
+
+    def __bool__(self):
+        return True
+
+class DepthReplay:
+    """Plays back a DepthRecorder file in place of an rs.pipeline.
+
+    The file is memory-mapped, so frames are never copied or read
+    before they're used. Use it like the pipeline:
+
+      replay = DepthReplay(path)
+      replay.start()
+      frames = replay.wait_for_frames()
+      depth = frames.get_depth_frame()
+
+    wait_for_frames() raises ReplayFinished when there are no frames left
+    (unless loop is True).
+    """
+
+    def __init__(self, path, mode=REPLAY_REALTIME, rate=30.0, speed=1.0,
+            loop=False):
+        """Open the recording.
+
+        path: the file written by DepthRecorder
+        mode: REPLAY_REALTIME to pace frames by their recorded timestamps,
+          REPLAY_FIXED to pace them at rate frames per second, or
+          REPLAY_FAST to return them as soon as they're asked for
+        rate: frames per second in REPLAY_FIXED mode
+        speed: multiplier on the recorded timing in REPLAY_REALTIME mode
+        loop: if True, start over at the end instead of finishing
+        """
+
+        if mode not in (REPLAY_REALTIME, REPLAY_FIXED, REPLAY_FAST):
+            raise ValueError("unknown replay mode: {}".format(mode))
+
+        with open(path, "rb") as f:
+            magic, version, width, height, depth_scale = \
+                _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a depth recording".format(path))
+
+        self.width = width
+        self.height = height
+        self.depth_scale = depth_scale
+        self.mode = mode
+        self.rate = rate
+        self.speed = speed
+        self.loop = loop
+
+        dtype = record_dtype(width, height)
+        # a partially written last frame is left out
+        count = (os.path.getsize(path)-_HEADER.size)//dtype.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype=dtype, mode="r",
+                offset=_HEADER.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, dtype=dtype)
+
+        self._next = 0
+        self._start_time = None
+        self._start_stamp = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def start(self, *args):
+        """Start replaying from the beginning.
+
+        returns: the replay itself, which get_depth_scale() understands
+          like an rs.pipeline_profile
+        """
+
+        self._next = 0
+        self._start_time = None
+        return self
+
+    def stop(self):
+        pass
+
+    def wait_for_frames(self):
+        """Get the next frame, waiting until it's due."""
+
+        if self._next >= len(self.records):
+            if not self.loop or len(self.records) == 0:
+                raise ReplayFinished()
+            self._next = 0
+            self._start_time = None
+
+        i = self._next
+        self._next += 1
+        stamp = float(self.records["timestamp"][i])
+
+        now = time.perf_counter()
+        if self._start_time is None:
+            self._start_time = now
+            self._start_stamp = stamp
+        elif self.mode != REPLAY_FAST:
+            if self.mode == REPLAY_REALTIME:
+                offset = (stamp-self._start_stamp)/1000/self.speed
+            else:
+                offset = i/self.rate
+            delay = self._start_time+offset-now
+            if delay > 0:
+                time.sleep(delay)
+
+        return ReplayFrame(i, stamp, self.records["depth"][i],
+            self.depth_scale)
@@ -2,35 +2,268 @@
 # directly controlled by Pixhawk
 
 import threading
+import time
+from array import array
+from collections import deque
 from dronekit import *
+from pymavlink import mavutil
+
+import telemetry
+
+# what happened to a command, see DronekitCommandAck
+CMD_ACCEPTED = "accepted"
+CMD_REJECTED = "rejected"
+CMD_TIMEOUT = "timeout"
+# sent, for the commands MAVLink never acknowledges
+CMD_SENT = "sent"
 
 # set a specific vehicle attribute
+# after: for the normal lane, how many fast lane commands have to be
+# sent before this one can go, so it doesn't overtake them
+# cid: if not None, the vehicle's answer is sent back in a
+# DronekitCommandAck with this id
 class DronekitSetAttr:
-    def __init__(self, attr, value):
+    def __init__(self, attr, value, trace=None, after=0, cid=None,
+            timeout=None):
         self.attr = attr
         self.value = value
+        # LatencyTrace, if the command is being traced
+        self.trace = trace
+        self.after = after
+        self.cid = cid
+        # seconds to wait for the COMMAND_ACK, if not Dronekit.ACK_TIMEOUT
+        self.timeout = timeout
 
 # send a MAVLink command
 # cmd = "command_long"
 # *args = [0, 0, 1, 3] etc
 # -> vehicle.send_mavlink(vehicle.message_factory.command_long_encode(*args))
 class DronekitSendCommand:
-    def __init__(self, cmd, *args):
+    def __init__(self, cmd, *args, trace=None, after=0, cid=None,
+            timeout=None):
         self.cmd = cmd
         self.args = args
+        # LatencyTrace, if the command is being traced
+        self.trace = trace
+        self.after = after
+        self.cid = cid
+        # seconds to wait for the COMMAND_ACK, if not Dronekit.ACK_TIMEOUT
+        self.timeout = timeout
+
+# sent back to Pixhawk with the result of a command that had a cid,
+# one of CMD_ACCEPTED, CMD_REJECTED, CMD_TIMEOUT or CMD_SENT
+class DronekitCommandAck:
+    def __init__(self, cid, result):
+        self.cid = cid
+        self.result = result
 
 class DronekitReady:
     pass
 
+# sent from Dronekit's fast lane when it's ready. commands sent to the
+# sender skip past whatever's queued up for the normal loop
+class DronekitFastLane:
+    pass
+
+# sent back to Pixhawk with the LatencyTrace of a command
+# once it's been sent to the vehicle
+# priority is the lane it went through, "urgent" or "normal"
+# it's not called trace so CoActors don't stamp it on the way back
+class DronekitTraced:
+    def __init__(self, finished, priority="normal"):
+        self.finished = finished
+        self.priority = priority
+
+# values are packed by telemetry.encode. attr_name is None for a bulk
+# update, where value is a dict of attribute name -> value
+# from Pixhawk, seq is the sequence number of its attribute store that
+# the receiver is caught up to, and epoch is the store's epoch (but only
+# on the first update after a PixhawkUpdateRequest)
 class PixhawkUpdate:
-    def __init__(self, attr_name, value):
+    # there are lots of these, so keep them small to pickle
+    __slots__ = ("attr_name", "value", "seq", "epoch")
+    def __init__(self, attr_name, value, seq=None, epoch=None):
         self.attr_name = attr_name
         self.value = value
+        self.seq = seq
+        self.epoch = epoch
+    def __reduce__(self):
+        if self.seq is None:
+            return (PixhawkUpdate, (self.attr_name, self.value))
+        return (PixhawkUpdate, (self.attr_name, self.value, self.seq,
+            self.epoch))
     def __repr__(self):
         return "{} = {}".format(self.attr_name, self.value)
 
+class RawTelemetry:
+    """Reads some high rate telemetry straight from the MAVLink messages,
+    instead of waiting on dronekit's attribute objects and listeners.
+
+    Each attribute's latest value is kept as plain numbers in one
+    preallocated array, so a message is just a few stores. collect()
+    packs whatever's changed the same way telemetry.encode does.
+
+    * Instantiate with raw = RawTelemetry()
+    * Listen for the messages with raw.attach(vehicle)
+    * Get the changed attributes with raw.collect(attrs)
+    """
+
+    # MAVLink message type -> list of (attribute name, message fields)
+    # a tuple of fields gives a tuple value, a single field a plain number
+    MESSAGES = {
+        "ATTITUDE": [("attitude", ("pitch", "yaw", "roll"))],
+        "LOCAL_POSITION_NED": [("location.local_frame", ("x", "y", "z"))],
+        "VFR_HUD": [("heading", "heading"), ("airspeed", "airspeed"),
+            ("groundspeed", "groundspeed")],
+    }
+
+    def __init__(self, messages=None):
+        """Lay out the records.
+
+        messages: dict like MESSAGES, of the messages to read,
+          in place of MESSAGES
+        """
+
+        self.messages = self.MESSAGES if messages is None else messages
+
+        # (attribute name, offset, number of fields, single) for each
+        # attribute, in order
+        self.attrs = []
+        # message type -> (offset, fields, attribute indices)
+        self._plan = {}
+        n = 0
+        for mtype, attrs in self.messages.items():
+            start = n
+            fields = []
+            indices = []
+            for attr_name, f in attrs:
+                single = isinstance(f, str)
+                if single:
+                    f = (f,)
+                indices.append(len(self.attrs))
+                self.attrs.append((attr_name, n, len(f), single))
+                fields.extend(f)
+                n += len(f)
+            self._plan[mtype] = (start, tuple(fields), tuple(indices))
+        # the attribute names read here
+        self.names = frozenset(a[0] for a in self.attrs)
+
+        self.values = array('d', bytes(8*n))
+        # 1 for each attribute that changed since the last collect()
+        self.dirty = bytearray(len(self.attrs))
+        # messages read so far
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def attach(self, vehicle):
+        """Listen for the messages on the vehicle. dronekit's own
+        listeners are left alone, so its attributes still work."""
+
+        for mtype in self._plan:
+            vehicle.add_message_listener(mtype, self.handle)
+
+    def handle(self, vehicle, mtype, msg):
+        # a message listener, on dronekit's MAVLink thread
+        start, fields, indices = self._plan[mtype]
+        values = self.values
+        with self.lock:
+            for i, field in enumerate(fields):
+                values[start+i] = getattr(msg, field)
+            for i in indices:
+                self.dirty[i] = 1
+            self.count += 1
+
+    def collect(self, attrs):
+        """Put the packed value of each attribute that's changed since
+        the last call into attrs, a dict of attribute name -> value."""
+
+        with self.lock:
+            if not any(self.dirty):
+                return
+            values = self.values
+            for i, (attr_name, start, n, single) in enumerate(self.attrs):
+                if self.dirty[i]:
+                    attrs[attr_name] = values[start] if single \
+                        else tuple(values[start:start+n])
+                    self.dirty[i] = 0
+
 # Dronekit gets its own thread
 class Dronekit:
+    # attributes that are sent to Pixhawk the moment they change.
+    # everything else is coalesced and sent in batches every tick
+    IMMEDIATE = ("mode", "armed")
+    # most updates per second sent for some attributes. if they change
+    # faster, only the latest value is sent when it's allowed
+    MAX_RATES = {
+        "attitude": 20,
+        "location.global_frame": 10,
+        "location.global_relative_frame": 10,
+        "location.local_frame": 10,
+        "velocity": 10,
+        "gps_0": 2,
+        "battery": 1,
+        "last_heartbeat": 1,
+    }
+    # how long to wait for a COMMAND_ACK before giving up, in seconds,
+    # for the commands that don't say
+    ACK_TIMEOUT = 5.0
+
+    def __init__(self, tick=0.05, max_rates=None, immediate=None,
+            raw=False):
+        """Set up how attribute updates are sent to Pixhawk.
+
+        tick: how often batched updates are sent, in seconds
+        max_rates: dict of attribute name to most updates per second,
+          in place of MAX_RATES
+        immediate: attribute names sent as soon as they change,
+          in place of IMMEDIATE
+        raw: if True, read the high rate telemetry in
+          RawTelemetry.MESSAGES straight from the MAVLink messages
+          instead of through dronekit's attributes. Can also be a dict
+          like RawTelemetry.MESSAGES of the ones to read.
+          Raw attributes are only sent on ticks, never immediately.
+          dronekit's own copies of them still update, but aren't sent,
+          and neither is the combined location if location.local_frame
+          is raw.
+        """
+
+        self.tick = tick
+        self.max_rates = self.MAX_RATES if max_rates is None else max_rates
+        self.immediate = set(self.IMMEDIATE if immediate is None
+            else immediate)
+
+        # attribute name -> latest value that hasn't been sent
+        self._pending = {}
+        # attribute name -> when it was last sent
+        self._last_sent = {}
+        self._pending_lock = threading.Lock()
+        # parameter values as last sent, so only changes are sent
+        self._params_sent = {}
+
+        self.raw = None
+        # attributes the raw telemetry sends in place of dronekit's
+        self._raw_names = frozenset()
+        if raw:
+            self.raw = RawTelemetry(None if raw is True else raw)
+            names = set(self.raw.names)
+            if "location.local_frame" in names:
+                # the combined location would only carry a stale copy
+                names.add("location")
+            self._raw_names = frozenset(names)
+
+        # commands go out from the normal loop and the fast lane,
+        # one at a time
+        self._send_lock = threading.Lock()
+        # number of fast lane commands sent so far, so the normal loop
+        # can wait for the ones its commands are after
+        self._urgent_done = 0
+        self._urgent_cond = threading.Condition()
+
+        # MAV_CMD -> deque of (cid, deadline) of the commands waiting for
+        # a COMMAND_ACK, oldest first. the vehicle answers them in order
+        self._acks = {}
+        self._acks_lock = threading.Lock()
+
     # pass the connection string, the actor id of Pixhawk, and the actor system
     def start(self, connection_string, actor, sys):
         self._thread_obj = \
@@ -53,28 +286,202 @@ class Dronekit:
         self.vehicle = connect(connection_string, _initialize=False)
         # observe EVERYTHING!!!
         self.vehicle.add_attribute_listener('*', self.attr_handler)
+        # parameters that change after they're all loaded
+        # only tell their own listeners
+        self.vehicle.parameters.add_attribute_listener('*',
+            self.param_handler)
+        if self.raw is not None:
+            self.raw.attach(self.vehicle)
+        self.vehicle.add_message_listener('COMMAND_ACK', self.ack_handler)
         self.vehicle.initialize(4, 30)
 
+        # urgent commands get a thread of their own, so they don't sit
+        # behind other commands or the attribute callbacks
+        self._fast_thread_obj = threading.Thread(target=self._fast_thread,
+            daemon=True)
+        self._fast_thread_obj.start()
+
         # and enter receive loop
+        next_tick = time.monotonic()+self.tick
+        while True:
+            msg = self.psys.listen(max(0, next_tick-time.monotonic()))
+            now = time.monotonic()
+            if now >= next_tick:
+                self.flush_updates(now)
+                self.expire_acks(now)
+                next_tick = now+self.tick
+            if isinstance(msg, (DronekitSetAttr, DronekitSendCommand)):
+                if msg.after > self._urgent_done:
+                    # don't go before the fast lane commands sent earlier
+                    with self._urgent_cond:
+                        self._urgent_cond.wait_for(
+                            lambda: self._urgent_done >= msg.after, 1.0)
+                self._run_command(msg, self.psys, "normal")
+
+    def _fast_thread(self):
+        # the fast lane for urgent commands, with its own connection
+        # to the actor system so nothing else is queued up in it
+        self.fsys = self.asys.private().__enter__()
+        self.fsys.tell(self.actor, DronekitFastLane())
         while True:
-            msg = self.psys.listen(0.1)
+            msg = self.fsys.listen(1)
+            if isinstance(msg, (DronekitSetAttr, DronekitSendCommand)):
+                self._run_command(msg, self.fsys, "urgent")
+                with self._urgent_cond:
+                    self._urgent_done += 1
+                    self._urgent_cond.notify_all()
+
+    def _run_command(self, msg, sys, priority):
+        # send a DronekitSetAttr or DronekitSendCommand to the vehicle
+        # sys: the system context of the thread this is running on
+        # priority: name of the lane, for the latency stats
+        trace = msg.trace
+        if trace is not None:
+            trace.stamp("Dronekit")
+        result = None
+        with self._send_lock:
+            if msg.cid is not None:
+                result = self._expect_ack(msg)
             if isinstance(msg, DronekitSetAttr):
                 setattr(self.vehicle,
                     msg.attr, msg.value)
-            elif isinstance(msg, DronekitSendCommand):
+            else:
                 enc = getattr(self.vehicle.message_factory,
                     msg.cmd+"_encode")
                 encmsg = enc(*msg.args)
                 self.vehicle.send_mavlink(encmsg)
+        if trace is not None:
+            # it's out the door, send the finished trace back
+            trace.stamp("MAVLink sent")
+            sys.tell(self.actor, DronekitTraced(trace, priority))
+        if result is not None:
+            # there's no ack coming, so that's all there is to say
+            sys.tell(self.actor, DronekitCommandAck(msg.cid, result))
+
+    def _expect_ack(self, msg):
+        # get ready to match the COMMAND_ACK for a command about to go out
+        # returns the result to send right away if there won't be one
+        if isinstance(msg, DronekitSetAttr):
+            if msg.attr == "mode":
+                command = mavutil.mavlink.MAV_CMD_DO_SET_MODE
+            elif msg.attr == "armed":
+                if bool(msg.value) == self.vehicle.armed:
+                    # dronekit doesn't bother sending it
+                    return CMD_ACCEPTED
+                command = mavutil.mavlink.MAV_CMD_COMPONENT_ARM_DISARM
+            else:
+                return CMD_SENT
+        elif msg.cmd in ("command_long", "command_int"):
+            command = msg.args[2]
+        else:
+            return CMD_SENT
+
+        timeout = self.ACK_TIMEOUT if msg.timeout is None else msg.timeout
+        with self._acks_lock:
+            self._acks.setdefault(command, deque()).append(
+                (msg.cid, time.monotonic()+timeout))
+        return None
+
+    def ack_handler(self, vehicle, name, msg):
+        # a message listener for COMMAND_ACK, on dronekit's MAVLink thread
+        if msg.result == mavutil.mavlink.MAV_RESULT_IN_PROGRESS:
+            # there's another one coming when it's finished
+            return
+        command = msg.command
+        if command == mavutil.mavlink.MAVLINK_MSG_ID_SET_MODE:
+            # ArduPilot acks a SET_MODE message with its message id
+            command = mavutil.mavlink.MAV_CMD_DO_SET_MODE
+        with self._acks_lock:
+            waiting = self._acks.get(command)
+            if not waiting:
+                return
+            cid, deadline = waiting.popleft()
+
+        if msg.result == mavutil.mavlink.MAV_RESULT_ACCEPTED:
+            result = CMD_ACCEPTED
+        else:
+            result = CMD_REJECTED
+        if self.hsys is None:
+            self.hsys = self.asys.private().__enter__()
+        self.hsys.tell(self.actor, DronekitCommandAck(cid, result))
+
+    def expire_acks(self, now):
+        """Give up on the commands that have been waiting for a
+        COMMAND_ACK too long, and tell Pixhawk they timed out."""
+
+        expired = []
+        with self._acks_lock:
+            for waiting in self._acks.values():
+                # commands can have timeouts of their own, so the
+                # deadlines aren't in order
+                if any(deadline <= now for cid, deadline in waiting):
+                    keep = []
+                    for cid, deadline in waiting:
+                        if deadline <= now:
+                            expired.append(cid)
+                        else:
+                            keep.append((cid, deadline))
+                    waiting.clear()
+                    waiting.extend(keep)
+        for cid in expired:
+            self.psys.tell(self.actor, DronekitCommandAck(cid, CMD_TIMEOUT))
 
     def attr_handler(self, vehicle, attr_name, value):
+        if attr_name in telemetry.UNSENDABLE or attr_name in self._raw_names:
+            return
+        if attr_name == "parameters":
+            value = self._param_changes(value)
+            if not value:
+                return
+        else:
+            value = telemetry.encode(attr_name, value)
+
+        if attr_name not in self.immediate:
+            # keep just the latest value until the next tick
+            with self._pending_lock:
+                telemetry.merge(self._pending, attr_name, value)
+            return
+
         # the handler gets another system context because it's on another thread
         # (i think)
         if self.hsys is None:
             self.hsys = self.asys.private().__enter__()
-        if attr_name in ("parameters", "location", "channels"):
-            # todo: figure out how to send these without dying
-            # of pickle errors
-            value = "hi this doesn;t work yet"
-
         self.hsys.tell(self.actor, PixhawkUpdate(attr_name, value))
+
+    def param_handler(self, parameters, name, value):
+        self.attr_handler(self.vehicle, "parameters", {name: value})
+
+    def _param_changes(self, params):
+        # the parameters that are different from what was last sent
+        with self._pending_lock:
+            sent = self._params_sent
+            changes = {name: value for name, value in params.items()
+                if name not in sent or sent[name] != value}
+            self._params_sent.update(changes)
+        return changes
+
+    def flush_updates(self, now):
+        """Send the coalesced attribute updates to Pixhawk as one
+        bulk PixhawkUpdate, leaving any that are over their max rate
+        for a later tick."""
+
+        with self._pending_lock:
+            if self.raw is not None:
+                self.raw.collect(self._pending)
+            if not self._pending:
+                return
+            pending = self._pending
+            self._pending = {}
+            updates = {}
+            for attr_name, value in pending.items():
+                rate = self.max_rates.get(attr_name)
+                if rate is not None and \
+                        now-self._last_sent.get(attr_name, -1e9) < 1/rate:
+                    # too soon, hold it (unless a newer one comes along)
+                    telemetry.merge(self._pending, attr_name, value)
+                    continue
+                updates[attr_name] = value
+                self._last_sent[attr_name] = now
+
+        if updates:
+            self.psys.tell(self.actor, PixhawkUpdate(None, updates))
@@ -0,0 +1,70 @@
+# measure message throughput between two CoActors with and without
+# send_batched, on a real multi-process actor system
+# run from the repo root: python3 experiments/bench_batch.py [messages]
+
+import sys
+sys.path.append(".")
+
+import time
+from thespian.actors import *
+
+from coactor import CoActor
+
+class Update:
+    # about the size of a PixhawkUpdate
+    def __init__(self, i):
+        self.attr_name = "attitude"
+        self.value = (0.01*i, 0.02, 1.57)
+
+class Run:
+    def __init__(self, sink, count, batched):
+        self.sink = sink
+        self.count = count
+        self.batched = batched
+
+class Expect:
+    def __init__(self, count):
+        self.count = count
+
+class Source(CoActor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.register_cb(Run, self.msg_run)
+
+    def msg_run(self, msg, sender):
+        send = self.send_batched if msg.batched else self.send
+        for i in range(msg.count):
+            send(msg.sink, Update(i))
+
+class Sink(CoActor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.register_cb(Expect, self.msg_expect)
+        self.register_cb(Update, self.msg_update)
+
+    def msg_expect(self, msg, sender):
+        self.left = msg.count
+        self.requester = sender
+
+    def msg_update(self, msg, sender):
+        self.left -= 1
+        if self.left == 0:
+            self.send(self.requester, "done")
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    asys = ActorSystem("multiprocTCPBase")
+    try:
+        source = asys.createActor(Source)
+        sink = asys.createActor(Sink)
+        for batched in (False, True):
+            asys.tell(sink, Expect(count))
+            start = time.perf_counter()
+            asys.tell(source, Run(sink, count, batched))
+            done = asys.listen(60)
+            elapsed = time.perf_counter()-start
+            print("{:>9}: {} messages in {:.3f} s, {:.0f} msg/s{}".format(
+                "batched" if batched else "unbatched", count, elapsed,
+                count/elapsed, "" if done == "done" else " (timed out)"))
+    finally:
+        asys.shutdown()
@@ -0,0 +1,70 @@
+# benchmark per-pixel get_distance() against vectorized depth ingestion
+# run from the repo root: python3 experiments/bench_depth_ingest.py [frames]
+# uses a synthetic 640x480 frame unless a RealSense camera is attached
+# and --camera is given
+
+import sys
+sys.path.append(".")
+
+import time
+import numpy as np
+
+from sense_template import depth_to_meters, DEPTH_WIDTH, DEPTH_HEIGHT
+
+DEPTH_SCALE = 0.001
+
+# stands in for rs.depth_frame with the two calls we use
+class SyntheticDepthFrame:
+    def __init__(self, width, height):
+        rng = np.random.default_rng(0)
+        self.raw = rng.integers(0, 10000, (height, width), dtype=np.uint16)
+    def get_data(self):
+        return self.raw
+    def get_distance(self, x, y):
+        return float(self.raw[y, x])*DEPTH_SCALE
+    def get_width(self):
+        return self.raw.shape[1]
+    def get_height(self):
+        return self.raw.shape[0]
+
+def legacy_ingest(depth, out):
+    for y in range(depth.get_height()):
+        for x in range(depth.get_width()):
+            out[y, x] = depth.get_distance(x, y)
+    return out
+
+def vector_ingest(depth, out):
+    return depth_to_meters(depth, DEPTH_SCALE, out=out)
+
+def run(name, fn, get_frame, n):
+    out = np.empty([DEPTH_HEIGHT, DEPTH_WIDTH], dtype=np.float32)
+    times = []
+    for i in range(n):
+        depth = get_frame()
+        start = time.perf_counter()
+        fn(depth, out)
+        times.append(time.perf_counter()-start)
+    times = np.array(times)
+    print("{:>8}: {:9.1f} fps  mean {:8.3f} ms  p99 {:8.3f} ms".format(name,
+        1/times.mean(), times.mean()*1e3, np.percentile(times, 99)*1e3))
+    return out
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 200
+
+    if "--camera" in sys.argv:
+        import pyrealsense2 as rs
+        from sense_template import get_depth_scale
+        pipeline = rs.pipeline()
+        DEPTH_SCALE = get_depth_scale(pipeline.start())
+        get_frame = lambda: pipeline.wait_for_frames().get_depth_frame()
+    else:
+        frame = SyntheticDepthFrame(DEPTH_WIDTH, DEPTH_HEIGHT)
+        get_frame = lambda: frame
+
+    print("{}x{} depth, {} frames".format(DEPTH_WIDTH, DEPTH_HEIGHT, n))
+    # the per-pixel loop is so slow only a few frames are worth timing
+    a = run("legacy", legacy_ingest, get_frame, max(1, n//100))
+    b = run("vector", vector_ingest, get_frame, n)
+    if "--camera" not in sys.argv:
+        assert np.allclose(a, b)
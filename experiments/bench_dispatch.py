@@ -0,0 +1,60 @@
+# micro-benchmark of CoActor's callback lookup against the number of
+# registered callbacks, compared with scanning every callback with
+# isinstance() like CoActor used to. only that step is timed, the rest
+# of receiveMessage is the same either way
+# run from the repo root: python3 experiments/bench_dispatch.py
+
+import sys
+sys.path.append(".")
+
+import time
+
+from coactor import CoActor
+
+class Update:
+    pass
+
+class Dispatcher(CoActor):
+    def __init__(self, n):
+        super().__init__()
+        self.hits = 0
+        # a pile of callbacks for other message types,
+        # plus the one the messages are actually for
+        for i in range(n):
+            self.register_cb(type("Other{}".format(i), (), {}), self.hit)
+        self.register_cb(Update, self.hit)
+
+    def hit(self, msg, sender):
+        self.hits += 1
+
+def linear_scan(actor, msg, sender):
+    # the old first step of receiveMessage
+    for mtype, cb in actor._callbacks:
+        if isinstance(msg, mtype):
+            cb(msg, sender)
+
+def indexed(actor, msg, sender):
+    # the new one, from CoActor._process
+    mtype = type(msg)
+    cbs = actor._dispatch.get(mtype)
+    if cbs is None:
+        cbs = actor._resolve_callbacks(mtype)
+    for cb in cbs:
+        cb(msg, sender)
+
+def timed(fn, actor, msg, n):
+    start = time.perf_counter()
+    for i in range(n):
+        fn(actor, msg, None)
+    return (time.perf_counter()-start)/n*1e6
+
+if __name__ == "__main__":
+    n = 100000
+    msg = Update()
+    print("{:>10} {:>14} {:>14}".format("callbacks", "linear us/msg",
+        "indexed us/msg"))
+    for count in (1, 5, 20, 50, 200):
+        actor = Dispatcher(count-1)
+        linear = timed(linear_scan, actor, msg, n)
+        index = timed(indexed, actor, msg, n)
+        print("{:>10} {:>14.3f} {:>14.3f}".format(count, linear, index))
@@ -0,0 +1,116 @@
+# replay a flight recording through Pixhawk to a VehicleProxy as fast as
+# it goes, on a real multi-process actor system, and time the recorder
+# run from the repo root:
+#   python3 experiments/bench_flight.py [recording] [speed]
+# without a recording, a synthetic one of a minute of telemetry is made
+# in a temporary file. speed defaults to as fast as it goes
+
+import sys
+sys.path.append(".")
+
+import math
+import os
+import tempfile
+import time
+from thespian.actors import *
+
+from coactor import CoActor
+from messages import Initialize
+from dk import PixhawkUpdate
+from pixhawk import PixhawkStartDronekit, VehicleProxy
+from flight_recorder import *
+
+class Start:
+    pass
+
+class CountRequest:
+    pass
+
+class Watcher(CoActor):
+    # starts Pixhawk and counts the attribute updates it passes on
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.count = 0
+        self.register_cb(Start, self.msg_start)
+        self.register_cb(CountRequest, self.msg_count_req)
+
+    def msg_start(self, msg, sender):
+        pixhawk = self.createActor('pixhawk.Pixhawk')
+        self.send(pixhawk, Initialize(actor_system=sender))
+        self.vehicle = VehicleProxy(self, pixhawk)
+        self.register_cb(PixhawkUpdate, self.msg_update)
+        self.vehicle.request_updates()
+
+    def msg_update(self, msg, sender):
+        if msg.attr_name is None:
+            self.count += len(msg.value)
+        else:
+            self.count += 1
+
+    def msg_count_req(self, msg, sender):
+        self.send(sender, self.count)
+
+def make_recording(path, seconds=60, rate=50):
+    # everything the proxy waits for up front, then the fast stuff
+    # batched like Dronekit's ticks
+    with FlightRecorder(path) as rec:
+        rec.write(REC_UPDATE, (None, {"parameters": {"SYSID_THISMAV": 1},
+            "gps_0": (121, 65535, 3, 10), "armed": False,
+            "mode": "STABILIZE"}), 0.0)
+        for i in range(seconds*rate):
+            t = i/rate
+            rec.write(REC_UPDATE, (None, {
+                "attitude": (0.01*math.sin(t), 0.1*t % 6.28, 0.02),
+                "location.local_frame": (t, 0.5*t, -20.0),
+                "heading": (5.7*t) % 360,
+                "airspeed": 5.0,
+            }), t)
+
+def time_recorder(path, n=100000):
+    msg = PixhawkUpdate(None, {"attitude": (0.01, 1.57, 0.02),
+        "location.local_frame": (1.0, 2.0, -20.0)})
+    with FlightRecorder(path) as rec:
+        start = time.perf_counter()
+        for i in range(n):
+            rec.update(msg)
+        elapsed = time.perf_counter()-start
+    print("recorder: {:.2f} us/update, {} bytes/update".format(
+        elapsed/n*1e6, (os.path.getsize(path)-16)//n))
+
+if __name__ == "__main__":
+    tmp = tempfile.mkdtemp()
+    path = sys.argv[1] if len(sys.argv) > 1 else None
+    if path is None:
+        path = os.path.join(tmp, "flight.rec")
+        make_recording(path)
+    speed = float(sys.argv[2]) if len(sys.argv) > 2 else None
+
+    time_recorder(os.path.join(tmp, "timing.rec"))
+
+    replay = FlightReplay(path, speed)
+    expected = sum(len(msg.value) if msg.attr_name is None else 1
+        for t, msg in replay.updates)
+
+    asys = ActorSystem("multiprocTCPBase",
+        capabilities={"nav_system": True})
+    try:
+        watcher = asys.createActor(Watcher)
+        asys.tell(watcher, Start())
+        msg = asys.listen(30)
+        if not isinstance(msg, PixhawkStartDronekit):
+            raise RuntimeError("Pixhawk didn't start: {}".format(msg))
+        start = time.perf_counter()
+        replay.start(msg.addr, asys)
+        replay.finished.wait()
+
+        # wait for the watcher to get the last of them
+        count = 0
+        deadline = time.perf_counter()+30
+        while count < expected and time.perf_counter() < deadline:
+            count = asys.ask(watcher, CountRequest(), 5)
+        elapsed = time.perf_counter()-start
+        print("replay: {} of {} attribute updates through to the proxy "
+            "in {:.2f} s, {:.0f}/s".format(count, expected, elapsed,
+                count/elapsed))
+    finally:
+        asys.shutdown()
@@ -0,0 +1,37 @@
+# benchmark the SensorController grid engine on a 640x480 depth image
+# run from the repo root: python3 experiments/bench_grid.py [frames]
+
+import sys
+sys.path.append(".")
+
+import time
+import numpy as np
+
+from sense_template import *
+
+def run(name, controller, meters, n):
+    controller.gridReduce(meters)
+    times = []
+    for i in range(n):
+        start = time.perf_counter()
+        controller.gridReduce(meters)
+        times.append(time.perf_counter()-start)
+    times = np.array(times)
+    print("{:>22}: mean {:6.3f} ms  p99 {:6.3f} ms".format(name,
+        times.mean()*1e3, np.percentile(times, 99)*1e3))
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    rng = np.random.default_rng(0)
+    meters = rng.uniform(0.2, 10, (DEPTH_HEIGHT, DEPTH_WIDTH)).astype(np.float32)
+    # about a third of a real frame has no depth
+    meters[rng.random(meters.shape) < 0.3] = 0
+
+    run("min 5x5", SensorController(), meters, n)
+    run("min 8x12", SensorController(8, 12), meters, n)
+    run("min 5x5 crop 2", SensorController(crop=2), meters, n)
+    run("count 5x5", SensorController(stat=GRID_COUNT), meters, n)
+    run("percentile 5x5", SensorController(stat=GRID_PERCENTILE), meters, n)
+    run("percentile 5x5 stride 2",
+        SensorController(stat=GRID_PERCENTILE, stride=2), meters, n)
@@ -0,0 +1,53 @@
+# compare single-process grid reduction with the SensorPool modes
+# run from the repo root: python3 experiments/bench_pool.py [workers] [frames]
+# uses the percentile statistic, the heaviest one the grid engine has
+
+import sys
+sys.path.append(".")
+
+import time
+import numpy as np
+
+from sense_template import *
+from sense_pool import *
+
+ARGS = dict(stat=GRID_PERCENTILE)
+
+def single(frames):
+    controller = SensorController(**ARGS)
+    meters = np.empty(frames[0].shape, dtype=np.float32)
+    for f in frames:
+        np.multiply(f, np.float32(0.001), out=meters, dtype=np.float32)
+        controller.gridReduce(meters)
+
+def pooled(frames, workers, mode):
+    with SensorPool(DEPTH_WIDTH, DEPTH_HEIGHT, 0.001, workers, mode,
+            controller_args=ARGS) as pool:
+        # let the workers start up before timing
+        pool.submit(frames[0])
+        pool.poll(True)
+        start = time.perf_counter()
+        done = 0
+        for f in frames:
+            pool.submit(f)
+            done += len(pool.poll())
+        while done < len(frames):
+            done += len(pool.poll(True))
+        return time.perf_counter()-start
+
+if __name__ == "__main__":
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    rng = np.random.default_rng(0)
+    frames = [rng.integers(0, 10000, (DEPTH_HEIGHT, DEPTH_WIDTH),
+        dtype=np.uint16) for i in range(16)]
+    frames = [frames[i % len(frames)] for i in range(n)]
+
+    start = time.perf_counter()
+    single(frames)
+    t = time.perf_counter()-start
+    print("{:>16}: {:8.1f} fps".format("single process", n/t))
+    for mode in (POOL_FRAMES, POOL_TILES):
+        t = pooled(frames, workers, mode)
+        print("{:>16}: {:8.1f} fps".format("{} x{}".format(mode, workers), n/t))
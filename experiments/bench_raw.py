@@ -0,0 +1,67 @@
+# measure the CPU cost per telemetry message of dronekit's attribute
+# listeners vs RawTelemetry, feeding decoded MAVLink messages through a
+# Vehicle the same way dronekit's MAVLink thread does
+# run from the repo root: python3 experiments/bench_raw.py [messages]
+
+import sys
+sys.path.append(".")
+
+import time
+from dronekit import Vehicle
+from dronekit.mavlink import MAVConnection
+from pymavlink.dialects.v20 import ardupilotmega as mavlink
+
+from dk import Dronekit
+
+def make_messages(n):
+    # a realistic mix, mostly attitude
+    mav = mavlink.MAVLink(None)
+    msgs = []
+    for i in range(n):
+        t = i*0.01
+        if i % 4 == 3:
+            m = mavlink.MAVLink_local_position_ned_message(i, t, -t, -5.0,
+                1.0, -1.0, 0.0)
+        elif i % 8 == 6:
+            m = mavlink.MAVLink_vfr_hud_message(1.0, 1.5, i % 360, 50,
+                5.0, 0.0)
+        else:
+            m = mavlink.MAVLink_attitude_message(i, 0.01*t, 0.02*t, 0.03*t,
+                0.0, 0.0, 0.0)
+        # round trip so they're like ones off the wire
+        msgs.append(mav.decode(bytearray(m.pack(mav))))
+    return msgs
+
+def run(raw, msgs):
+    handler = MAVConnection("udpin:127.0.0.1:0")
+    vehicle = Vehicle(handler)
+    dk = Dronekit(raw=raw)
+    dk.vehicle = vehicle
+    dk.hsys = None
+    vehicle.add_attribute_listener('*', dk.attr_handler)
+    if dk.raw is not None:
+        dk.raw.attach(vehicle)
+
+    start = time.perf_counter()
+    for i, msg in enumerate(msgs):
+        for fn in handler.message_listeners:
+            fn(handler, msg)
+        if i % 100 == 99:
+            # what a tick collects, without sending it
+            with dk._pending_lock:
+                if dk.raw is not None:
+                    dk.raw.collect(dk._pending)
+                dk._pending.clear()
+    dt = time.perf_counter()-start
+    # its threads have to have started for it to close cleanly
+    handler.start()
+    handler.close()
+    return dt
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    msgs = make_messages(n)
+    for raw in (False, True):
+        dt = run(raw, msgs)
+        print("{:>9}: {:.2f} us/msg, {:.0f} msg/s".format(
+            "raw" if raw else "dronekit", dt/n*1e6, n/dt))
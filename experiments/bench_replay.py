@@ -0,0 +1,74 @@
+# profile the sensor pipeline from a depth recording, no camera needed
+# run from the repo root:
+#   python3 experiments/bench_replay.py [recording]
+# without a recording, a synthetic one with an obstacle coming and going
+# is made in a temporary file
+
+import sys
+sys.path.append(".")
+
+import os
+import tempfile
+import time
+import numpy as np
+
+from sense_template import *
+from depth_replay import *
+
+class NullSystem:
+    def __init__(self):
+        self.told = []
+    def tell(self, addr, msg):
+        self.told.append(msg)
+
+def make_recording(path, frames=600):
+    rng = np.random.default_rng(0)
+    with DepthRecorder(path, DEPTH_WIDTH, DEPTH_HEIGHT, 0.001) as rec:
+        for i in range(frames):
+            depth = rng.integers(2000, 10000, (DEPTH_HEIGHT, DEPTH_WIDTH),
+                dtype=np.uint16)
+            depth[rng.random(depth.shape) < 0.3] = 0
+            if (i//100) % 2 == 1:
+                # something 0.8m in front for a bit over 3 seconds
+                depth[200:280, 280:360] = 800
+            rec.write(depth, i*1000/30)
+
+if __name__ == "__main__":
+    tmp = None
+    if len(sys.argv) > 1:
+        path = sys.argv[1]
+    else:
+        tmp = tempfile.NamedTemporaryFile(suffix=".depth", delete=False)
+        tmp.close()
+        path = tmp.name
+        make_recording(path)
+
+    try:
+        replay = DepthReplay(path, REPLAY_FAST)
+        asys = NullSystem()
+        publisher = DangerPublisher(asys, None)
+        controller = SensorController()
+        depth_scale = get_depth_scale(replay.start())
+        meters = np.empty([replay.height, replay.width], dtype=np.float32)
+
+        times = []
+        while True:
+            try:
+                depth = replay.wait_for_frames().get_depth_frame()
+            except ReplayFinished:
+                break
+            start = time.perf_counter()
+            depth_to_meters(depth, depth_scale, out=meters)
+            grid = controller.gridReduce(meters)
+            publisher.update(grid.min(), depth.get_timestamp()/1000)
+            times.append(time.perf_counter()-start)
+
+        times = np.array(times)
+        print("{} frames: {:.1f} fps  mean {:.3f} ms  p99 {:.3f} ms".format(
+            len(times), 1/times.mean(), times.mean()*1e3,
+            np.percentile(times, 99)*1e3))
+        print("{} messages sent, danger states: {}".format(publisher.sent,
+            [m.danger for m in asys.told]))
+    finally:
+        if tmp is not None:
+            os.unlink(tmp.name)
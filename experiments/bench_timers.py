@@ -0,0 +1,54 @@
+# measure CoActor.sleep wakeup jitter and CPU time with many
+# concurrent sleepers
+# run from the repo root: python3 experiments/bench_timers.py [sleepers]
+
+import sys
+sys.path.append(".")
+
+import time
+from thespian.actors import *
+
+from coactor import CoActor
+
+class Run:
+    def __init__(self, sleepers, seconds):
+        self.sleepers = sleepers
+        self.seconds = seconds
+
+class SleepBench(CoActor):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.register_cb(Run, self.msg_run)
+
+    async def msg_run(self, msg, sender):
+        self.lateness = []
+        self.left = msg.sleepers
+        self.requester = sender
+        self.cpu = time.process_time()
+        for i in range(msg.sleepers):
+            # spread the deadlines out over the period
+            self.call_soon(self.sleeper(msg.seconds*(i+1)/msg.sleepers))
+
+    async def sleeper(self, seconds):
+        due = time.monotonic()+seconds
+        await self.sleep(seconds)
+        self.lateness.append(time.monotonic()-due)
+        self.left -= 1
+        if self.left == 0:
+            self.send(self.requester, (sorted(self.lateness),
+                time.process_time()-self.cpu))
+
+if __name__ == "__main__":
+    asys = ActorSystem("simpleSystemBase")
+    try:
+        bench = asys.createActor(SleepBench)
+        for sleepers in ([int(sys.argv[1])] if len(sys.argv) > 1
+                else (10, 100, 500)):
+            lateness, cpu = asys.ask(bench, Run(sleepers, 1.0), 30)
+            n = len(lateness)
+            print("{:>5} sleepers: lateness p50 {:6.2f} ms  p99 {:6.2f} ms  "
+                "max {:6.2f} ms  cpu {:6.1f} ms".format(sleepers,
+                lateness[n//2]*1000, lateness[int(n*0.99)]*1000,
+                lateness[-1]*1000, cpu*1000))
+    finally:
+        asys.shutdown()
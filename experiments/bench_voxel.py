@@ -0,0 +1,40 @@
+# benchmark the voxel map: projecting and integrating a 640x480 frame,
+# and querying clearance all the way around the drone
+# run from the repo root: python3 experiments/bench_voxel.py [frames]
+
+import sys
+sys.path.append(".")
+
+import time
+import numpy as np
+
+from voxel import DepthProjector, VoxelMap
+
+def timed(name, fn, n):
+    fn(0)
+    start = time.perf_counter()
+    for i in range(n):
+        fn(i)
+    t = (time.perf_counter()-start)/n
+    print("{:>28}: {:6.3f} ms".format(name, t*1000))
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    rng = np.random.default_rng(0)
+    depth = rng.integers(500, 9000, (480, 640), dtype=np.uint16)
+    depth[rng.random(depth.shape) < 0.3] = 0
+
+    for stride in (2, 4):
+        projector = DepthProjector.from_fov(640, 480, 87.0, stride)
+        vmap = VoxelMap()
+        timed("project, stride {}".format(stride),
+            lambda i: projector.project(depth, 0.001), n)
+        points = projector.project(depth, 0.001)
+        timed("integrate {} points".format(len(points)),
+            lambda i: vmap.integrate(points, i/30, i*0.01), n)
+
+    timed("clearance, 36 bearings",
+        lambda i: vmap.clearance(list(range(-180, 180, 10))), n)
+    timed("corridor_clear, 1 heading",
+        lambda i: vmap.corridor_clear(0, 5), n)
@@ -0,0 +1,64 @@
+# micro-benchmark of CoActor.wait_msg with many coroutines waiting on
+# the same message type for different replies, picked out either by
+# a validator or by a key
+# run from the repo root: python3 experiments/bench_waiters.py
+
+import sys
+sys.path.append(".")
+
+import random
+import time
+
+from coactor import CoActor
+
+class Start:
+    def __init__(self, first, last):
+        self.first = first
+        self.last = last
+
+class Reply:
+    def __init__(self, cid):
+        self.cid = cid
+
+class Waiters(CoActor):
+    def __init__(self, keyed):
+        super().__init__()
+        self.keyed = keyed
+        self.replies = 0
+        self.register_key(Reply, lambda msg, sender: msg.cid)
+        self.register_cb(Start, self.msg_start)
+
+    def msg_start(self, msg, sender):
+        for cid in range(msg.first, msg.last):
+            self.call_soon(self.waiter(cid))
+
+    async def waiter(self, cid):
+        while True:
+            if self.keyed:
+                await self.wait_msg(Reply, key=cid)
+            else:
+                await self.wait_msg(Reply,
+                    lambda msg, sender: msg.cid == cid)
+            self.replies += 1
+
+def timed(n, keyed, count):
+    actor = Waiters(keyed)
+    # a few at a time, so they all start before receiveMessage returns
+    for first in range(0, n, actor.READY_LIMIT):
+        actor.receiveMessage(Start(first, min(n, first+actor.READY_LIMIT)),
+            None)
+    msgs = [Reply(random.randrange(n)) for i in range(count)]
+    start = time.perf_counter()
+    for msg in msgs:
+        actor.receiveMessage(msg, None)
+    elapsed = time.perf_counter()-start
+    assert actor.replies == count
+    return elapsed/count*1e6
+
+if __name__ == "__main__":
+    print("{:>8} {:>17} {:>14}".format("waiters", "validator us/msg",
+        "keyed us/msg"))
+    for n in (1, 10, 100, 1000, 5000):
+        count = max(200, 200000//n)
+        print("{:>8} {:>17.2f} {:>14.2f}".format(n,
+            timed(n, False, count), timed(n, True, count)))
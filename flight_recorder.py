@@ -0,0 +1,222 @@
+# recording and replay of what goes through the Pixhawk actor
+# the telemetry it gets from Dronekit and the commands it sends back
+# can be played back through the whole actor stack without a vehicle
+
+import pickle
+import queue
+import struct
+import threading
+import time
+
+from dk import PixhawkUpdate, DronekitReady, DronekitSetAttr, \
+    DronekitSendCommand, DronekitTraced, DronekitCommandAck, CMD_SENT
+
+# file layout:
+# header: magic, version
+# then one record per event: time in seconds (float64, time.monotonic()
+# when Pixhawk got it), kind (uint8), payload length (uint32), then the
+# pickled payload, all little endian. a recording cut off mid-record
+# still replays up to there
+MAGIC = b"DSAAFLGT"
+VERSION = 1
+_HEADER = struct.Struct("<8sI")
+_RECORD = struct.Struct("<dBI")
+
+# record kinds
+REC_UPDATE = 0 # a PixhawkUpdate, payload (attr_name, value)
+REC_COMMAND = 1 # a PixhawkProxyCommand, payload (cmd, args)
+
+class FlightRecorder:
+    """Writes Pixhawk's telemetry and commands to a file that
+    FlightReplay can play back.
+
+    Records are packed into a buffer in memory, and full buffers are
+    written out by a thread of its own, so recording never waits on
+    the disk.
+
+    * Instantiate with rec = FlightRecorder(path)
+    * Record with rec.update(msg) and rec.command(msg)
+    * Hand what's buffered to the writer with rec.flush() every so often,
+      so not much is lost if we crash
+    * Close it with rec.close(), or use it as a context manager
+    """
+
+    def __init__(self, path, chunk=65536):
+        """Create the recording.
+
+        path: file to write to. It's overwritten if it exists.
+        chunk: bytes to buffer before handing them to the writer
+        """
+
+        self.chunk = chunk
+        self.records = 0
+
+        self._f = open(path, "wb")
+        self._buf = bytearray(_HEADER.pack(MAGIC, VERSION))
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _writer(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                break
+            self._f.write(data)
+            self._f.flush()
+        self._f.close()
+
+    def write(self, kind, payload, t=None):
+        """Write one record.
+
+        kind: REC_UPDATE or REC_COMMAND
+        payload: anything that can be pickled
+        t: the time of the record, if not now
+        """
+
+        if t is None:
+            t = time.monotonic()
+        blob = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+        self._buf += _RECORD.pack(t, kind, len(blob))
+        self._buf += blob
+        self.records += 1
+        if len(self._buf) >= self.chunk:
+            self.flush()
+
+    def update(self, msg, t=None):
+        """Record a PixhawkUpdate."""
+
+        self.write(REC_UPDATE, (msg.attr_name, msg.value), t)
+
+    def command(self, msg, t=None):
+        """Record a PixhawkProxyCommand."""
+
+        self.write(REC_COMMAND, (msg.cmd, msg.args), t)
+
+    def flush(self):
+        """Hand everything buffered to the writer."""
+
+        if self._buf:
+            self._queue.put(self._buf)
+            self._buf = bytearray()
+
+    def close(self):
+        self.flush()
+        self._queue.put(None)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_recording(path):
+    """Read a FlightRecorder file.
+
+    returns: a list of (time, kind, payload)
+    """
+
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < _HEADER.size:
+        raise ValueError("{} is not a flight recording".format(path))
+    magic, version = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{} is not a flight recording".format(path))
+
+    records = []
+    pos = _HEADER.size
+    while pos+_RECORD.size <= len(data):
+        t, kind, n = _RECORD.unpack_from(data, pos)
+        pos += _RECORD.size
+        if pos+n > len(data):
+            # cut off
+            break
+        records.append((t, kind, pickle.loads(data[pos:pos+n])))
+        pos += n
+    return records
+
+class FlightReplay:
+    """Plays back a FlightRecorder file into Pixhawk in place of the
+    Dronekit thread.
+
+    Start it like Dronekit, with replay.start(pixhawk_addr, asys), when
+    Pixhawk asks for Dronekit with a PixhawkStartDronekit. The recorded
+    PixhawkUpdates are sent as they were flown, or faster.
+
+    Commands Pixhawk sends it are counted and answered with CMD_SENT,
+    since there's no telling what the vehicle would have made of them.
+    After the last update it carries on answering commands, and
+    replay.finished is set.
+    """
+
+    # while sending as fast as it can, how many updates to send between
+    # checking for commands
+    POLL_EVERY = 64
+
+    def __init__(self, path, speed=1.0):
+        """Load the recording.
+
+        path: the file written by FlightRecorder
+        speed: multiplier on the recorded timing, e.g. 1.0 to replay as
+          it was flown or 10.0 for ten times as fast. None to send the
+          updates as fast as they go.
+        """
+
+        self.speed = speed
+        records = read_recording(path)
+        # the updates ready to send, with their times
+        self.updates = [(t, PixhawkUpdate(*payload))
+            for t, kind, payload in records if kind == REC_UPDATE]
+        self.commands_recorded = sum(1 for t, kind, payload in records
+            if kind == REC_COMMAND)
+        self.commands_sent = 0
+        self.finished = threading.Event()
+
+    # pass the actor id of Pixhawk and the actor system
+    def start(self, actor, sys):
+        self._thread_obj = threading.Thread(target=self._thread,
+            args=(actor, sys), daemon=True)
+        self._thread_obj.start()
+
+    def _thread(self, actor, sys):
+        self.actor = actor
+        self.psys = sys.private().__enter__()
+        self.psys.tell(self.actor, DronekitReady())
+
+        start = time.monotonic()
+        first = self.updates[0][0] if self.updates else 0
+        for i, (t, msg) in enumerate(self.updates):
+            if self.speed is not None:
+                due = start+(t-first)/self.speed
+                # answer commands until it's due
+                while True:
+                    delay = due-time.monotonic()
+                    if delay <= 0:
+                        break
+                    self._serve(delay)
+            elif i % self.POLL_EVERY == 0:
+                self._serve(0)
+            self.psys.tell(self.actor, msg)
+
+        elapsed = time.monotonic()-start
+        print("[REPLAY] Finished: {} updates in {:.2f} s ({:.0f}/s)".format(
+            len(self.updates), elapsed, len(self.updates)/max(elapsed, 1e-9)))
+        self.finished.set()
+        while True:
+            self._serve(1)
+
+    def _serve(self, timeout):
+        # answer a command from Pixhawk, if there is one in time
+        msg = self.psys.listen(timeout)
+        if not isinstance(msg, (DronekitSetAttr, DronekitSendCommand)):
+            return
+        self.commands_sent += 1
+        if msg.trace is not None:
+            # stamped like Dronekit does, so the stats line up
+            msg.trace.stamp("Dronekit")
+            msg.trace.stamp("MAVLink sent")
+            self.psys.tell(self.actor, DronekitTraced(msg.trace))
+        if msg.cid is not None:
+            self.psys.tell(self.actor, DronekitCommandAck(msg.cid, CMD_SENT))
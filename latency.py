@@ -0,0 +1,144 @@
+# latency tracing through the obstacle reaction chain,
+# from the depth frame to the command going out to the Pixhawk
+
+import time
+
+class LatencyTrace:
+    """Timestamps a message collects on its way through the system.
+
+    Each hop calls trace.stamp(stage) when the message gets there, and
+    the trace is passed along on the next message. Times come from
+    time.monotonic(), which is the same clock in every process on one
+    Linux machine.
+    """
+
+    def __init__(self, stage=None, t=None):
+        """Start a trace.
+
+        stage: if not None, the name of the first stage
+        t: the time of the first stage, if not now
+        """
+
+        self.stamps = []
+        if stage is not None:
+            self.stamp(stage, t)
+
+    def stamp(self, stage, t=None):
+        """Record that the message reached a stage.
+
+        stage: name of the stage
+        t: the time it got there, if not now
+        """
+
+        if t is None:
+            t = time.monotonic()
+        self.stamps.append((stage, t))
+
+    def hops(self):
+        """Get the time taken between each pair of stages.
+
+        returns: a list of ("stage -> next stage", seconds)
+        """
+
+        return [("{} -> {}".format(a, b), tb-ta)
+            for (a, ta), (b, tb) in zip(self.stamps, self.stamps[1:])]
+
+    def total(self):
+        """Get the time from the first stage to the last, in seconds."""
+
+        if len(self.stamps) < 2:
+            return 0.0
+        return self.stamps[-1][1]-self.stamps[0][1]
+
+    def __repr__(self):
+        return ", ".join("{}: {:.2f} ms".format(h, dt*1000)
+            for h, dt in self.hops())
+
+class LatencyHistogram:
+    """Histogram of latencies with fixed buckets."""
+
+    # upper edges of the buckets, in ms. there's one more for anything over
+    BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self):
+        self.counts = [0]*(len(self.BUCKETS)+1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        ms = seconds*1000
+        i = 0
+        while i < len(self.BUCKETS) and ms > self.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p):
+        """Get the upper edge of the bucket the p'th percentile is in, in ms."""
+
+        if self.count == 0:
+            return 0.0
+        target = p/100*self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+        return self.max
+
+    def __str__(self):
+        if self.count == 0:
+            return "no samples"
+        return "n={} mean={:.2f} p50<={} p99<={} max={:.2f} ms".format(
+            self.count, self.sum/self.count, self.percentile(50),
+            self.percentile(99), self.max)
+
+class LatencyStats:
+    """Latency histograms for every hop of the traces recorded."""
+
+    def __init__(self):
+        # hop name -> LatencyHistogram, in the order they were first seen
+        self.hists = {}
+
+    def record(self, trace, prefix=""):
+        """Add each hop of a finished trace, plus its total.
+
+        prefix: put in front of the hop names, to keep different
+          kinds of traces apart
+        """
+
+        for hop, dt in trace.hops():
+            self._hist(prefix+hop).add(dt)
+        if len(trace.stamps) > 1:
+            self._hist("{}total {} -> {}".format(prefix, trace.stamps[0][0],
+                trace.stamps[-1][0])).add(trace.total())
+
+    def _hist(self, name):
+        h = self.hists.get(name)
+        if h is None:
+            h = LatencyHistogram()
+            self.hists[name] = h
+        return h
+
+    def report(self):
+        """Get a printable report of all the histograms."""
+
+        if not self.hists:
+            return "no latency samples"
+        width = max(len(name) for name in self.hists)
+        return "\n".join("{:>{}}: {}".format(name, width, h)
+            for name, h in self.hists.items())
+
+# ask an actor for its latency stats. it responds with a LatencyReport
+class LatencyReportRequest:
+    pass
+
+class LatencyReport:
+    def __init__(self, stats):
+        self.stats = stats
+    def __repr__(self):
+        return self.stats.report()
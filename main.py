@@ -2,9 +2,11 @@
 
 from thespian.actors import *
 from messages import Initialize
+import sys
 import time
 
 from dk import Dronekit
+from flight_recorder import FlightReplay
 from pixhawk import PixhawkStartDronekit
 
 if __name__ == "__main__":
@@ -13,15 +15,35 @@ if __name__ == "__main__":
         capabilities={"nav_system": True})
 
     try:
+        # --record-flight file records the telemetry and commands
+        # --replay-flight file plays one back instead of connecting to the
+        # vehicle, as it was flown or --speed times as fast, or --fast
+        init_data = {}
+        if "--record-flight" in sys.argv:
+            init_data["flight_record"] = \
+                sys.argv[sys.argv.index("--record-flight")+1]
+        replay = None
+        if "--replay-flight" in sys.argv:
+            speed = 1.0
+            if "--fast" in sys.argv:
+                speed = None
+            elif "--speed" in sys.argv:
+                speed = float(sys.argv[sys.argv.index("--speed")+1])
+            replay = FlightReplay(
+                sys.argv[sys.argv.index("--replay-flight")+1], speed)
+
         # instantiate navigation processor
         nav = asys.createActor("nav.Navigation", globalName="Navigation")
         # tell it to start up
-        asys.tell(nav, Initialize())
+        asys.tell(nav, Initialize(**init_data))
 
         # wait for certain messages
         while True:
             msg = asys.listen()
             if isinstance(msg, PixhawkStartDronekit):
+                if replay is not None:
+                    replay.start(msg.addr, asys)
+                    continue
                 dk = Dronekit()
                 dk.start('tcp:127.0.0.1:5763', msg.addr, asys)
     finally:
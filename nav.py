@@ -3,16 +3,116 @@
 from thespian.actors import *
 from messages import Initialize
 import copy
+import math
+import sys
+import time
+from array import array
 
 from coactor import CoActor, Future
 from pixhawk import *
+# dronekit's own TimeoutError comes in with that, but wait_for
+# raises the builtin one
+from builtins import TimeoutError
 
 # sent to the navigation if the drone is about to hit something
 class DroneInDanger:
-    def __init__(self, danger=True):
+    def __init__(self, danger=True, trace=None):
         self.danger = danger
+        # LatencyTrace from the depth frame that decided it, if any
+        self.trace = trace
+
+# sent by the sensor with a summary of what's in front of the drone.
+# it's also a DroneInDanger, so it can be sent instead of one.
+# the grid is packed into bytes so it's cheap to pickle at frame rate
+class ObstacleSummary(DroneInDanger):
+    # cell value for "nothing seen", i.e. as far as can be
+    NOTHING = 0xFFFF
+
+    def __init__(self, danger, rows, cols, cells, hfov, bearing, nearest,
+            stamp, fan=None):
+        """Make the summary.
+
+        danger: the same as in DroneInDanger
+        rows, cols: size of the distance grid
+        cells: the grid as bytes, rows*cols little endian uint16 distances
+          in millimeters, row-major from the top left. NOTHING means the
+          cell didn't see anything.
+        hfov: horizontal field of view covered by the grid, in degrees
+        bearing: direction of the nearest obstacle in degrees,
+          relative to the nose, positive to the right
+        nearest: distance to the nearest obstacle in meters
+        stamp: time of the frame it came from, in seconds
+        fan: if not None, how far it's clear all the way around the drone,
+          from the sensor's voxel map. Bytes of little endian uint16
+          distances in millimeters, for evenly spaced bearings starting
+          at -180 degrees. It's only as far as the map has seen, so
+          bearings it hasn't looked along are short, not clear.
+        """
+
+        super().__init__(danger)
+        self.rows = rows
+        self.cols = cols
+        self.cells = cells
+        self.hfov = hfov
+        self.bearing = bearing
+        self.nearest = nearest
+        self.stamp = stamp
+        self.fan = fan
+
+    def _unpack(self, data):
+        mm = array('H', data)
+        if sys.byteorder == 'big':
+            mm.byteswap()
+        return [math.inf if d == self.NOTHING else d/1000 for d in mm]
+
+    def fan_clearance(self):
+        """Get how far it's clear all the way around the drone.
+
+        returns: a list of (bearing, distance) with bearing in degrees
+          relative to the nose and distance in meters, or None if the
+          sensor didn't send any
+        """
+
+        if self.fan is None:
+            return None
+        dists = self._unpack(self.fan)
+        step = 360/len(dists)
+        return [(-180+i*step, d) for i, d in enumerate(dists)]
+
+    def distances(self):
+        """Get the grid as a list of rows of distances in meters.
+        Cells that didn't see anything are math.inf."""
+
+        mm = self._unpack(self.cells)
+        return [mm[r*self.cols:(r+1)*self.cols] for r in range(self.rows)]
+
+    def column_clearance(self):
+        """Get the closest distance in each column of the grid, in meters."""
+
+        return [min(col) for col in zip(*self.distances())]
+
+    def column_bearing(self, col):
+        """Get the direction the center of a column looks in, in degrees
+        relative to the nose, positive to the right."""
+
+        u = (col+0.5)/self.cols*2-1
+        half = math.radians(self.hfov/2)
+        return math.degrees(math.atan(u*math.tan(half)))
+
+# sent by the navigation to a sensor that sends a voxel map fan,
+# with the drone's yaw in radians, so the map can stay put while the
+# drone turns
+class VehicleYaw:
+    def __init__(self, yaw):
+        self.yaw = yaw
 
 class Navigation(CoActor):
+    # longest to wait for the drone to stop, in seconds
+    STOP_TIMEOUT = 10.0
+    # most VehicleYaws sent to the sensor per second, about its frame
+    # rate. it only uses the newest one each frame
+    YAW_RATE = 30
+
     @staticmethod
     def actorSystemCapabilityCheck(capabilities, requirements=None):
         return capabilities.get("nav_system", False)
@@ -28,6 +128,18 @@ class Navigation(CoActor):
         # monitor if we're in danger, i.e. about to hit something
         self.in_danger = False
         self.in_danger_fut = None
+        # the latest ObstacleSummary, if the sensor sends them
+        self.obstacles = None
+        # LatencyTrace of the message that last changed in_danger
+        self.danger_trace = None
+        # where to send the yaw to, once a sensor with a voxel map
+        # says hello
+        self.sensor_addr = None
+        # newest yaw, when one was last sent, and the call_later timer
+        # to send the newest once it's allowed
+        self._yaw = None
+        self._yaw_sent = -1e9
+        self._yaw_timer = None
 
     async def msg_init(self, msg, sender):
         print("[NAV] Initializing!")
@@ -41,10 +153,12 @@ class Navigation(CoActor):
 
         # now create a vehicle proxy
         self.vehicle = VehicleProxy(self, self.pixhawk)
-        # register update callback
+        # register update and command ack callbacks
         self.register_cb(PixhawkUpdate, self.vehicle.process_update)
+        self.register_cb(PixhawkCommandAck, self.vehicle.process_ack)
+        self.vehicle.register_cb('attitude', self.attitude_changed)
         # and request updates
-        self.send(self.pixhawk, PixhawkUpdateRequest())
+        self.vehicle.request_updates()
 
         print("[NAV] Done!")
         # unregister init callback
@@ -71,25 +185,44 @@ class Navigation(CoActor):
             await self.wait_for_danger()
             # we're about to hit something!
             print("[NAV] in danger, stopping!!!")
-            self.vehicle.stop_now()
-            # wait until we stop
-            await self.vehicle.wait_until('airspeed',
-                lambda s: s < 0.1)
+            self.vehicle.stop_now(self.danger_trace)
+            # it's done its job, don't count it again
+            self.danger_trace = None
+            # wait until we stop, but don't hang if telemetry stalls
+            try:
+                await self.wait_for(self.vehicle.wait_until('airspeed',
+                    lambda s: s < 0.1), self.STOP_TIMEOUT)
+            except TimeoutError:
+                print("[NAV] Didn't see us stop, carrying on")
 
             print("[NAV] Stopped, looking around")
             self.vehicle.set_mode("GUIDED")
-            heading = await self.vehicle.wait_for_next('heading')
+            try:
+                heading = await self.wait_for(
+                    self.vehicle.wait_for_next('heading'), self.STOP_TIMEOUT)
+            except TimeoutError:
+                # go with the last one we had. heading might never have
+                # come, but wait_ready waited for the attitude
+                heading = getattr(self.vehicle, 'heading', None)
+                if heading is None:
+                    heading = math.degrees(self.vehicle.attitude.yaw) % 360
+
+            # if the sensor told us what it sees, go straight to
+            # a direction that's clear
+            escape = self.pick_escape_heading(heading)
+            if escape is not None:
+                print("[NAV] Turning {:.0f} degrees to clear heading".format(
+                    escape-heading))
+                heading = escape
+                if not await self.turn_to(heading):
+                    escape = None
 
             amount_rotated = 0
-            while amount_rotated <= 360:
+            while escape is None and amount_rotated <= 360:
                 heading -= 10
                 amount_rotated += 10
-                self.vehicle.set_heading(heading % 360)
-                # wait until we get to the specified heading
-                await self.vehicle.wait_until('heading',
-                    # will mess up around a circle
-                    # but fine for testing
-                    lambda h: h-(heading%360) < 2)
+                if not await self.turn_to(heading):
+                    continue
                 # updated by receiving the DroneInDanger message
 
                 if not self.in_danger:
@@ -101,9 +234,16 @@ class Navigation(CoActor):
             while not self.vehicle.is_close_to_local(pos):
                 if self.in_danger:
                     print("[NAV] Oh no! There it is again!")
-                    self.vehicle.stop_now()
+                    self.vehicle.stop_now(self.danger_trace)
+                    self.danger_trace = None
                     break
-                await self.vehicle.wait_for_next('location.local_frame')
+                # wake up for whichever comes first, so a new obstacle
+                # stops us right away and not at the next position update
+                done, pending = await self.first_completed(
+                    self.vehicle.wait_for_next('location.local_frame'),
+                    self.wait_for_next_danger())
+                for task in pending:
+                    task.cancel()
 
             if not self.in_danger:
                 print("[NAV] Okay, it's clear...")
@@ -122,11 +262,15 @@ class Navigation(CoActor):
         self.vehicle.set_mode("STABILIZE")
 
         print("[NAV] Arming motors")
-        await self.vehicle.arm_motors(True)
+        while await self.vehicle.arm_motors(True) == CMD_REJECTED:
+            print("[NAV] Arming rejected, trying again")
+            await self.sleep(1)
 
         print("[NAV] Taking off!")
         self.vehicle.set_mode("GUIDED")
-        await self.vehicle.takeoff(20) # meters
+        while await self.vehicle.takeoff(20) == CMD_REJECTED: # meters
+            print("[NAV] Takeoff rejected, trying again")
+            await self.sleep(1)
 
         print("[NAV] Beginning mission")
         self.vehicle.set_mode("AUTO")
@@ -134,15 +278,103 @@ class Navigation(CoActor):
     async def msg_shutdown(self, msg, sender):
         print("[NAV] Shutdown")
 
+    def attitude_changed(self, attr_name, attitude):
+        if self.sensor_addr is None:
+            return
+        # attitude comes faster than frames, so only send the newest,
+        # and no more often than YAW_RATE
+        self._yaw = attitude.yaw
+        if self._yaw_timer is None:
+            wait = self._yaw_sent+1/self.YAW_RATE-time.monotonic()
+            if wait <= 0:
+                self._send_yaw()
+            else:
+                self._yaw_timer = self.call_later(wait, self._send_yaw)
+
+    def _send_yaw(self):
+        self._yaw_timer = None
+        self._yaw_sent = time.monotonic()
+        self.send(self.sensor_addr, VehicleYaw(self._yaw))
+
     async def msg_in_danger(self, msg, sender):
+        if isinstance(msg, ObstacleSummary):
+            self.obstacles = msg
+            if msg.fan is not None:
+                self.sensor_addr = sender
+        # the sensor repeats its state as a keepalive, so only
+        # wake up the waiters if it actually changed
+        if msg.danger == self.in_danger:
+            return
         self.in_danger = msg.danger
+        self.danger_trace = msg.trace
         if self.in_danger_fut is not None:
             self.in_danger_fut.set_result(self.in_danger)
             self.in_danger_fut = None
 
+    async def turn_to(self, heading):
+        """Turn to a heading and wait until we're facing it.
+
+        heading: the compass heading, in degrees
+
+        returns: True if we got there, False if the turn was rejected,
+          wasn't answered, or didn't happen within STOP_TIMEOUT
+        """
+
+        result = await self.vehicle.set_heading(heading % 360)
+        if result in (CMD_REJECTED, CMD_TIMEOUT):
+            # no use waiting for a turn that isn't happening
+            print("[NAV] Turn {}".format(
+                "rejected" if result == CMD_REJECTED else "not answered"))
+            return False
+        try:
+            await self.wait_for(self.vehicle.wait_until('heading',
+                lambda h: abs((h-heading+180) % 360 - 180) < 2),
+                self.STOP_TIMEOUT)
+        except TimeoutError:
+            print("[NAV] Didn't see us turn")
+            return False
+        return True
+
+    def pick_escape_heading(self, heading, clear_dist=5.0):
+        """Pick a heading to get around the obstacle, using the
+        latest ObstacleSummary.
+
+        heading: the current heading, in degrees
+        clear_dist: how far a direction has to be clear, in meters
+
+        returns: the clear heading closest to the current one, or None
+          if there isn't a summary or nothing it knows about is clear.
+          The heading isn't wrapped, so heading-returned is how far to turn.
+        """
+
+        summary = self.obstacles
+        if summary is None:
+            return None
+
+        # the voxel map's fan sees all the way around, or at least what
+        # it remembers. bearings it hasn't seen come out short, so when
+        # none are known to be clear we turn and look instead.
+        # otherwise use what's in front of the camera
+        choices = summary.fan_clearance()
+        if choices is None:
+            choices = [(summary.column_bearing(col), clearance)
+                for col, clearance in enumerate(summary.column_clearance())]
+
+        best = None
+        for bearing, clearance in choices:
+            if clearance < clear_dist:
+                continue
+            if best is None or abs(bearing) < abs(best):
+                best = bearing
+        if best is None:
+            return None
+        return heading+best
+
     async def wait_for_danger(self):
         while not self.in_danger:
             await self.wait_for_next_danger()
+        if self.danger_trace is not None:
+            self.danger_trace.stamp("nav resumed")
 
     async def wait_for_next_danger(self):
         if self.in_danger_fut is None:
@@ -7,15 +7,37 @@ from coactor import CoActor, Future
 from dronekit import VehicleMode
 from pymavlink import mavutil
 from functools import partial as curry
+import fnmatch
+import itertools
 import math
+import time
 
 from dk import *
+import telemetry
+from flight_recorder import FlightRecorder
+from latency import LatencyTrace, LatencyStats, LatencyReportRequest, \
+    LatencyReport
 
 # a command from the vehicle proxy to do something
+# cid: if not None, a PixhawkCommandAck with this id is sent back
+#   once the vehicle answers
 class PixhawkProxyCommand:
-    def __init__(self, cmd, *args):
+    def __init__(self, cmd, *args, trace=None, cid=None, timeout=None):
         self.cmd = cmd
         self.args = args
+        # LatencyTrace, if the command is being traced
+        self.trace = trace
+        self.cid = cid
+        # seconds Dronekit waits for the vehicle to answer,
+        # if not Dronekit.ACK_TIMEOUT
+        self.timeout = timeout
+
+# the result of a PixhawkProxyCommand, sent to the actor that sent it
+# result is one of CMD_ACCEPTED, CMD_REJECTED, CMD_TIMEOUT or CMD_SENT
+class PixhawkCommandAck:
+    def __init__(self, cid, result):
+        self.cid = cid
+        self.result = result
 
 class PixhawkStartDronekit:
     def __init__(self, pixhawk_addr):
@@ -24,9 +46,68 @@ class PixhawkStartDronekit:
 
 # enable/disable sending pixhawk updates to the actor
 # that sent the message
+# attrs: attribute names or patterns like "location.*" to send,
+#   or None for all of them
+# max_rate: most updates per second of each attribute, or None for
+#   every update
+# rates: dict of attribute name or pattern -> most updates per second,
+#   for the ones that need a different rate than max_rate
+# since: (epoch, seq) from the PixhawkUpdates the actor got before, to
+#   only be sent what changed since then instead of everything
+# batch: True if the actor is a CoActor, so several updates can be
+#   sent to it together in one CoActor.Envelope
+# a new request from the same actor replaces its old one
 class PixhawkUpdateRequest:
-    def __init__(self, enable=True):
+    def __init__(self, enable=True, attrs=None, max_rate=None, rates=None,
+            since=None, batch=False):
         self.enable = enable
+        self.attrs = attrs
+        self.max_rate = max_rate
+        self.rates = rates
+        self.since = since
+        self.batch = batch
+
+class PixhawkSubscription:
+    """What one actor asked Pixhawk for with a PixhawkUpdateRequest,
+    and the updates it's waiting to be sent."""
+
+    def __init__(self, addr, attrs=None, max_rate=None, rates=None,
+            batch=False):
+        self.addr = addr
+        self.attrs = None if attrs is None else tuple(attrs)
+        self.max_rate = max_rate
+        self.rates = rates or {}
+        # whether it's a CoActor that can take batched updates
+        self.batch = batch
+
+        # updates to send once the current message is handled
+        self.outbox = {}
+        # updates held back by the rate limit
+        self.pending = {}
+        # store seq of the oldest change in pending
+        self.pending_seq = None
+        # attribute name -> when it was last sent
+        self.last_sent = {}
+        # call_later timer to send the pending updates
+        self.timer = None
+
+    def wants(self, attr_name):
+        if self.attrs is None:
+            return True
+        return any(fnmatch.fnmatchcase(attr_name, p) for p in self.attrs)
+
+    def period(self, attr_name):
+        """Get the shortest time between updates of an attribute, in
+        seconds, or None if it's not limited."""
+
+        rate = self.max_rate
+        for pattern, r in self.rates.items():
+            if fnmatch.fnmatchcase(attr_name, pattern):
+                rate = r
+                break
+        if not rate:
+            return None
+        return 1/rate
 
 class Pixhawk(CoActor):
     """Actor that manages the Pixhawk flight controller."""
@@ -37,6 +118,10 @@ class Pixhawk(CoActor):
         # is actually connected to the pixhawk
         return capabilities.get("nav_system", False)
 
+    # how often the flight recorder's buffer is handed to its writer,
+    # in seconds
+    RECORD_FLUSH = 1.0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -44,17 +129,55 @@ class Pixhawk(CoActor):
         self.register_cb(ActorExitRequest, self.msg_shutdown)
         self.register_cb(Initialize, self.msg_init)
 
-        self.updatees = []
-
-        self.attrs = {}
+        # PixhawkSubscriptions of the actors that want updates
+        self.subscriptions = []
+        # attribute name -> list of (subscription, period)
+        # of the subscriptions that want it
+        self._sub_index = {}
+
+        # latest value of every attribute, numbered
+        self.store = telemetry.AttributeStore()
+
+        # latency of commands, from wherever their trace started
+        # to going out over MAVLink, with the hops named by priority
+        self.latency = LatencyStats()
+
+        # command name -> function that makes its message for Dronekit
+        self._proxy_cmds = {
+            "arm": self._cmd_arm,
+            "mode": self._cmd_mode,
+            "takeoff": self._cmd_takeoff,
+            "heading": self._cmd_heading,
+            "move_local": self._cmd_move_local,
+        }
+        # address of Dronekit's fast lane for urgent commands, once it's up
+        self.dk_fast_addr = None
+        # how many commands have gone down the fast lane
+        self._urgent_sent = 0
+        # our command id -> (sender, their cid) of the commands
+        # waiting for an answer from the vehicle
+        self._acks = {}
+        self._cids = itertools.count(1)
+        # FlightRecorder of the updates and commands, if recording
+        self.recorder = None
+        self.register_cb(DronekitTraced, self.msg_dk_traced)
+        self.register_cb(DronekitCommandAck, self.msg_dk_ack)
+        self.register_cb(LatencyReportRequest, self.msg_latency_req)
 
     async def msg_init(self, msg, sender):
         print("[PIX] Initializing!")
         self.init_data = copy.deepcopy(msg.data)
 
+        # flight_record is a path to record the flight to
+        path = self.init_data.get("flight_record")
+        if path is not None:
+            self.recorder = FlightRecorder(path)
+            self.call_later(self.RECORD_FLUSH, self._flush_recorder)
+
         # register callback for messages
         self.register_cb(PixhawkUpdate, self.msg_dk_update)
         self.register_cb(PixhawkUpdateRequest, self.msg_update_req)
+        self.register_cb(DronekitFastLane, self.msg_dk_fast_lane)
 
         # tell the main actor system it's time to start dronekit
         self.send(self.init_data["actor_system"],
@@ -73,69 +196,246 @@ class Pixhawk(CoActor):
 
     async def msg_shutdown(self, msg, sender):
         print("[PIX] Shutdown")
+        print("[PIX] Command latency:")
+        print(self.latency.report())
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def _flush_recorder(self):
+        if self.recorder is not None:
+            self.recorder.flush()
+            self.call_later(self.RECORD_FLUSH, self._flush_recorder)
+
+    async def msg_dk_traced(self, msg, sender):
+        trace = msg.finished
+        # the stats are up to the command going out, nothing after
+        if not trace.stamps or trace.stamps[-1][0] != "MAVLink sent":
+            print("[PIX] Ignoring unfinished trace: {}".format(trace))
+            return
+        self.latency.record(trace, msg.priority+" ")
+
+    def msg_dk_fast_lane(self, msg, sender):
+        self.dk_fast_addr = sender
+
+    async def msg_latency_req(self, msg, sender):
+        self.send(sender, LatencyReport(self.latency))
 
     async def msg_dk_update(self, msg, sender):
-        # save the value in ourselves
-        self.attrs[msg.attr_name] = msg.value
-
-        # and broadcast the value to the actors who want it
-        for updatee in self.updatees:
-            self.send(updatee, msg)
+        if self.recorder is not None:
+            self.recorder.update(msg)
+        if msg.attr_name is None:
+            # it's a bulk attribute update
+            updates = msg.value
+        else:
+            updates = {msg.attr_name: msg.value}
+
+        now = time.monotonic()
+        for attr_name, value in updates.items():
+            # save the (still packed) value in ourselves
+            seq = self.store.update(attr_name, value)
+
+            # and hand it to the subscriptions that want it
+            subs = self._sub_index.get(attr_name)
+            if subs is None:
+                subs = self._index_attr(attr_name)
+            for sub, period in subs:
+                if period is None or \
+                        now-sub.last_sent.get(attr_name, -1e9) >= period:
+                    # anything older that was held back goes with it,
+                    # or is replaced by it
+                    held = sub.pending.pop(attr_name, None)
+                    if held is not None:
+                        if attr_name in telemetry.MERGED:
+                            telemetry.merge(sub.outbox, attr_name, held)
+                        if not sub.pending:
+                            if sub.timer is not None:
+                                sub.timer.cancel()
+                            sub.timer = None
+                            sub.pending_seq = None
+                    telemetry.merge(sub.outbox, attr_name, value)
+                    sub.last_sent[attr_name] = now
+                else:
+                    # too soon, keep the latest until it's allowed
+                    if not sub.pending:
+                        sub.pending_seq = seq
+                    telemetry.merge(sub.pending, attr_name, value)
+                    if sub.timer is None:
+                        sub.timer = self.call_later(
+                            period-(now-sub.last_sent[attr_name]),
+                            curry(self._send_pending, sub))
+
+        for sub in self.subscriptions:
+            if sub.outbox:
+                self._send_outbox(sub)
+
+    def _index_attr(self, attr_name):
+        # work out which subscriptions want an attribute, and remember it
+        subs = [(sub, sub.period(attr_name)) for sub in self.subscriptions
+            if sub.wants(attr_name)]
+        self._sub_index[attr_name] = subs
+        return subs
+
+    def _send_outbox(self, sub):
+        # it's caught up to the latest change, except for
+        # whatever's still held back
+        if sub.pending:
+            seq = sub.pending_seq-1
+        else:
+            seq = self.store.seq
+        if len(sub.outbox) == 1:
+            (attr_name, value), = sub.outbox.items()
+            self._send_update(sub, PixhawkUpdate(attr_name, value, seq))
+        else:
+            self._send_update(sub, PixhawkUpdate(None, sub.outbox, seq))
+        sub.outbox = {}
+
+    def _send_update(self, sub, msg):
+        # everything for a subscription goes out the same way,
+        # so it arrives in order
+        if sub.batch:
+            self.send_batched(sub.addr, msg)
+        else:
+            self.send(sub.addr, msg)
+
+    def _send_pending(self, sub):
+        # send the held back updates that are allowed now
+        sub.timer = None
+        now = time.monotonic()
+        pending = sub.pending
+        sub.pending = {}
+        wait = None
+        for attr_name, value in pending.items():
+            left = sub.period(attr_name)-(now-sub.last_sent[attr_name])
+            if left > 0:
+                sub.pending[attr_name] = value
+                wait = left if wait is None else min(wait, left)
+            else:
+                sub.outbox[attr_name] = value
+                sub.last_sent[attr_name] = now
+        if sub.outbox:
+            self._send_outbox(sub)
+        if wait is not None:
+            sub.timer = self.call_later(wait, curry(self._send_pending, sub))
 
     async def msg_update_req(self, msg, sender):
+        # drop its old subscription, if any
+        for sub in self.subscriptions:
+            if sub.addr == sender:
+                self.subscriptions.remove(sub)
+                if sub.timer is not None:
+                    sub.timer.cancel()
+                if sub.batch and not msg.batch:
+                    # don't let what's sent now overtake its batched updates
+                    self.flush_batches()
+                break
         if msg.enable:
-            self.updatees.append(sender)
+            sub = PixhawkSubscription(sender, msg.attrs, msg.max_rate,
+                msg.rates, msg.batch)
+            self.subscriptions.append(sub)
             # send the current parameters to ensure the new updatee
-            # has all of them
-            self.send(sender, PixhawkUpdate(None, self.attrs))
+            # has all of them. if it had them before, it only needs
+            # what changed since
+            store = self.store
+            since = msg.since
+            if since is not None and since[0] == store.epoch and \
+                    since[1] <= store.seq:
+                values = store.since(since[1], sub.wants)
+            else:
+                values = store.snapshot(sub.wants)
+            # behind any updates still batched up for it from before
+            self._send_update(sub, PixhawkUpdate(None, values, store.seq,
+                store.epoch))
+        self._sub_index = {}
+
+    # commands that take the fast lane to the vehicle, so they don't
+    # wait behind other commands. stop_now is a mode change
+    URGENT_CMDS = ("mode",)
+
+    def msg_proxy_cmd(self, msg, sender):
+        make = self._proxy_cmds.get(msg.cmd)
+        if make is None:
+            print("[PIX] Unknown command: {}".format(msg.cmd))
+            if msg.cid is not None:
+                self.send(sender, PixhawkCommandAck(msg.cid, CMD_REJECTED))
+            return
+
+        # time every command on its way out, not just the traced ones
+        trace = msg.trace
+        if trace is None:
+            trace = LatencyTrace("Pixhawk")
+
+        if msg.cmd in self.URGENT_CMDS and self.dk_fast_addr is not None:
+            self._urgent_sent += 1
+            out = make(msg, trace, 0)
+            addr = self.dk_fast_addr
         else:
-            if sender in self.updatees:
-                self.updatees.remove(sender)
-
-    async def msg_proxy_cmd(self, msg, sender):
-        cmd = msg.cmd
-        if cmd == "arm":
-            # flip armed to the specified value
-            self.send(self.dk_addr,
-                DronekitSetAttr('armed', msg.args[0]))
-        elif cmd == "mode":
-            # set mode to the specified value,
-            # after converting it into that weird VehicleMode
-            self.send(self.dk_addr,
-                DronekitSetAttr('mode', VehicleMode(msg.args[0])))
-        elif cmd == "takeoff":
-            # send TAKEOFF command and get drone to specified altitude
-            altitude = float(msg.args[0])
-            mcmd = (0, 0, mavutil.mavlink.MAV_CMD_NAV_TAKEOFF,
-                    0, 0, 0, 0, 0, 0, 0, altitude)
-            self.send(self.dk_addr,
-                DronekitSendCommand("command_long", *mcmd))
-        elif cmd == "heading":
-            # send YAW command to change the heading
-            # we always use it in non-relative
-            mcmd = (0, 0,    # target system, target component
-                    mavutil.mavlink.MAV_CMD_CONDITION_YAW, #command
-                    0, #confirmation
-                    msg.args[0],    # param 1, yaw in degrees
-                    0,          # param 2, yaw speed deg/s
-                    1,          # param 3, direction -1 ccw, 1 cw
-                    0, # param 4, relative offset 1, absolute angle 0
-                    0, 0, 0)
-            self.send(self.dk_addr,
-                DronekitSendCommand("command_long", *mcmd))
-        elif cmd == "move_local":
-            # send position command in NED space
-            # relative to current position
-            mcmd = (0,       # time_boot_ms (not used)
-                0, 0,    # target system, target component
-                msg.args[3], # frame
-                0b0000111111111000, # type_mask (only positions enabled)
-                msg.args[0], msg.args[1], msg.args[2],
-                0, 0, 0, # x, y, z velocity in m/s  (not used)
-                0, 0, 0, # x, y, z acceleration (not supported yet, ignored in GCS_Mavlink)
-                0, 0)    # yaw, yaw_rate (not supported yet, ignored in GCS_Mavlink)
-            self.send(self.dk_addr,
-                DronekitSendCommand("set_position_target_local_ned", *mcmd))
+            # it mustn't overtake the urgent commands sent before it
+            out = make(msg, trace, self._urgent_sent)
+            addr = self.dk_addr
+        if msg.cid is not None:
+            # the sender's ids might clash with another's, so use our own
+            out.cid = next(self._cids)
+            out.timeout = msg.timeout
+            self._acks[out.cid] = (sender, msg.cid)
+        self.send(addr, out)
+        if self.recorder is not None:
+            self.recorder.command(msg)
+
+    def msg_dk_ack(self, msg, sender):
+        waiting = self._acks.pop(msg.cid, None)
+        if waiting is not None:
+            addr, cid = waiting
+            self.send(addr, PixhawkCommandAck(cid, msg.result))
+
+    # the rest of these turn a PixhawkProxyCommand into the
+    # message for Dronekit
+    def _cmd_arm(self, msg, trace, after):
+        # flip armed to the specified value
+        return DronekitSetAttr('armed', msg.args[0], trace=trace,
+            after=after)
+
+    def _cmd_mode(self, msg, trace, after):
+        # set mode to the specified value,
+        # after converting it into that weird VehicleMode
+        return DronekitSetAttr('mode', VehicleMode(msg.args[0]),
+            trace=trace, after=after)
+
+    def _cmd_takeoff(self, msg, trace, after):
+        # send TAKEOFF command and get drone to specified altitude
+        altitude = float(msg.args[0])
+        mcmd = (0, 0, mavutil.mavlink.MAV_CMD_NAV_TAKEOFF,
+                0, 0, 0, 0, 0, 0, 0, altitude)
+        return DronekitSendCommand("command_long", *mcmd, trace=trace,
+            after=after)
+
+    def _cmd_heading(self, msg, trace, after):
+        # send YAW command to change the heading
+        # we always use it in non-relative
+        mcmd = (0, 0,    # target system, target component
+                mavutil.mavlink.MAV_CMD_CONDITION_YAW, #command
+                0, #confirmation
+                msg.args[0],    # param 1, yaw in degrees
+                0,          # param 2, yaw speed deg/s
+                1,          # param 3, direction -1 ccw, 1 cw
+                0, # param 4, relative offset 1, absolute angle 0
+                0, 0, 0)
+        return DronekitSendCommand("command_long", *mcmd, trace=trace,
+            after=after)
+
+    def _cmd_move_local(self, msg, trace, after):
+        # send position command in NED space
+        # relative to current position
+        mcmd = (0,       # time_boot_ms (not used)
+            0, 0,    # target system, target component
+            msg.args[3], # frame
+            0b0000111111111000, # type_mask (only positions enabled)
+            msg.args[0], msg.args[1], msg.args[2],
+            0, 0, 0, # x, y, z velocity in m/s  (not used)
+            0, 0, 0, # x, y, z acceleration (not supported yet, ignored in GCS_Mavlink)
+            0, 0)    # yaw, yaw_rate (not supported yet, ignored in GCS_Mavlink)
+        return DronekitSendCommand("set_position_target_local_ned", *mcmd,
+            trace=trace, after=after)
 
 # proxy for the vehicle
 # receives PixhawkUpdates to update its parameters
@@ -150,16 +450,34 @@ class VehicleProxy:
     when you get them from the proxy, but not when passed as strings
     to function names!
 
+    Values are the light copies in telemetry.py rather than dronekit's
+    own objects, but have the same attribute names, e.g.
+    p.location_local_frame.north or p.attitude.yaw.
+
     To use:
     * Instantiate the proxy: p = VehicleProxy(self, self.pixhawk_addr)
       where pixhawk_addr is the address of the Pixhawk actor and self
       is the actor that will own the proxy
     * Enable update messages from the Pixhawk actor by sending
-      it the message PixhawkUpdateRequest(True)
+      it the message PixhawkUpdateRequest(True), or with
+      p.request_updates(), which only asks for what it missed if it
+      had updates before
     * Call p.process_update(msg, sender) with the msg and sender of all
       PixhawkUpdate messages received
+    * Call p.process_ack(msg, sender) with the msg and sender of all
+      PixhawkCommandAck messages received
+
+    Commands return a Future of what the vehicle made of them: CMD_ACCEPTED
+    or CMD_REJECTED when it answers, CMD_TIMEOUT if it doesn't in
+    Dronekit.ACK_TIMEOUT seconds, or CMD_SENT for the ones MAVLink doesn't
+    answer, like position targets. Awaiting it is optional.
     """
 
+    # Dronekit times the commands out, this is how much longer the proxy
+    # waits for that before giving up itself, in case the answer never
+    # makes it back, in seconds
+    ACK_MARGIN = 1.0
+
     def __init__(self, actor, pixhawk_addr):
         """Initialize the proxy.
 
@@ -170,6 +488,16 @@ class VehicleProxy:
         self.pixhawk_addr = pixhawk_addr
         self._callbacks = []
         self._attr_updated = {}
+        # proxy attribute name -> (attribute name, packed value) of the
+        # updates that haven't been read yet, see __getattr__
+        self._packed = {}
+        # where we're caught up to in Pixhawk's attribute store
+        self._epoch = None
+        self._seq = None
+        # cid -> (Future, timeout timer) of the commands
+        # waiting for an answer
+        self._acks = {}
+        self._cids = itertools.count(1)
 
     async def process_update(self, msg, sender):
         """Process an update message.
@@ -178,6 +506,11 @@ class VehicleProxy:
         PixhawkUpdate message the proxy owner receives.
         """
 
+        if msg.epoch is not None:
+            self._epoch = msg.epoch
+        if msg.seq is not None:
+            self._seq = msg.seq
+
         if msg.attr_name == None and isinstance(msg.value, dict):
             # it's a bulk attribute update
             for attr, value in msg.value.items():
@@ -186,19 +519,98 @@ class VehicleProxy:
             # just one
             self._update_attr(msg.attr_name, msg.value)
 
+    def request_updates(self, **kwargs):
+        """Ask the Pixhawk actor for attribute updates.
+
+        If the proxy had updates from it before, only the attributes that
+        changed since then are sent, instead of all of them.
+
+        kwargs: the other arguments for PixhawkUpdateRequest,
+          like attrs or max_rate
+        """
+
+        since = None
+        if self._epoch is not None and self._seq is not None:
+            since = (self._epoch, self._seq)
+        self.actor.send(self.pixhawk_addr,
+            PixhawkUpdateRequest(since=since, batch=True, **kwargs))
+
+    def process_ack(self, msg, sender):
+        """Process a command ack message.
+
+        Call this function with the msg and sender for every
+        PixhawkCommandAck message the proxy owner receives.
+        """
+
+        waiting = self._acks.pop(msg.cid, None)
+        if waiting is None:
+            # it timed out already
+            return
+        fut, timer = waiting
+        timer.cancel()
+        fut.set_result(msg.result)
+
+    def command(self, cmd, *args, trace=None, timeout=None):
+        """Send a command to the Pixhawk actor.
+
+        cmd, *args: the PixhawkProxyCommand
+        trace: the LatencyTrace to send with it, if any
+        timeout: how long to wait for the vehicle to answer, in seconds,
+          if not Dronekit.ACK_TIMEOUT
+
+        returns: a Future of the result, see the class docstring
+        """
+
+        if timeout is None:
+            timeout = Dronekit.ACK_TIMEOUT
+        cid = next(self._cids)
+        fut = Future(self.actor)
+        timer = self.actor.call_later(timeout+self.ACK_MARGIN,
+            curry(self._ack_timeout, cid))
+        self._acks[cid] = (fut, timer)
+        self.actor.send(self.pixhawk_addr, PixhawkProxyCommand(cmd, *args,
+            trace=trace, cid=cid, timeout=timeout))
+        return fut
+
+    def _ack_timeout(self, cid):
+        waiting = self._acks.pop(cid, None)
+        if waiting is not None:
+            waiting[0].set_result(CMD_TIMEOUT)
+
     def _update_attr(self, attr, value):
         # update the parameter in question
-        setattr(self, attr.replace(".", "_"), value)
+        name = attr.replace(".", "_")
+        if attr in telemetry.MERGED:
+            # it's just what changed
+            if isinstance(value, telemetry.Encoded):
+                value = value.decode()
+            merged = getattr(self, name, None) or {}
+            merged.update(value)
+            self.__dict__[name] = merged
+        else:
+            # it's unpacked when it's read, so the ones nobody
+            # looks at cost nothing
+            self.__dict__.pop(name, None)
+            self._packed[name] = (attr, value)
         self._attr_updated[attr] = True
         # and call any callbacks
         cb = []
         for attr_name, fn, once in self._callbacks:
             if attr_name == attr:
-                self.actor.call_soon(curry(fn, attr, value))
+                self.actor.call_soon(curry(fn, attr, getattr(self, name)))
                 if once: continue
             cb.append((attr_name, fn, once))
         self._callbacks = cb
 
+    def __getattr__(self, name):
+        # only called when name isn't set yet, so unpack its update
+        packed = self.__dict__.get("_packed", {}).pop(name, None)
+        if packed is None:
+            raise AttributeError(name)
+        value = telemetry.decode(*packed)
+        self.__dict__[name] = value
+        return value
+
     def register_cb(self, attr_name, fn, once=False):
         """Register a callback for attribute changes.
 
@@ -219,7 +631,7 @@ class VehicleProxy:
 
     async def wait_ready_ekf(self):
         await self.wait_for('ekf_ok')
-        await self.wait_for('location_local_frame')
+        await self.wait_for('location.local_frame')
 
     async def wait_for(self, attr):
         """Wait for the specified attribute to be valid, i.e. it has
@@ -253,10 +665,17 @@ class VehicleProxy:
 
         # register callback so that hwen the future is updated
         # its result is set
-        self.register_cb(attr, lambda a, v: fut.set_result(v), once=True)
+        cb = lambda a, v: fut.set_result(v)
+        self.register_cb(attr, cb, once=True)
 
         # then wait on the future (and return the value which is its result)
-        return await fut
+        try:
+            return await fut
+        except BaseException:
+            # we were cancelled, e.g. by wait_for timing out, so the
+            # callback is still there. take it out
+            self._callbacks = [c for c in self._callbacks if c[1] is not cb]
+            raise
 
     async def wait_for_new(self, attr):
         """Wait for the specified attribute to have a new value.
@@ -267,7 +686,7 @@ class VehicleProxy:
         """
 
         # check if it exists
-        if self._attr_updated.get(attr, False):
+        if not self._attr_updated.get(attr, False):
             # it doesn't, so just wait until it does
             return await self.wait_for_next(attr)
 
@@ -307,36 +726,58 @@ class VehicleProxy:
         return value
 
     async def arm_motors(self, arm):
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("arm", arm))
+        """Arm or disarm the motors and wait until they are.
+
+        returns: the command's result. If it's CMD_REJECTED, it returns
+          right away without waiting.
+        """
+
+        result = await self.command("arm", arm)
+        if result == CMD_REJECTED:
+            return result
 
         await self.wait_until('armed', lambda v: v == arm)
+        return result
 
-    def set_mode(self, mode):
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("mode", mode))
+    def set_mode(self, mode, trace=None):
+        return self.command("mode", mode, trace=trace)
 
     async def takeoff(self, altitude):
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("takeoff", altitude))
+        """Take off and wait until we're at the altitude.
+
+        returns: the command's result. If it's CMD_REJECTED, it returns
+          right away without waiting.
+        """
+
+        result = await self.command("takeoff", altitude)
+        if result == CMD_REJECTED:
+            return result
 
         curr_alt = self.location_global_relative_frame.alt
         if curr_alt < 0.01: curr_alt = 0.01
         while abs((curr_alt-altitude)/altitude) > 0.05:
             await self.wait_for_next("location.global_relative_frame")
             curr_alt = self.location_global_relative_frame.alt
+        return result
+
+    def stop_now(self, trace=None):
+        """Stop the vehicle right now.
+
+        trace: if not None, the LatencyTrace of whatever caused the stop.
+          It follows the command to the Pixhawk actor, which keeps
+          latency stats on it.
+        """
 
-    def stop_now(self):
         # we stop by BRAKEing
-        self.set_mode("BRAKE")
+        if trace is not None:
+            trace.stamp("stop_now")
+        return self.set_mode("BRAKE", trace)
 
     def set_heading(self, heading):
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("heading", heading))
+        return self.command("heading", heading)
 
     def move_rel_body(self, forward, right, down):
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("move_ned_body_offset", forward, right, down))
+        return self.command("move_ned_body_offset", forward, right, down)
 
     def goto_local(self, north, east, down):
         """Go to the specified north, east, down position,
@@ -348,9 +789,8 @@ class VehicleProxy:
           (north, east, down)
         """
 
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("move_local", north, east, down,
-                mavutil.mavlink.MAV_FRAME_LOCAL_NED))
+        self.command("move_local", north, east, down,
+            mavutil.mavlink.MAV_FRAME_LOCAL_NED)
 
         return (north, east, down)
 
@@ -364,9 +804,8 @@ class VehicleProxy:
           (north, east, down)
         """
 
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("move_local", north, east, down,
-                mavutil.mavlink.MAV_FRAME_LOCAL_OFFSET_NED))
+        self.command("move_local", north, east, down,
+            mavutil.mavlink.MAV_FRAME_LOCAL_OFFSET_NED)
 
         pos = self.location_local_frame
         return (pos.north+north,
@@ -383,9 +822,8 @@ class VehicleProxy:
             (north, east, down)
         """
 
-        self.actor.send(self.pixhawk_addr,
-            PixhawkProxyCommand("move_local", forward, right, down,
-                mavutil.mavlink.MAV_FRAME_BODY_OFFSET_NED))
+        self.command("move_local", forward, right, down,
+            mavutil.mavlink.MAV_FRAME_BODY_OFFSET_NED)
 
         pos = self.location_local_frame
         yaw = self.attitude.yaw
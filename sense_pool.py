@@ -0,0 +1,246 @@
+# multi-process depth processing for the sensor
+# frames are shared with the workers through shared memory,
+# only small task and result tuples go through the queues
+
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import queue
+import traceback
+import numpy as np
+
+from sense_template import SensorController
+
+# pool modes
+POOL_FRAMES = "frames" # each worker processes whole frames
+POOL_TILES = "tiles" # each frame is split into bands of grid rows
+
+def _worker(shm_name, shape, depth_scale, controller_args, tasks, results):
+    # attach to the ring the parent made
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ring = None
+    try:
+        ring = np.ndarray(shape, dtype=np.uint16, buffer=shm.buf)
+        controller = SensorController(**controller_args)
+        meters = np.zeros(shape[1:], dtype=np.float32)
+        scale = np.float32(depth_scale)
+
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            seq, slot, first, last = task
+            try:
+                # only convert the image rows this task looks at
+                start, stop = controller.gridPixelRows(shape[1:], first, last)
+                np.multiply(ring[slot, start:stop], scale,
+                    out=meters[start:stop], dtype=np.float32)
+                grid = controller.gridReduce(meters, first, last)
+            except Exception:
+                traceback.print_exc()
+                grid = None
+            results.put((seq, first, grid))
+    finally:
+        del ring
+        shm.close()
+
+class SensorPool:
+    """Reduces depth frames to obstacle grids on several processes.
+
+    Frames are copied into a ring of shared memory slots and the workers
+    read them from there, so the pixels are never pickled. In POOL_FRAMES
+    mode each frame goes to one worker; in POOL_TILES mode every worker
+    gets a band of grid rows from each frame. Either way, finished grids
+    come back out in the order the frames went in.
+
+    * Instantiate with pool = SensorPool(width, height, depth_scale)
+    * Start the workers with pool.start()
+    * Hand it frames with pool.submit(depth, timestamp)
+    * Get finished frames with pool.poll()
+    * Get the rest once there are no more frames with pool.drain()
+    * Stop the workers with pool.close()
+    """
+
+    # while waiting for a result, how often to check the workers are
+    # still alive, in seconds
+    CHECK_EVERY = 1.0
+
+    def __init__(self, width, height, depth_scale, workers=None,
+            mode=POOL_FRAMES, slots=None, controller_args=None):
+        """Initialize the pool.
+
+        width, height: size of the depth frames
+        depth_scale: meters per depth unit, from get_depth_scale()
+        workers: number of worker processes. If None, one per CPU.
+        mode: POOL_FRAMES or POOL_TILES
+        slots: number of frames that can be in flight at once. If None,
+          two per worker. submit() waits when they're all busy.
+        controller_args: keyword arguments for each worker's
+          SensorController
+        """
+
+        if mode not in (POOL_FRAMES, POOL_TILES):
+            raise ValueError("unknown pool mode: {}".format(mode))
+
+        self.workers = workers or mp.cpu_count()
+        self.mode = mode
+        self.slots = slots or 2*self.workers
+        self.shape = (self.slots, height, width)
+        self.depth_scale = depth_scale
+        self.controller_args = controller_args or {}
+
+        # how each frame is split into tasks, as (first, last) grid rows
+        rows = SensorController(**self.controller_args).rows
+        if mode == POOL_FRAMES:
+            self.bands = [(0, rows)]
+        else:
+            bands = np.array_split(np.arange(rows), min(self.workers, rows))
+            self.bands = [(int(b[0]), int(b[-1])+1) for b in bands]
+        self._band_index = {b[0]: i for i, b in enumerate(self.bands)}
+
+        self._shm = None
+        self._procs = []
+        self._seq = 0
+        self._next_out = 0
+        # seq -> [slot, timestamp, grid, parts left]
+        self._pending = {}
+        self._slot_busy = [False]*self.slots
+
+    def start(self):
+        nbytes = int(np.prod(self.shape))*2
+        self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        self.ring = np.ndarray(self.shape, dtype=np.uint16,
+            buffer=self._shm.buf)
+
+        self._tasks = mp.Queue()
+        self._results = mp.Queue()
+        for i in range(self.workers):
+            p = mp.Process(target=_worker, daemon=True,
+                args=(self._shm.name, self.shape, self.depth_scale,
+                    self.controller_args, self._tasks, self._results))
+            p.start()
+            self._procs.append(p)
+
+    def submit(self, depth, timestamp=None):
+        """Hand a frame to the workers.
+
+        depth: an rs.depth_frame or a (height, width) uint16 array
+        timestamp: anything to pass back out with the result,
+          e.g. the frame's timestamp
+
+        returns: the frame's sequence number
+        """
+
+        seq = self._seq
+        slot = seq % self.slots
+        # wait for the slot's previous frame to be finished with
+        while self._slot_busy[slot]:
+            self._collect(True)
+
+        if hasattr(depth, "get_data"):
+            depth = depth.get_data()
+        np.copyto(self.ring[slot], np.asanyarray(depth))
+        self._slot_busy[slot] = True
+
+        self._pending[seq] = [slot, timestamp, None, len(self.bands)]
+        for first, last in self.bands:
+            self._tasks.put((seq, slot, first, last))
+
+        self._seq += 1
+        return seq
+
+    @property
+    def in_flight(self):
+        """Number of frames submitted but not yet returned by poll()."""
+
+        return len(self._pending)
+
+    def _collect(self, block):
+        # get one result from the workers and file it away
+        # returns False if there wasn't one
+        while True:
+            try:
+                seq, first, grid = self._results.get(block, self.CHECK_EVERY)
+                break
+            except queue.Empty:
+                if not block:
+                    return False
+            # a dead worker's tasks never come back, so don't wait forever
+            for p in self._procs:
+                if not p.is_alive():
+                    raise RuntimeError("sensor worker {} died with exit "
+                        "code {}".format(p.pid, p.exitcode))
+        if grid is None:
+            raise RuntimeError("sensor worker failed on frame {}".format(seq))
+
+        p = self._pending[seq]
+        if len(self.bands) == 1:
+            p[2] = grid
+        else:
+            if p[2] is None:
+                p[2] = [None]*len(self.bands)
+            p[2][self._band_index[first]] = grid
+        p[3] -= 1
+        if p[3] == 0:
+            # every part is in, so the slot can be reused
+            self._slot_busy[p[0]] = False
+            if len(self.bands) > 1:
+                p[2] = np.concatenate(p[2])
+        return True
+
+    def poll(self, block=False):
+        """Get the frames that are finished, in the order they were submitted.
+
+        block: if True, wait until at least one frame is finished
+          (as long as any are in flight)
+
+        returns: a list of (seq, timestamp, grid)
+        """
+
+        while self._collect(False):
+            pass
+
+        done = []
+        while True:
+            while self._next_out in self._pending and \
+                    self._pending[self._next_out][3] == 0:
+                slot, timestamp, grid, left = \
+                    self._pending.pop(self._next_out)
+                done.append((self._next_out, timestamp, grid))
+                self._next_out += 1
+            if done or not block or not self._pending:
+                return done
+            self._collect(True)
+
+    def drain(self):
+        """Wait for every frame in flight to finish.
+
+        returns: a list of (seq, timestamp, grid), like poll()
+        """
+
+        done = []
+        while self._pending:
+            done += self.poll(True)
+        return done
+
+    def close(self):
+        for p in self._procs:
+            self._tasks.put(None)
+        for p in self._procs:
+            p.join(self.CHECK_EVERY)
+            if p.is_alive():
+                # stuck, so it won't be missed
+                p.terminate()
+                p.join()
+        self._procs = []
+        if self._shm is not None:
+            del self.ring
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -2,75 +2,722 @@
 ## Sensor Controller   ##
 #########################
 
-import pyrealsense2 as rs
 import sys
+import math
+import threading
 import numpy as np
 
-from nav import DroneInDanger
+from nav import DroneInDanger, ObstacleSummary, VehicleYaw
+from depth_replay import DepthRecorder, ReplayFinished
+from latency import LatencyTrace
+from voxel import DepthProjector, VoxelMap
 import time
 
+try:
+    import pyrealsense2 as rs
+except ImportError:
+    # no camera support, but recordings can still be replayed
+    rs = None
+
+# size of the depth image the camera is configured for
+DEPTH_WIDTH = 640
+DEPTH_HEIGHT = 480
+# horizontal field of view of the depth camera, in degrees
+DEPTH_HFOV = 87.0
+# bearings the voxel map's clearance is sent for, relative to the nose
+FAN_BEARINGS = list(range(-180, 180, 10))
+# how old the yaw from the navigation can get before the voxel map
+# stops trusting it, in seconds
+YAW_MAX_AGE = 0.5
+
+def get_depth_scale(profile):
+    """Get the number of meters per depth unit for a started pipeline.
+
+    profile: the rs.pipeline_profile returned by pipeline.start(),
+      or the DepthReplay a recording is played back from
+    """
+
+    if hasattr(profile, "depth_scale"):
+        return profile.depth_scale
+    return profile.get_device().first_depth_sensor().get_depth_scale()
+
+def get_projector(profile, width, height, stride=4):
+    """Get a DepthProjector for a started pipeline.
+
+    profile: the rs.pipeline_profile returned by pipeline.start(). If it's
+      something else, like a DepthReplay, the camera is assumed to be an
+      ideal one with DEPTH_HFOV.
+    width, height: size of the depth frames
+    stride: passed to the DepthProjector
+    """
+
+    if rs is not None and hasattr(profile, "get_stream"):
+        intrinsics = profile.get_stream(rs.stream.depth) \
+            .as_video_stream_profile().get_intrinsics()
+        return DepthProjector.from_intrinsics(intrinsics, stride)
+    return DepthProjector.from_fov(width, height, DEPTH_HFOV, stride)
+
+def depth_to_meters(depth, depth_scale, out=None):
+    """Convert a depth frame into a float32 array of distances in meters.
+
+    The frame's buffer is wrapped as a uint16 array without copying it,
+    then scaled to meters in one vectorized step. Invalid pixels stay 0.
+
+    depth: the rs.depth_frame (or anything with get_data() returning
+      a buffer of z16 depth units)
+    depth_scale: meters per depth unit, from get_depth_scale()
+    out: if not None, a float32 array of the frame's shape to write the
+      result into, so a new one isn't allocated every frame
+
+    returns: the (height, width) array of distances in meters
+    """
+
+    # zero-copy view of the frame's buffer. it's only valid while the
+    # frame is alive, so it's scaled into our own array right away
+    raw = np.asanyarray(depth.get_data())
+    return np.multiply(raw, np.float32(depth_scale), out=out,
+        dtype=np.float32)
+
+# per-cell statistics the grid engine can reduce with
+GRID_MIN = "min"
+GRID_PERCENTILE = "percentile"
+GRID_COUNT = "count"
+
 class SensorController:
+    """Reduces depth images into a coarse grid of obstacle distances.
+
+    The image (or a cropped region of it) is split into rows x cols cells
+    and each cell is reduced to one number with a vectorized statistic.
+    Invalid (zero) depth pixels are ignored.
+    """
+
+    def __init__(self, rows=5, cols=5, crop=0, stat=GRID_MIN,
+            percentile=5.0, threshold=1.0, stride=1, hfov=DEPTH_HFOV,
+            alpha=0.4, beta=0.1, gate=1.0, min_closing=0.2):
+        """Initialize the controller.
+
+        rows, cols: size of the grid
+        crop: how much of the image border to throw away, see cropSubset.
+          0 uses the whole image.
+        stat: how each cell is reduced.
+          GRID_MIN: the closest valid distance in the cell
+          GRID_PERCENTILE: the given percentile of the valid distances,
+            which ignores a few noisy pixels but still sees thin obstacles
+          GRID_COUNT: the number of valid pixels closer than threshold
+        percentile: the percentile used by GRID_PERCENTILE, 0-100
+        threshold: distance in meters used by GRID_COUNT
+        stride: only use every stride'th pixel in each direction
+        hfov: horizontal field of view of the whole image, in degrees
+        alpha, beta: gains of the tracker's alpha-beta filter, see trackUpdate
+        gate: distance in meters a cell can jump between frames before
+          the tracker decides it's seeing something new and starts over
+        min_closing: closing speed in m/s under which an obstacle is
+          considered to not be getting closer at all
+        """
+
+        if stat not in (GRID_MIN, GRID_PERCENTILE, GRID_COUNT):
+            raise ValueError("unknown grid statistic: {}".format(stat))
+
+        self.rows = rows
+        self.cols = cols
+        self.crop = crop
+        self.stat = stat
+        self.percentile = percentile
+        self.threshold = threshold
+        self.stride = stride
+        self.hfov = hfov
+        self.alpha = alpha
+        self.beta = beta
+        self.gate = gate
+        self.min_closing = min_closing
+
+        # scratch buffer for the sort keys gridReduce makes
+        self._work = None
+
+        # tracker state, per grid cell
+        self.trackDist = None # filtered distance, meters
+        self.trackSpeed = None # closing speed, m/s, positive is closer
+        self._trackStamp = None
+
     def cropSubset(self, data, width):
+        """Crop the border off an image.
+
+        data: the image, indexed [y, x]
+        width: how much to crop, in fifths of the image. width/10 of the
+          height and width is removed from each side, so 0 keeps the
+          whole image and 4 keeps the central fifth.
+
+        returns: a view of the cropped image
+        """
+
         c=width
         x=data.shape[0]
         y=data.shape[1]
-        cx=c*(x/5)/2
+        cx=int(c*(x/5)/2)
         dx=x-cx
-        cy=c*(y/5)/2
+        cy=int(c*(y/5)/2)
         dy=y-cy
-        data=data[cx:dx,cy:dy]
-
-    def filterSuperPix(self, dataD, depthDataraw, layer):  #Needs more work!!
-        for y in range(0,dataD.shape[1],1):
-            for x in range(0,dataD.shape[0],1):
-                dataD[x, y] = depthDataraw.get_distance(x, y)
-        npDepth1 = dataD.reshape(2,(dataD.shape[1]*dataD.shape[0]/2)).mean(0)
-        npDepth2 = npDepth1.reshape((dataD.shape[1]*dataD.shape[0]/2/2),2).mean(1)
-        npDepth3 = npDepth2.reshape(5,5)       
-
-def main(asys, nav):
-    asys.tell(nav, DroneInDanger(False))
+        return data[cx:dx,cy:dy]
+
+    def gridCells(self, depthData, first=0, last=None):
+        """Get the region of interest split into cells.
+
+        depthData: the image in meters, indexed [y, x]
+        first, last: only return grid rows first up to (not including)
+          last. If last is None, go to the bottom of the grid.
+
+        returns: a (rows, cell height, cols, cell width) view of the region.
+          Leftover pixels that don't fill a whole cell are trimmed evenly
+          from the edges.
+        """
+
+        data = np.asarray(depthData, dtype=np.float32)
+        data = self.cropSubset(data, self.crop)
+        data = data[::self.stride, ::self.stride]
+        ch = data.shape[0]//self.rows
+        cw = data.shape[1]//self.cols
+        if ch == 0 or cw == 0:
+            raise ValueError("{}x{} grid doesn't fit in a {}x{} image".format(
+                self.rows, self.cols, data.shape[0], data.shape[1]))
+        oy = (data.shape[0]-ch*self.rows)//2
+        ox = (data.shape[1]-cw*self.cols)//2
+        data = data[oy:oy+ch*self.rows, ox:ox+cw*self.cols]
+        return data.reshape(self.rows, ch, self.cols, cw)[first:last]
+
+    def gridPixelRows(self, shape, first=0, last=None):
+        """Get the image rows that grid rows first up to last are made from.
+
+        shape: the (height, width) of the image
+        first, last: the grid rows, like gridCells
+
+        returns: (start, stop) such that image[start:stop] contains
+          every pixel of those grid rows
+        """
+
+        if last is None:
+            last = self.rows
+        cx = int(self.crop*(shape[0]/5)/2)
+        height = len(range(cx, shape[0]-cx, self.stride))
+        ch = height//self.rows
+        oy = (height-ch*self.rows)//2
+        start = cx+(oy+first*ch)*self.stride
+        stop = cx+(oy+last*ch)*self.stride
+        return start, stop
+
+    def gridReduce(self, depthData, first=0, last=None):
+        """Reduce a depth image to a grid of per-cell statistics.
+
+        depthData: the image in meters, indexed [y, x]
+        first, last: only reduce grid rows first up to (not including)
+          last. If last is None, go to the bottom of the grid. Only the
+          image rows from gridPixelRows() are looked at.
+
+        returns: a (rows, cols) array, or (last-first, cols) if only some
+          rows were asked for. For GRID_MIN and GRID_PERCENTILE, cells
+          without any valid pixels are inf. For GRID_COUNT, it's the
+          number of close pixels.
+        """
+
+        cells = self.gridCells(depthData, first, last)
+
+        if self.stat == GRID_COUNT:
+            # invalid pixels are 0 so they fail the first test
+            return ((cells > 0) & (cells < self.threshold)).sum(axis=(1, 3))
+
+        # non-negative floats are ordered the same as their bits are as
+        # unsigned ints. subtracting 1 from the bits wraps the invalid 0
+        # pixels around to the biggest value, so they never win a min and
+        # sort to the back. this is much faster than a masked assignment
+        if self._work is None or self._work.shape != cells.shape:
+            self._work = np.empty(cells.shape, dtype=np.uint32)
+        keys = np.subtract(cells.view(np.uint32), np.uint32(1),
+            out=self._work)
+
+        if self.stat == GRID_MIN:
+            return self._keysToMeters(keys.min(axis=(1, 3)))
+
+        # percentile of the valid pixels: invalid pixels sort to the back,
+        # so it's each cell's idx'th smallest key, idx from its valid count
+        rows = cells.shape[0]
+        flat = keys.transpose(0, 2, 1, 3).reshape(rows*self.cols, -1)
+        valid = (cells > 0).sum(axis=(1, 3)).reshape(-1)
+        idx = np.ceil(self.percentile/100*valid).astype(np.intp)-1
+        idx = np.clip(idx, 0, flat.shape[1]-1)
+        # partition every cell around the biggest idx, then only the
+        # smallest few need sorting, not the whole cell
+        k = int(idx.max())
+        if k+1 < flat.shape[1]:
+            flat = np.partition(flat, k, axis=1)[:, :k+1]
+        flat = np.sort(flat, axis=1)
+        return self._keysToMeters(
+            flat[np.arange(flat.shape[0]), idx].reshape(rows, self.cols))
+
+    def gridHfov(self):
+        """Get the horizontal field of view the grid covers, in degrees."""
+
+        # cropSubset takes width/10 off each side
+        u = 1-self.crop/5
+        half = math.radians(self.hfov/2)
+        return 2*math.degrees(math.atan(u*math.tan(half)))
+
+    def summarize(self, grid, danger, stamp):
+        """Pack a GRID_MIN or GRID_PERCENTILE grid into an ObstacleSummary.
+
+        grid: the grid from gridReduce, in meters
+        danger: whether the drone is in danger
+        stamp: the frame's time, in seconds
+
+        returns: the ObstacleSummary
+        """
+
+        nearest = np.unravel_index(np.argmin(grid), grid.shape)
+        rng = float(grid[nearest])
+        # bearing of the nearest cell's column, same as
+        # ObstacleSummary.column_bearing
+        fov = self.gridHfov()
+        u = (nearest[1]+0.5)/grid.shape[1]*2-1
+        bearing = math.degrees(math.atan(u*math.tan(math.radians(fov/2))))
+
+        mm = np.minimum(grid*1000, ObstacleSummary.NOTHING)
+        cells = mm.astype("<u2").tobytes()
+        return ObstacleSummary(danger, grid.shape[0], grid.shape[1], cells,
+            fov, bearing, nearest=rng, stamp=stamp)
+
+    def trackReset(self):
+        """Forget everything the tracker knows."""
+
+        self.trackDist = None
+        self.trackSpeed = None
+        self._trackStamp = None
+
+    def trackUpdate(self, grid, stamp):
+        """Update the per-cell obstacle tracker with a new frame.
+
+        Each cell's distance is run through an alpha-beta filter to
+        estimate how fast it's closing. Cells that jump by more than gate
+        or lose sight of everything start over with no speed.
+
+        grid: a GRID_MIN or GRID_PERCENTILE grid from gridReduce
+        stamp: the frame's time, in seconds
+
+        returns: the time to collision of each cell, in seconds.
+          It's inf for cells that aren't getting closer.
+        """
+
+        grid = np.asarray(grid, dtype=np.float32)
+        seen = np.isfinite(grid)
+
+        if self.trackDist is None or self.trackDist.shape != grid.shape or \
+                stamp <= self._trackStamp:
+            self.trackDist = grid.copy()
+            self.trackSpeed = np.zeros_like(grid)
+        else:
+            dt = np.float32(stamp-self._trackStamp)
+            # predict where everything should be, then correct
+            predicted = self.trackDist-self.trackSpeed*dt
+            with np.errstate(invalid="ignore"):
+                residual = grid-predicted
+                fresh = ~seen | ~np.isfinite(predicted) | \
+                    (np.abs(residual) > self.gate)
+            residual[fresh] = 0
+            self.trackDist = predicted+self.alpha*residual
+            self.trackSpeed = self.trackSpeed-(self.beta/dt)*residual
+            # start over on the cells that can't be tracked
+            self.trackDist[fresh] = grid[fresh]
+            self.trackSpeed[fresh] = 0
+        self._trackStamp = stamp
+
+        ttc = np.full_like(grid, np.inf)
+        closing = self.trackSpeed > self.min_closing
+        ttc[closing] = self.trackDist[closing]/self.trackSpeed[closing]
+        return ttc
+
+    @staticmethod
+    def _keysToMeters(keys):
+        # undo the key transform from gridReduce. cells with no valid
+        # pixels wrap back to 0 and are reported as infinitely far
+        meters = (keys+np.uint32(1)).view(np.float32)
+        meters[meters == 0] = np.inf
+        return meters
+
+class DangerPublisher:
+    """Turns per-frame obstacle distances into DroneInDanger messages.
+
+    Each frame is reduced to one decision. The danger state is entered
+    when the time to collision drops under enter_ttc, or the closest
+    obstacle gets nearer than enter_dist no matter how fast it's coming.
+    It's only left once the time to collision is over exit_ttc and the
+    obstacle is farther than exit_dist. A new state has to hold for
+    debounce seconds before it's believed. A message is only sent when
+    the state changes, plus a keepalive every keepalive seconds so the
+    navigation resyncs if it missed one.
+
+    If frames come with an ObstacleSummary, it's sent in place of the
+    DroneInDanger message, and also every summary_period seconds while
+    in danger so the navigation can see where to go.
+    """
+
+    def __init__(self, asys, nav, enter_dist=1.0, exit_dist=1.3,
+            enter_ttc=2.0, exit_ttc=3.0, debounce=0.1, keepalive=1.0,
+            summary_period=0.1):
+        """Initialize the publisher.
+
+        asys: the actor system to send with
+        nav: the address of the navigation actor
+        enter_dist: distance in meters under which we're in danger
+        exit_dist: distance in meters over which we're safe again.
+          Should be more than enter_dist.
+        enter_ttc: time to collision in seconds under which we're in danger
+        exit_ttc: time to collision in seconds over which we're safe again
+        debounce: seconds a new state has to hold before it's published.
+          Getting into danger uses half of this, since that's the one
+          that matters.
+        keepalive: seconds between repeats of the current state
+        summary_period: seconds between summaries while in danger
+        """
+
+        self.asys = asys
+        self.nav = nav
+        self.enter_dist = enter_dist
+        self.exit_dist = exit_dist
+        self.enter_ttc = enter_ttc
+        self.exit_ttc = exit_ttc
+        self.debounce = debounce
+        self.keepalive = keepalive
+        self.summary_period = summary_period
+
+        self.danger = False
+        # when the frames started disagreeing with self.danger
+        self._pending_since = None
+        self._last_sent = None
+
+        self.sent = 0
+        self.frames = 0
+
+    def update(self, closest, now=None, summary=None, ttc=math.inf,
+            arrival=None):
+        """Process one frame.
+
+        closest: distance in meters to the closest obstacle in the frame,
+          e.g. the min of the SensorController grid
+        ttc: the shortest time to collision in the frame, in seconds,
+          e.g. the min of SensorController.trackUpdate. If it's not given,
+          only closest is used.
+        arrival: if not None, the time.monotonic() the frame arrived at.
+          Messages sent because of the frame carry a LatencyTrace
+          starting from then.
+        now: the frame's time in seconds. If None, time.monotonic() is used.
+        summary: if not None, the frame's ObstacleSummary.
+          Its danger is filled in here.
+
+        returns: True if the danger state changed
+        """
+
+        if now is None:
+            now = time.monotonic()
+        self.frames += 1
+
+        # hysteresis: which way the frame points depends on where we are
+        if self.danger:
+            want = not bool(closest > self.exit_dist and ttc > self.exit_ttc)
+        else:
+            want = bool(closest < self.enter_dist or ttc < self.enter_ttc)
+
+        changed = False
+        if want == self.danger:
+            self._pending_since = None
+        else:
+            if self._pending_since is None:
+                self._pending_since = now
+            hold = self.debounce/2 if want else self.debounce
+            if now-self._pending_since >= hold:
+                self.danger = want
+                self._pending_since = None
+                changed = True
+
+        since = None if self._last_sent is None else now-self._last_sent
+        if changed or since is None or since >= self.keepalive or \
+                (self.danger and summary is not None and
+                    since >= self.summary_period):
+            self.publish(now, summary, arrival)
+
+        return changed
+
+    def publish(self, now=None, summary=None, arrival=None):
+        """Send the current state to the navigation right now.
+
+        now: the current time on the same clock update() is given. If None,
+          the next update() sends a keepalive to start the clock.
+        summary: if not None, an ObstacleSummary to send instead
+          of a DroneInDanger
+        arrival: if not None, the time.monotonic() the frame the message
+          is about arrived at, to start its LatencyTrace
+        """
+
+        if summary is None:
+            msg = DroneInDanger(self.danger)
+        else:
+            summary.danger = self.danger
+            msg = summary
+        if arrival is not None:
+            msg.trace = LatencyTrace("frame", arrival)
+            msg.trace.stamp("sensor sent")
+        self.asys.tell(self.nav, msg)
+        self._last_sent = now
+        self.sent += 1
+
+class LatestFrameCapture:
+    """Captures depth frames on its own thread, keeping only the newest.
+
+    If processing falls behind, older frames are thrown away instead of
+    queueing up, so the processing always works on the freshest frame.
+    With drop=False it waits for each frame to be taken instead, e.g. for
+    a replay, where every recorded frame should be processed.
+
+    * Instantiate with cap = LatestFrameCapture(pipeline), where pipeline
+      is a started rs.pipeline or anything that acts like one
+    * Start capturing with cap.start()
+    * Get the newest frame with depth = cap.get(). It waits if there
+      hasn't been a new one since the last get.
+
+    Counters:
+    * captured: frames received from the pipeline
+    * dropped: frames replaced by a newer one before they were processed
+    * processed: frames returned by get()
+    * last_age: seconds between the last frame arriving and get() returning it
+    * last_arrival: time.monotonic() the last frame from get() arrived at
+    * max_age: the largest last_age seen
+    """
+
+    def __init__(self, pipeline, drop=True, on_frame=None):
+        """Set up the capture.
+
+        pipeline: the started pipeline
+        drop: if False, wait for each frame to be taken instead of
+          replacing it with a newer one
+        on_frame: if not None, called with every frame captured, on the
+          capture thread, e.g. to record them all
+        """
+
+        self.pipeline = pipeline
+        self.drop = drop
+        self.on_frame = on_frame
+
+        self._cond = threading.Condition()
+        self._frame = None
+        self._arrived = None
+        self._error = None
+        self._running = False
+        self._thread_obj = None
+
+        self.captured = 0
+        self.dropped = 0
+        self.processed = 0
+        self.last_age = 0.0
+        self.max_age = 0.0
+        self.last_arrival = None
+
+    def start(self):
+        self._running = True
+        self._thread_obj = threading.Thread(target=self._thread, daemon=True)
+        self._thread_obj.start()
+
+    def stop(self, timeout=1.0):
+        """Stop capturing, waiting up to timeout seconds for the
+        capture thread to finish."""
+
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        if self._thread_obj is not None:
+            self._thread_obj.join(timeout)
+
+    def _thread(self):
+        try:
+            while self._running:
+                frames = self.pipeline.wait_for_frames()
+                depth = frames.get_depth_frame()
+                if not depth: continue
+                arrived = time.monotonic()
+                if self.on_frame is not None:
+                    self.on_frame(depth)
+                with self._cond:
+                    if not self.drop:
+                        # wait for the last one to be taken
+                        while self._frame is not None and self._running:
+                            self._cond.wait()
+                    if self._frame is not None:
+                        self.dropped += 1
+                    self._frame = depth
+                    self._arrived = arrived
+                    self.captured += 1
+                    self._cond.notify()
+        except Exception as e:
+            # hand it to the processing side, e.g. ReplayFinished
+            with self._cond:
+                self._error = e
+                self._cond.notify()
+
+    def get(self, timeout=None):
+        """Get the newest frame.
+
+        timeout: seconds to wait for a new frame. If None, wait forever.
+
+        returns: the depth frame, or None if the timeout expired.
+          If capturing stopped because of an exception, it's raised here
+          once all the captured frames are processed.
+        """
+
+        with self._cond:
+            while self._frame is None:
+                if self._error is not None:
+                    raise self._error
+                if not self._cond.wait(timeout):
+                    return None
+            depth = self._frame
+            arrived = self._arrived
+            self._frame = None
+            self._cond.notify_all()
+
+        self.processed += 1
+        self.last_arrival = arrived
+        self.last_age = time.monotonic()-arrived
+        if self.last_age > self.max_age:
+            self.max_age = self.last_age
+        return depth
+
+def main(asys, nav, pipeline=None, record=None, workers=None, tiles=False,
+        voxels=False):
+    """Run the sensor loop.
+
+    asys: the actor system to send with
+    nav: the address of the navigation actor
+    pipeline: where frames come from. If None, a RealSense pipeline
+      is started. Otherwise, something that acts like one, e.g. a
+      depth_replay.DepthReplay.
+    record: if not None, the path to record all the depth frames to
+    workers: if not None, process frames on a sense_pool.SensorPool
+      with this many worker processes
+    tiles: if True, the pool splits each frame between the workers
+      instead of giving each worker whole frames
+    voxels: if True, build a voxel map from the frames and send how far
+      it's clear all around the drone with each ObstacleSummary
+    """
+
+    # time to collision does most of the work, the distances only
+    # catch things that are close but not getting closer
+    publisher = DangerPublisher(asys, nav, enter_dist=0.5, exit_dist=0.7)
+    publisher.publish()
+    recorder = None
+    capture = None
+    pool = None
+    # a live camera can skip frames, a replay has every one processed
+    live = pipeline is None
     try:
-        # Create a context object. This object owns the handles to all connected realsense devices
-        pipeline = rs.pipeline()
-        pipeline.start()
+        if live:
+            # Create a context object. This object owns the handles to all connected realsense devices
+            pipeline = rs.pipeline()
+        profile = pipeline.start()
+        depth_scale = get_depth_scale(profile)
 
-        while True:
-            # This call waits until a new coherent set of frames is available on a device
-            # Calls to get_frame_data(...) and get_frame_timestamp(...) on a device will return stable values until wait_for_frames(...) is called
-            frames = pipeline.wait_for_frames()
-            depth = frames.get_depth_frame()
-            #npDepth = np.asarray(depth)  #can format here
-            npDepth = np.empty([10, 10])
-            #data = np.empty([depth.shape[0], depth.shape[1]])
-            dataDepth = np.empty([480, 640])
-            if not depth: continue
-
-            for y in range(235,245,1):
-                for x in range(315,325,1):
-                    dist = depth.get_distance(x, y)
-                    npDepth[x-315, y-235] = dist
-                    print("%1.1f " % dist, end=" ")
-                    print("%1.1f " % npDepth[x-315, y-235], end=" ")
-                #print('\n\n')
-            npDepth1 = npDepth.reshape(2,50).mean(0)
-            npDepth2 = npDepth1.reshape(25,2).mean(1)
-            npDepth3 = npDepth2.reshape(5,5)
-            for yy in range(0,5,1):
-                for xx in range(0,5,1):
-                    #print("%1.1f " % npDepth3[xx, yy], end=" ")
-                    #if (3.0 > npDepth3[xx, yy] and npDepth3[xx, yy] > 0.3):
-                    if (1.0 > npDepth3[xx, yy]):
-                        print("DRONE IN DANGER DRONE IN DANGER DRONE IN DANGER")
-                        print("DRONE IN DANGER DRONE IN DANGER DRONE IN DANGER")
+        def record_frame(depth):
+            # every frame captured is recorded, even the ones skipped
+            nonlocal recorder
+            if recorder is None:
+                recorder = DepthRecorder(record, depth.get_width(),
+                    depth.get_height(), depth_scale)
+            recorder.write(depth)
+
+        # frames are captured on their own thread so that when processing
+        # is slow, it skips to the newest one instead of falling behind
+        capture = LatestFrameCapture(pipeline, drop=live,
+            on_frame=record_frame if record is not None else None)
+        capture.start()
+
+        controller = SensorController()
+        projector = None
+        vmap = VoxelMap() if voxels else None
+        # latest VehicleYaw from the navigation and when it came
+        yaw = None
+        yaw_time = None
+        # reused every frame so we don't allocate a new image each time
+        meters = np.empty([DEPTH_HEIGHT, DEPTH_WIDTH], dtype=np.float32)
+
+        def handle(grids):
+            # track and publish finished frames,
+            # as (timestamp, arrival, grid)
+            for stamp, arrival, grid in grids:
+                # use the camera's clock so replays track like they flew
+                stamp = stamp/1000
+                ttc = controller.trackUpdate(grid, stamp)
+                summary = controller.summarize(grid, publisher.danger, stamp)
+                if vmap is not None:
+                    # the map's on a compass if it has the yaw,
+                    # but the fan's relative to the nose
+                    offset = 0 if yaw is None else math.degrees(yaw)
+                    fan = vmap.clearance([b+offset for b in FAN_BEARINGS])
+                    summary.fan = np.minimum(fan*1000,
+                        ObstacleSummary.NOTHING).astype("<u2").tobytes()
+                if publisher.update(summary.nearest, stamp, summary, ttc.min(),
+                        arrival):
+                    if publisher.danger:
                         print("DRONE IN DANGER DRONE IN DANGER DRONE IN DANGER")
-                        asys.tell(nav, DroneInDanger(True))
-                    else :
-                        asys.tell(nav, DroneInDanger(False))
-                        continue
-                        #print()
-                print('\n\n')
-        exit(0)
+                    else:
+                        print("drone is safe")
+
+        while True:
+            depth = capture.get()
+
+            if vmap is not None:
+                if projector is None:
+                    projector = get_projector(profile, depth.get_width(),
+                        depth.get_height())
+                # pick up the yaw the navigation sent since last frame
+                while True:
+                    msg = asys.listen(0)
+                    if msg is None:
+                        break
+                    if isinstance(msg, VehicleYaw):
+                        yaw = msg.yaw
+                        yaw_time = time.monotonic()
+                if yaw is not None and \
+                        time.monotonic()-yaw_time > YAW_MAX_AGE:
+                    # without it the map can't remember across turns
+                    yaw = None
+                vmap.integrate(projector.project(depth.get_data(),
+                    depth_scale), depth.get_timestamp()/1000, yaw)
+
+            if workers is None:
+                if (depth.get_height(), depth.get_width()) != meters.shape:
+                    meters = np.empty([depth.get_height(), depth.get_width()],
+                        dtype=np.float32)
+                depth_to_meters(depth, depth_scale, out=meters)
+                grids = [(depth.get_timestamp(), capture.last_arrival,
+                    controller.gridReduce(meters))]
+            else:
+                if pool is None:
+                    from sense_pool import SensorPool, POOL_FRAMES, POOL_TILES
+                    pool = SensorPool(depth.get_width(), depth.get_height(),
+                        depth_scale, workers, POOL_TILES if tiles else POOL_FRAMES)
+                    pool.start()
+                pool.submit(depth,
+                    (depth.get_timestamp(), capture.last_arrival))
+                # finished frames come back in order, maybe a few at once.
+                # once every worker is busy, wait for the oldest instead
+                # of letting the next frame pile up behind it
+                done = pool.poll(block=pool.in_flight >= pool.workers)
+                grids = [(stamp, arrival, grid)
+                    for seq, (stamp, arrival), grid in done]
+
+            handle(grids)
+    except ReplayFinished:
+        if pool is not None:
+            # the last few frames are still with the workers
+            handle([(stamp, arrival, grid)
+                for seq, (stamp, arrival), grid in pool.drain()])
+        print("replay finished: {} frames captured, {} dropped, "
+            "max age {:.1f} ms".format(capture.captured, capture.dropped,
+            capture.max_age*1000))
     #except rs.error as e:
     #    # Method calls agaisnt librealsense objects may throw exceptions of type pylibrs.error
     #    print("pylibrs.error was thrown when calling %s(%s):\n", % (e.get_failed_function(), e.get_failed_args()))
@@ -78,4 +725,10 @@ def main(asys, nav):
     #    exit(1)
     except Exception as e:
         print(e)
-    pass
+    finally:
+        if capture is not None:
+            capture.stop()
+        if pool is not None:
+            pool.close()
+        if recorder is not None:
+            recorder.close()
@@ -8,16 +8,18 @@ class NavDummy(Actor):
     def receiveMessage(self, msg, sender):
         if isinstance(msg, DroneInDanger):
             print("Danger status: {}".format(msg.danger))
+            if msg.trace is not None:
+                print("  latency: {}".format(msg.trace))
 
 asys = None
 nav = None
 
 if __name__ == "__main__":
     try:
-        try:
-            dummy = sys.argv[1] != "testing"
-        except:
-            dummy = False
+        # a first argument other than "testing" (that isn't one of the
+        # --flags) sends the messages to a dummy instead of the navigation
+        dummy = len(sys.argv) > 1 and not sys.argv[1].startswith("--") \
+            and sys.argv[1] != "testing"
 
         if dummy:
             asys = ActorSystem(systemBase="multiprocTCPBase",
@@ -35,7 +37,34 @@ if __name__ == "__main__":
         else:
             nav = asys.createActor('nav.Navigation', globalName="Navigation")
 
+        # --replay file plays a recording instead of using the camera,
+        # paced like it was recorded, or with --rate fps or --fast
+        # --record file saves the frames that were processed
+        pipeline = None
+        record = None
+        if "--replay" in sys.argv:
+            import depth_replay
+            path = sys.argv[sys.argv.index("--replay")+1]
+            if "--fast" in sys.argv:
+                pipeline = depth_replay.DepthReplay(path,
+                    depth_replay.REPLAY_FAST)
+            elif "--rate" in sys.argv:
+                rate = float(sys.argv[sys.argv.index("--rate")+1])
+                pipeline = depth_replay.DepthReplay(path,
+                    depth_replay.REPLAY_FIXED, rate=rate)
+            else:
+                pipeline = depth_replay.DepthReplay(path)
+        if "--record" in sys.argv:
+            record = sys.argv[sys.argv.index("--record")+1]
+        # --workers n processes frames on n processes,
+        # --tiles splits each frame between them
+        workers = None
+        if "--workers" in sys.argv:
+            workers = int(sys.argv[sys.argv.index("--workers")+1])
+
         import sense_template
-        sense_template.main(asys, nav)
+        # --voxels keeps a map of what's been seen all around
+        sense_template.main(asys, nav, pipeline, record, workers,
+            "--tiles" in sys.argv, "--voxels" in sys.argv)
     finally:
         asys.shutdown()
\ No newline at end of file
@@ -0,0 +1,220 @@
+# compact telemetry values sent from the Dronekit thread to Pixhawk
+# and on to the VehicleProxys
+# dronekit's own objects are big to pickle (or can't be pickled at all),
+# so the Dronekit thread packs each attribute into a plain tuple of numbers
+# and the proxy turns it back into something with the same attribute names
+# when it's read
+
+import os
+import pickle
+from collections import namedtuple
+
+Attitude = namedtuple("Attitude", "pitch yaw roll")
+LocationGlobal = namedtuple("LocationGlobal", "lat lon alt")
+LocationGlobalRelative = namedtuple("LocationGlobalRelative", "lat lon alt")
+LocationLocal = namedtuple("LocationLocal", "north east down")
+Locations = namedtuple("Locations",
+    "global_frame global_relative_frame local_frame")
+GPSInfo = namedtuple("GPSInfo", "eph epv fix_type satellites_visible")
+Battery = namedtuple("Battery", "voltage current level")
+Rangefinder = namedtuple("Rangefinder", "distance voltage")
+Gimbal = namedtuple("Gimbal", "pitch roll yaw")
+
+class VehicleMode(str):
+    """Mode name that compares equal to a string, like dronekit's."""
+
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return str(self)
+
+class SystemStatus(str):
+    """System status that compares equal to a string, like dronekit's."""
+
+    __slots__ = ()
+
+    @property
+    def state(self):
+        return str(self)
+
+def _frame(v):
+    return (v.lat, v.lon, v.alt)
+
+def _local(v):
+    return (v.north, v.east, v.down)
+
+def _locations(v):
+    return _frame(v.global_frame)+_frame(v.global_relative_frame)+ \
+        _local(v.local_frame)
+
+def _unlocations(t):
+    return Locations(LocationGlobal(*t[0:3]),
+        LocationGlobalRelative(*t[3:6]), LocationLocal(*t[6:9]))
+
+# attribute name -> (pack, unpack)
+# pack turns dronekit's value into a tuple (or string),
+# unpack turns that into the value the proxy gives out
+CODECS = {
+    "attitude": (lambda v: (v.pitch, v.yaw, v.roll),
+        lambda t: Attitude(*t)),
+    "location": (_locations, _unlocations),
+    "location.global_frame": (_frame, lambda t: LocationGlobal(*t)),
+    "location.global_relative_frame": (_frame,
+        lambda t: LocationGlobalRelative(*t)),
+    "location.local_frame": (_local, lambda t: LocationLocal(*t)),
+    "home_location": (_frame, lambda t: LocationGlobal(*t)),
+    "velocity": (tuple, tuple),
+    "mount": (tuple, tuple),
+    "gps_0": (lambda v: (v.eph, v.epv, v.fix_type, v.satellites_visible),
+        lambda t: GPSInfo(*t)),
+    "battery": (lambda v: (v.voltage, v.current, v.level),
+        lambda t: Battery(*t)),
+    "rangefinder": (lambda v: (v.distance, v.voltage),
+        lambda t: Rangefinder(*t)),
+    "gimbal": (lambda v: (v.pitch, v.roll, v.yaw), lambda t: Gimbal(*t)),
+    # channel values in order, from "1" up
+    "channels": (lambda v: tuple(v[k] for k in sorted(v, key=int)),
+        lambda t: {str(i+1): c for i, c in enumerate(t)}),
+    "mode": (lambda v: v.name, VehicleMode),
+    "system_status": (lambda v: v.state, SystemStatus),
+}
+
+# attributes whose values are dicts of just what changed,
+# which are merged into what's there already
+MERGED = ("parameters",)
+
+# attributes that can't be sent at all
+UNSENDABLE = ("commands",)
+
+def encode(attr_name, value):
+    """Pack a dronekit attribute value to be sent.
+
+    Attributes without a codec, like heading or armed, are plain numbers
+    already and are left as they are.
+    """
+
+    codec = CODECS.get(attr_name)
+    if codec is None or value is None:
+        return value
+    return codec[0](value)
+
+def decode(attr_name, value):
+    """Unpack a value packed by encode()."""
+
+    codec = CODECS.get(attr_name)
+    if codec is None or value is None:
+        return value
+    return codec[1](value)
+
+def merge(attrs, attr_name, value):
+    """Put a packed value into a dict of attribute name -> packed value,
+    merging it in if it's one of the MERGED attributes."""
+
+    if isinstance(value, Encoded):
+        value = value.decode()
+    if attr_name in MERGED:
+        attrs.setdefault(attr_name, {}).update(value)
+    else:
+        attrs[attr_name] = value
+
+class Encoded:
+    """A value pickled ahead of time, so one encoding can be sent to lots
+    of actors without pickling it again for each. Make one with
+    Encoded.of(value) and get the value back with decode()."""
+
+    __slots__ = ("blob",)
+
+    def __init__(self, blob):
+        self.blob = blob
+
+    @classmethod
+    def of(cls, value):
+        return cls(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+    def decode(self):
+        return pickle.loads(self.blob)
+
+    def __reduce__(self):
+        return (Encoded, (self.blob,))
+
+class AttributeStore:
+    """The latest packed value of every attribute, numbered so anyone
+    that's seen everything up to some number can catch up on just what
+    changed since.
+
+    Every change gets the next sequence number. Changes to MERGED
+    attributes are tracked item by item, so catching up on the
+    parameters only sends the ones that changed. Each store gets its own
+    epoch, so numbers from a different store (like before a restart)
+    aren't mistaken for this one's.
+    """
+
+    def __init__(self):
+        self.epoch = os.urandom(4).hex()
+        self.seq = 0
+        # attribute name -> packed value
+        self.values = {}
+        # attribute name, or (attribute name, item) for MERGED ones,
+        # -> seq of its last change. kept in order of last change
+        self._changed = {}
+        # MERGED attribute name -> its value, Encoded
+        self._encoded = {}
+
+    def update(self, attr_name, value):
+        """Save a packed value. returns its sequence number."""
+
+        self.seq += 1
+        merge(self.values, attr_name, value)
+        if attr_name in MERGED:
+            self._encoded.pop(attr_name, None)
+            keys = [(attr_name, item) for item in value]
+        else:
+            keys = [attr_name]
+        for key in keys:
+            # move it to the end
+            self._changed.pop(key, None)
+            self._changed[key] = self.seq
+        return self.seq
+
+    def since(self, seq, wants=None):
+        """Get what changed after sequence number seq.
+
+        wants: if not None, called like wants(attr_name) to pick
+          the attributes to include
+
+        returns: dict of attribute name -> packed value. MERGED attributes
+          only have the items that changed.
+        """
+
+        changes = {}
+        # newest first, until they're ones that were already seen
+        for key in reversed(self._changed):
+            if self._changed[key] <= seq:
+                break
+            if isinstance(key, tuple):
+                attr_name, item = key
+                if wants is None or wants(attr_name):
+                    changes.setdefault(attr_name, {})[item] = \
+                        self.values[attr_name][item]
+            elif wants is None or wants(key):
+                changes[key] = self.values[key]
+        return changes
+
+    def snapshot(self, wants=None):
+        """Get everything, like since(0), except the MERGED attributes are
+        Encoded once and reused until they change, since they're big.
+        """
+
+        values = {}
+        for attr_name, value in self.values.items():
+            if wants is not None and not wants(attr_name):
+                continue
+            if attr_name in MERGED:
+                enc = self._encoded.get(attr_name)
+                if enc is None:
+                    enc = Encoded.of(value)
+                    self._encoded[attr_name] = enc
+                value = enc
+            values[attr_name] = value
+        return values
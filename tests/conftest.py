@@ -0,0 +1,126 @@
+# helpers for the tests: run a CoActor by hand, without an actor system,
+# on a clock that only moves when the test moves it
+# run from the repo root: python3 -m pytest tests
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import pytest
+from thespian.actors import ActorAddress, WakeupMessage
+
+import coactor
+
+class Clock:
+    """Stands in for the time module in the modules under test."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+class _Ref:
+    # what an Actor sends and asks for wakeups through
+    def __init__(self, driver, address):
+        self.driver = driver
+        self.address = address
+
+    def actor_send(self, addr, msg):
+        self.driver._send(addr, msg)
+
+    def wakeupAfter(self, period, payload):
+        self.driver.wakeups.append((self.driver.clock.now +
+            period.total_seconds(), WakeupMessage(period, payload)))
+
+class Driver:
+    """Runs one actor. Messages to it are handled right away, everything
+    else it sends is kept in driver.sent, and its wakeups go off as the
+    clock is moved on with driver.run_until() or driver.advance().
+
+    * Instantiate with d = Driver(actor, clock)
+    * Send it something with d.deliver(msg, sender)
+    * See what it sent to an address with d.received(addr)
+    """
+
+    def __init__(self, actor, clock, name="actor"):
+        self.actor = actor
+        self.clock = clock
+        self.address = ActorAddress(name)
+        # (address, message) of everything sent, in order
+        self.sent = []
+        # (due, WakeupMessage)
+        self.wakeups = []
+        self._queue = []
+        actor._myRef = _Ref(self, self.address)
+
+    def _send(self, addr, msg):
+        self.sent.append((addr, msg))
+        if addr == self.address:
+            self._queue.append((msg, self.address))
+
+    def deliver(self, msg, sender=None):
+        if sender is None:
+            sender = ActorAddress("sender")
+        self._queue.append((msg, sender))
+        self._drain()
+
+    def _drain(self):
+        while self._queue:
+            msg, sender = self._queue.pop(0)
+            self.actor.receiveMessage(msg, sender)
+
+    def run_until(self, t):
+        """Move the clock on to t, going off every wakeup due by then."""
+
+        self._drain()
+        while True:
+            due = [w for w in self.wakeups if w[0] <= t]
+            if not due:
+                break
+            w = min(due, key=lambda w: w[0])
+            self.wakeups.remove(w)
+            self.clock.now = max(self.clock.now, w[0])
+            self._queue.append((w[1], self.address))
+            self._drain()
+        self.clock.now = max(self.clock.now, t)
+
+    def advance(self, seconds):
+        self.run_until(self.clock.now+seconds)
+
+    def received(self, addr):
+        """Get the messages sent to addr, with the batched ones
+        taken out of their envelopes."""
+
+        msgs = []
+        for a, msg in self.sent:
+            if a != addr:
+                continue
+            if isinstance(msg, coactor.CoActor.Envelope):
+                msgs.extend(msg.msgs)
+            else:
+                msgs.append(msg)
+        return msgs
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A Clock put in place of time in the modules that keep time."""
+
+    c = Clock()
+    for name in ("coactor", "pixhawk", "nav", "dk"):
+        module = sys.modules.get(name)
+        if module is not None:
+            monkeypatch.setattr(module, "time", c)
+    return c
+
+@pytest.fixture
+def drive(clock):
+    """Start driving an actor, like d = drive(actor)."""
+
+    return lambda actor, name="actor": Driver(actor, clock, name)
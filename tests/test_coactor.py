@@ -0,0 +1,358 @@
+import pytest
+from thespian.actors import ActorAddress
+
+from coactor import *
+
+class Base:
+    def __init__(self, n=0):
+        self.n = n
+
+class Derived(Base):
+    pass
+
+class Other:
+    pass
+
+def actor(drive):
+    a = CoActor()
+    return a, drive(a)
+
+# dispatch (user-011)
+
+def test_dispatch_base_class_callbacks(drive):
+    a, d = actor(drive)
+    got = []
+    a.register_cb(Base, lambda msg, sender: got.append(("base", msg.n)))
+    a.register_cb(Derived, lambda msg, sender: got.append(("derived", msg.n)))
+    d.deliver(Derived(1))
+    d.deliver(Base(2))
+    # in the order they were registered
+    assert got == [("base", 1), ("derived", 1), ("base", 2)]
+
+def test_dispatch_coroutine_callback(drive):
+    a, d = actor(drive)
+    got = []
+    async def cb(msg, sender):
+        got.append(sender)
+    a.register_cb(Base, cb)
+    d.deliver(Base(), ActorAddress("them"))
+    assert got == [ActorAddress("them")]
+
+def test_dispatch_cache_follows_registration(drive):
+    a, d = actor(drive)
+    got = []
+    cb = lambda msg, sender: got.append(msg.n)
+    a.register_cb(Base, cb)
+    d.deliver(Derived(1))
+    assert Derived in a._dispatch
+    a.unregister_cb(Base, cb)
+    assert a._dispatch == {}
+    d.deliver(Derived(2))
+    a.register_cb(Derived, cb)
+    d.deliver(Derived(3))
+    assert got == [1, 3]
+
+def test_dispatch_unhandled(drive, capsys):
+    a, d = actor(drive)
+    d.deliver(Other())
+    assert "didn't handle" in capsys.readouterr().out
+
+# timers (user-012)
+
+def test_call_later_order(drive, clock):
+    a, d = actor(drive)
+    got = []
+    a.call_later(0.3, lambda: got.append(3))
+    a.call_later(0.1, lambda: got.append(1))
+    a.call_later(0.2, lambda: got.append(2))
+    d.run_until(0.15)
+    assert got == [1]
+    d.run_until(1.0)
+    assert got == [1, 2, 3]
+
+def test_one_wakeup_for_many_timers(drive, clock):
+    a, d = actor(drive)
+    a.call_later(0.1, lambda: None)
+    for i in range(10):
+        a.call_later(0.5+i, lambda: None)
+    assert len(d.wakeups) == 1
+    # the next one's asked for once the first has gone off
+    d.run_until(0.2)
+    assert [due for due, w in d.wakeups] == [0.5]
+
+def test_sleep(drive, clock):
+    a, d = actor(drive)
+    got = []
+    async def sleeper(name, seconds):
+        await a.sleep(seconds)
+        got.append((name, clock.now))
+    a.create_task(sleeper("long", 0.2))
+    a.create_task(sleeper("short", 0.1))
+    d.run_until(1.0)
+    assert got == [("short", 0.1), ("long", 0.2)]
+
+def test_timer_cancel(drive, clock):
+    a, d = actor(drive)
+    got = []
+    timer = a.call_later(0.1, lambda: got.append(1))
+    timer.cancel()
+    assert timer.cancelled
+    d.run_until(1.0)
+    assert got == []
+    # cancelling one that's gone off does nothing
+    timer = a.call_later(0.1, lambda: got.append(2))
+    d.run_until(2.0)
+    timer.cancel()
+    assert got == [2] and timer.done and not timer.cancelled
+
+def test_await_done_timer(drive, clock):
+    a, d = actor(drive)
+    got = []
+    timer = a.call_later(0.1)
+    d.run_until(1.0)
+    async def late():
+        await timer
+        got.append(clock.now)
+    a.create_task(late())
+    d.advance(0)
+    assert got == [1.0]
+
+# ready queue (user-013)
+
+def call_soons(d):
+    return [m for addr, m in d.sent
+        if addr == d.address and isinstance(m, CoActor.CallSoon)]
+
+def test_call_soon_while_handling(drive):
+    a, d = actor(drive)
+    got = []
+    a.register_cb(Base, lambda msg, sender:
+        a.call_soon(lambda: got.append(msg.n)))
+    d.deliver(Base(1))
+    # it ran before the message was done, without sending anything
+    assert got == [1]
+    assert call_soons(d) == []
+
+def test_call_soon_from_outside(drive):
+    a, d = actor(drive)
+    got = []
+    a.call_soon(lambda: got.append(1))
+    a.call_soon(lambda: got.append(2))
+    assert len(call_soons(d)) == 1
+    d.advance(0)
+    assert got == [1, 2]
+
+def test_ready_limit(drive):
+    a, d = actor(drive)
+    a.READY_LIMIT = 10
+    got = []
+    def handle(msg, sender):
+        for i in range(25):
+            a.call_soon(lambda i=i: got.append(i))
+    a.register_cb(Base, handle)
+    # straight in, so the driver doesn't handle the CallSoon yet
+    a.receiveMessage(Base(), ActorAddress("sender"))
+    # the rest wait for a CallSoon, so other messages get a turn
+    assert got == list(range(10))
+    assert len(call_soons(d)) == 1
+    d.advance(0)
+    assert got == list(range(25))
+
+# waiting on messages (user-014)
+
+def test_wait_msg_validator(drive):
+    a, d = actor(drive)
+    got = []
+    async def waiter():
+        msg, sender = await a.wait_msg(Base, lambda m, s: m.n > 1)
+        got.append(msg.n)
+    a.create_task(waiter())
+    d.advance(0)
+    d.deliver(Base(1))
+    d.deliver(Derived(2))
+    d.deliver(Base(3))
+    assert got == [2]
+    assert a._pending_coros == {}
+
+def test_wait_msg_key(drive):
+    a, d = actor(drive)
+    a.register_key(Base, lambda m, s: m.n)
+    got = []
+    async def waiter(n):
+        msg, sender = await a.wait_msg(Base, key=n)
+        got.append(msg.n)
+    for n in (1, 2, 2):
+        a.create_task(waiter(n))
+    d.advance(0)
+    d.deliver(Derived(2))
+    assert got == [2, 2]
+    assert list(a._keyed_coros[Base]) == [1]
+    d.deliver(Base(1))
+    assert got == [2, 2, 1]
+    assert a._keyed_coros == {}
+
+def test_wait_msg_key_needs_key_fn(drive):
+    a, d = actor(drive)
+    task = a.create_task(a.wait_msg(Base, key=1))
+    d.advance(0)
+    assert isinstance(task.exception, ValueError)
+
+def test_cancelled_waiter_is_removed(drive):
+    a, d = actor(drive)
+    task = a.create_task(a.wait_msg(Base))
+    d.advance(0)
+    assert Base in a._pending_coros
+    task.cancel()
+    assert a._pending_coros == {}
+    assert isinstance(task.exception, CancelledError)
+
+# tasks and waiting on them (user-015)
+
+def test_wait_for(drive, clock):
+    a, d = actor(drive)
+    async def slow(seconds):
+        await a.sleep(seconds)
+        return seconds
+    fast = a.create_task(a.wait_for(slow(0.1), 0.5))
+    late = a.create_task(a.wait_for(slow(1.0), 0.5))
+    d.run_until(2.0)
+    assert fast.result == 0.1
+    assert isinstance(late.exception, TimeoutError)
+
+def test_gather(drive, clock):
+    a, d = actor(drive)
+    async def slow(seconds):
+        await a.sleep(seconds)
+        return seconds
+    task = a.create_task(a.gather(slow(0.3), slow(0.1), slow(0.2)))
+    d.run_until(1.0)
+    assert task.result == [0.3, 0.1, 0.2]
+    assert clock.now == 1.0
+
+def test_gather_cancels_the_rest(drive, clock):
+    a, d = actor(drive)
+    finished = []
+    async def slow(seconds):
+        await a.sleep(seconds)
+        finished.append(seconds)
+    async def fails():
+        await a.sleep(0.1)
+        raise KeyError("nope")
+    task = a.create_task(a.gather(slow(1.0), fails()))
+    d.run_until(2.0)
+    assert isinstance(task.exception, KeyError)
+    assert finished == []
+
+def test_task_cancel(drive, clock):
+    a, d = actor(drive)
+    cleaned = []
+    async def sleeper():
+        try:
+            await a.sleep(1.0)
+        except CancelledError:
+            cleaned.append(clock.now)
+            raise
+    task = a.create_task(sleeper())
+    d.run_until(0.5)
+    assert task.cancel()
+    assert cleaned == [0.5]
+    assert isinstance(task.exception, CancelledError)
+    assert not task.cancel()
+    d.run_until(2.0)
+    assert cleaned == [0.5]
+
+def test_cancel_timer_being_awaited(drive, clock):
+    a, d = actor(drive)
+    timer = a.call_later(1.0)
+    task = a.create_task(a._await(timer))
+    d.run_until(0.5)
+    timer.cancel()
+    assert isinstance(task.exception, CancelledError)
+    # and awaiting it afterwards doesn't hang either
+    again = a.create_task(a._await(timer))
+    d.advance(0)
+    assert isinstance(again.exception, CancelledError)
+
+def test_unretrieved_exception_is_logged(drive, caplog):
+    import gc
+    a, d = actor(drive)
+    async def fails():
+        raise KeyError("nope")
+    a.create_task(fails())
+    looked = a.create_task(fails())
+    d.advance(0)
+    assert isinstance(looked.exception, KeyError)
+    del looked
+    gc.collect()
+    errors = [r for r in caplog.records if r.name == "coactor"]
+    assert len(errors) == 1
+    assert "never retrieved" in errors[0].getMessage()
+    assert errors[0].exc_info[0] is KeyError
+
+# profiling (user-016)
+
+def test_profile_request(drive, clock):
+    a, d = actor(drive)
+    them = ActorAddress("them")
+    async def handle(msg, sender):
+        await a.sleep(0.5)
+    a.register_cb(Base, handle)
+    d.deliver(CoActor.ProfileRequest(), them)
+    assert d.received(them)[-1].report == "not profiling"
+
+    d.deliver(CoActor.ProfileRequest(enable=True), them)
+    d.deliver(Base())
+    d.run_until(1.0)
+    d.deliver(CoActor.ProfileRequest(), them)
+    report = d.received(them)[-1]
+    assert report.enabled
+    assert "dispatch:" in report.report and "Base" in report.report
+    assert "handle" in report.report
+    assert "waits:" in report.report
+
+    d.deliver(CoActor.ProfileRequest(enable=False), them)
+    assert not d.received(them)[-1].enabled
+    assert "_send_coro" not in a.__dict__
+
+# batching (user-017)
+
+def test_envelope_handled_in_order(drive, capsys):
+    a, d = actor(drive)
+    got = []
+    def handle(msg, sender):
+        if msg.n == 2:
+            raise KeyError("nope")
+        got.append((msg.n, sender))
+    a.register_cb(Base, handle)
+    them = ActorAddress("them")
+    d.deliver(CoActor.Envelope([Base(1), Base(2), Derived(3)]), them)
+    # one going wrong doesn't lose the rest
+    assert got == [(1, them), (3, them)]
+    assert "KeyError" in capsys.readouterr().err
+
+def test_send_batched(drive):
+    a, d = actor(drive)
+    a.BATCH_SIZE = 3
+    them, other = ActorAddress("them"), ActorAddress("other")
+    def handle(msg, sender):
+        for i in range(msg.n):
+            a.send_batched(them, i)
+        a.send_batched(other, "x")
+    a.register_cb(Base, handle)
+    d.deliver(Base(4))
+    sent = [(addr, m.msgs if isinstance(m, CoActor.Envelope) else m)
+        for addr, m in d.sent]
+    # full ones go right away, the rest once the message is handled
+    assert sent == [(them, [0, 1, 2]), (them, 3), (other, "x")]
+
+def test_send_batched_delay(drive, clock):
+    a, d = actor(drive)
+    a.BATCH_DELAY = 0.1
+    them = ActorAddress("them")
+    a.register_cb(Base, lambda msg, sender: a.send_batched(them, msg.n))
+    d.deliver(Base(1))
+    d.advance(0.05)
+    d.deliver(Base(2))
+    assert d.received(them) == []
+    d.advance(0.05)
+    assert d.received(them) == [1, 2]
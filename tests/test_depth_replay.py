@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+from depth_replay import *
+
+def frames(n, width=64, height=48):
+    rng = np.random.default_rng(0)
+    return [rng.integers(0, 10000, (height, width), dtype=np.uint16)
+        for i in range(n)]
+
+def record(path, data, width=64, height=48):
+    with DepthRecorder(path, width, height, 0.001) as rec:
+        for i, d in enumerate(data):
+            rec.write(d, 1000+i*33.3)
+
+def replay_all(replay):
+    got = []
+    replay.start()
+    try:
+        while True:
+            got.append(replay.wait_for_frames().get_depth_frame())
+    except ReplayFinished:
+        pass
+    return got
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path/"d.depth")
+    data = frames(10)
+    record(path, data)
+
+    replay = DepthReplay(path, REPLAY_FAST)
+    assert (replay.width, replay.height, replay.depth_scale) == \
+        (64, 48, 0.001)
+    got = replay_all(replay)
+    assert len(got) == 10
+    for i, (frame, d) in enumerate(zip(got, data)):
+        assert frame.get_frame_number() == i
+        assert frame.get_timestamp() == 1000+i*33.3
+        assert np.array_equal(frame.get_data(), d)
+        assert frame.get_distance(3, 2) == pytest.approx(d[2, 3]*0.001)
+
+def test_cut_off_recording_replays_whole_frames(tmp_path):
+    path = str(tmp_path/"d.depth")
+    record(path, frames(3))
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2)-100)
+    assert len(DepthReplay(path, REPLAY_FAST)) == 2
+
+def test_loop(tmp_path):
+    path = str(tmp_path/"d.depth")
+    record(path, frames(2))
+    replay = DepthReplay(path, REPLAY_FAST, loop=True)
+    replay.start()
+    numbers = [replay.wait_for_frames().get_frame_number() for i in range(5)]
+    assert numbers == [0, 1, 0, 1, 0]
+
+def test_wrong_frame_size(tmp_path):
+    with DepthRecorder(str(tmp_path/"d.depth"), 64, 48, 0.001) as rec:
+        with pytest.raises(ValueError):
+            rec.write(np.zeros((48, 63), dtype=np.uint16))
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path/"junk"
+    path.write_bytes(b"x"*100)
+    with pytest.raises(ValueError):
+        DepthReplay(str(path))
@@ -0,0 +1,243 @@
+from types import SimpleNamespace
+
+import pytest
+from thespian.actors import ActorAddress
+
+import telemetry
+from dk import *
+
+PIXHAWK = ActorAddress("pixhawk")
+
+class System:
+    # an actor system (and private context of it) that keeps what's told
+    def __init__(self):
+        self.told = []
+
+    def private(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def tell(self, addr, msg):
+        self.told.append((addr, msg))
+
+def dronekit(**kwargs):
+    # a Dronekit as its thread would have it, without a vehicle
+    dk = Dronekit(**kwargs)
+    dk.asys = dk.psys = System()
+    dk.hsys = dk.vehicle = None
+    dk.actor = PIXHAWK
+    return dk, dk.psys.told
+
+def bulk(told):
+    return [msg.value for addr, msg in told
+        if isinstance(msg, PixhawkUpdate) and msg.attr_name is None]
+
+# coalescing updates (user-018)
+
+def test_updates_coalesced_until_tick():
+    dk, told = dronekit()
+    for h in (10, 11, 12):
+        dk.attr_handler(None, "heading", h)
+    dk.attr_handler(None, "airspeed", 3.5)
+    assert told == []
+    dk.flush_updates(0.0)
+    assert bulk(told) == [{"heading": 12, "airspeed": 3.5}]
+    # nothing new, nothing sent
+    dk.flush_updates(0.05)
+    assert len(told) == 1
+
+def test_updates_packed():
+    dk, told = dronekit()
+    dk.attr_handler(None, "attitude", telemetry.Attitude(0.1, 0.2, 0.3))
+    dk.flush_updates(0.0)
+    assert bulk(told) == [{"attitude": (0.1, 0.2, 0.3)}]
+
+def test_max_rate():
+    dk, told = dronekit(max_rates={"heading": 10})
+    dk.attr_handler(None, "heading", 1)
+    dk.flush_updates(0.0)
+    dk.attr_handler(None, "heading", 2)
+    dk.attr_handler(None, "airspeed", 3.0)
+    dk.flush_updates(0.05)
+    # held back, and replaced by the newer one
+    dk.attr_handler(None, "heading", 3)
+    dk.flush_updates(0.08)
+    dk.flush_updates(0.1)
+    assert bulk(told) == [{"heading": 1}, {"airspeed": 3.0}, {"heading": 3}]
+
+def test_immediate():
+    dk, told = dronekit(immediate=("armed",))
+    dk.attr_handler(None, "armed", True)
+    assert [(m.attr_name, m.value) for a, m in told] == [("armed", True)]
+    assert dk._pending == {}
+
+def test_only_changed_parameters():
+    dk, told = dronekit()
+    dk.attr_handler(None, "parameters", {"A": 1, "B": 2})
+    dk.flush_updates(0.0)
+    dk.param_handler(None, "A", 1)
+    dk.param_handler(None, "B", 3)
+    dk.flush_updates(0.1)
+    assert bulk(told) == [{"parameters": {"A": 1, "B": 2}},
+        {"parameters": {"B": 3}}]
+
+def test_unsendable():
+    dk, told = dronekit()
+    dk.attr_handler(None, "commands", object())
+    dk.flush_updates(0.0)
+    assert told == []
+
+# raw telemetry (user-023)
+
+class Vehicle:
+    # just enough of a vehicle to be listened to
+    def __init__(self):
+        self.listeners = {}
+
+    def add_message_listener(self, name, fn):
+        self.listeners.setdefault(name, []).append(fn)
+
+    def receive(self, mtype, **fields):
+        msg = SimpleNamespace(**fields)
+        for fn in self.listeners.get(mtype, []):
+            fn(self, mtype, msg)
+
+def test_raw_collect():
+    raw = RawTelemetry()
+    vehicle = Vehicle()
+    raw.attach(vehicle)
+    assert set(vehicle.listeners) == set(RawTelemetry.MESSAGES)
+    vehicle.receive("ATTITUDE", pitch=0.1, yaw=0.2, roll=0.3)
+    vehicle.receive("ATTITUDE", pitch=0.1, yaw=0.5, roll=0.3)
+    vehicle.receive("VFR_HUD", heading=90, airspeed=3.0, groundspeed=2.5)
+    attrs = {}
+    raw.collect(attrs)
+    # packed like telemetry.encode would
+    assert attrs == {"attitude": (0.1, 0.5, 0.3), "heading": 90.0,
+        "airspeed": 3.0, "groundspeed": 2.5}
+    assert raw.count == 3
+    # only what's changed since
+    attrs = {}
+    vehicle.receive("LOCAL_POSITION_NED", x=1.0, y=2.0, z=-3.0)
+    raw.collect(attrs)
+    assert attrs == {"location.local_frame": (1.0, 2.0, -3.0)}
+
+def test_raw_names():
+    raw = RawTelemetry({"ATTITUDE": [("attitude", ("pitch", "yaw", "roll"))],
+        "VFR_HUD": [("heading", "heading")]})
+    assert raw.names == {"attitude", "heading"}
+
+def test_dronekit_raw():
+    dk, told = dronekit(raw=True)
+    vehicle = Vehicle()
+    dk.raw.attach(vehicle)
+    # dronekit's own copies aren't sent, nor the location that
+    # has a stale local_frame in it
+    dk.attr_handler(None, "attitude", telemetry.Attitude(9, 9, 9))
+    dk.attr_handler(None, "location", object())
+    dk.attr_handler(None, "battery", SimpleNamespace(voltage=12.0,
+        current=1.0, level=90))
+    vehicle.receive("ATTITUDE", pitch=0.1, yaw=0.2, roll=0.3)
+    dk.flush_updates(0.0)
+    assert bulk(told) == [{"attitude": (0.1, 0.2, 0.3),
+        "battery": (12.0, 1.0, 90)}]
+
+def test_dronekit_raw_keeps_location():
+    # local_frame isn't raw, so the combined location is still good
+    dk, told = dronekit(raw={"VFR_HUD": [("heading", "heading")]})
+    dk.attr_handler(None, "location", SimpleNamespace(
+        global_frame=telemetry.LocationGlobal(1.0, 2.0, 3.0),
+        global_relative_frame=telemetry.LocationGlobalRelative(1.0, 2.0, 0.5),
+        local_frame=telemetry.LocationLocal(4.0, 5.0, 6.0)))
+    dk.attr_handler(None, "heading", 10)
+    dk.flush_updates(0.0)
+    assert bulk(told) == [{"location": (1.0, 2.0, 3.0, 1.0, 2.0, 0.5,
+        4.0, 5.0, 6.0)}]
+
+# command results (user-024)
+
+class Commanded(Vehicle):
+    # a vehicle that takes commands
+    def __init__(self):
+        super().__init__()
+        self.armed = False
+        self.sent = []
+        self.message_factory = self
+
+    def command_long_encode(self, *args):
+        return args
+
+    def send_mavlink(self, msg):
+        self.sent.append(msg)
+
+def ack(command, result=mavutil.mavlink.MAV_RESULT_ACCEPTED):
+    return SimpleNamespace(command=command, result=result)
+
+def yaw(cid, timeout=None):
+    return DronekitSendCommand("command_long", 0, 0,
+        mavutil.mavlink.MAV_CMD_CONDITION_YAW, 0, 90, 0, 1, 0, 0, 0, 0,
+        cid=cid, timeout=timeout)
+
+def acks(told):
+    return [(m.cid, m.result) for a, m in told
+        if isinstance(m, DronekitCommandAck)]
+
+def test_command_acked(clock):
+    dk, told = dronekit()
+    dk.vehicle = Commanded()
+    dk._run_command(yaw(1), dk.psys, "normal")
+    dk._run_command(yaw(2), dk.psys, "normal")
+    assert len(dk.vehicle.sent) == 2
+    assert acks(told) == []
+    # answered in order
+    dk.ack_handler(None, "COMMAND_ACK",
+        ack(mavutil.mavlink.MAV_CMD_CONDITION_YAW,
+            mavutil.mavlink.MAV_RESULT_IN_PROGRESS))
+    dk.ack_handler(None, "COMMAND_ACK",
+        ack(mavutil.mavlink.MAV_CMD_CONDITION_YAW))
+    dk.ack_handler(None, "COMMAND_ACK",
+        ack(mavutil.mavlink.MAV_CMD_CONDITION_YAW,
+            mavutil.mavlink.MAV_RESULT_DENIED))
+    assert acks(told) == [(1, CMD_ACCEPTED), (2, CMD_REJECTED)]
+    # and nobody's waiting for another
+    dk.ack_handler(None, "COMMAND_ACK",
+        ack(mavutil.mavlink.MAV_CMD_CONDITION_YAW))
+    assert len(acks(told)) == 2
+
+def test_mode_acked_by_message_id(clock):
+    dk, told = dronekit()
+    dk.vehicle = Commanded()
+    dk._run_command(DronekitSetAttr("mode", "BRAKE", cid=4), dk.psys,
+        "urgent")
+    assert dk.vehicle.mode == "BRAKE"
+    dk.ack_handler(None, "COMMAND_ACK",
+        ack(mavutil.mavlink.MAVLINK_MSG_ID_SET_MODE))
+    assert acks(told) == [(4, CMD_ACCEPTED)]
+
+def test_commands_without_acks(clock):
+    dk, told = dronekit()
+    dk.vehicle = Commanded()
+    # already disarmed, so dronekit doesn't send anything to ack
+    dk._run_command(DronekitSetAttr("armed", False, cid=1), dk.psys,
+        "normal")
+    dk._run_command(DronekitSetAttr("airspeed", 5.0, cid=3), dk.psys,
+        "normal")
+    assert acks(told) == [(1, CMD_ACCEPTED), (3, CMD_SENT)]
+    assert dk._acks == {}
+
+def test_acks_expire_out_of_order(clock):
+    dk, told = dronekit()
+    dk.vehicle = Commanded()
+    dk._run_command(yaw(1), dk.psys, "normal")
+    dk._run_command(yaw(2, timeout=1.0), dk.psys, "normal")
+    dk._run_command(yaw(3, timeout=10.0), dk.psys, "normal")
+    dk.expire_acks(2.0)
+    assert acks(told) == [(2, CMD_TIMEOUT)]
+    dk.expire_acks(Dronekit.ACK_TIMEOUT)
+    assert acks(told) == [(2, CMD_TIMEOUT), (1, CMD_TIMEOUT)]
+    # the one left gets the next ack
+    dk.ack_handler(None, "COMMAND_ACK",
+        ack(mavutil.mavlink.MAV_CMD_CONDITION_YAW))
+    assert acks(told)[-1] == (3, CMD_ACCEPTED)
@@ -0,0 +1,83 @@
+import time
+
+import pytest
+from thespian.actors import ActorAddress, ActorExitRequest
+
+from flight_recorder import *
+from messages import Initialize
+from pixhawk import Pixhawk, PixhawkProxyCommand
+
+def record(path, n=100, chunk=256):
+    with FlightRecorder(path, chunk) as rec:
+        for i in range(n):
+            rec.update(PixhawkUpdate("heading", i), t=i*0.1)
+        rec.command(PixhawkProxyCommand("mode", "BRAKE"), t=n*0.1)
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path/"f.rec")
+    record(path)
+    records = read_recording(path)
+    assert len(records) == 101
+    assert records[3] == (pytest.approx(0.3), REC_UPDATE, ("heading", 3))
+    assert records[-1][1:] == (REC_COMMAND, ("mode", ("BRAKE",)))
+
+def test_cut_off_recording(tmp_path):
+    path = str(tmp_path/"f.rec")
+    record(path, 10)
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2)-3)
+    records = read_recording(path)
+    assert [payload for t, kind, payload in records] == \
+        [("heading", i) for i in range(10)]
+
+def test_not_a_recording(tmp_path):
+    path = tmp_path/"junk"
+    path.write_bytes(b"x"*100)
+    with pytest.raises(ValueError):
+        read_recording(str(path))
+    path.write_bytes(b"x")
+    with pytest.raises(ValueError):
+        read_recording(str(path))
+
+class System:
+    # an actor system that keeps what's told, and never has commands
+    def __init__(self):
+        self.told = []
+
+    def private(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def tell(self, addr, msg):
+        self.told.append(msg)
+
+    def listen(self, timeout):
+        time.sleep(timeout)
+        return None
+
+def test_replay(tmp_path):
+    path = str(tmp_path/"f.rec")
+    record(path, 300)
+    replay = FlightReplay(path, speed=None)
+    assert replay.commands_recorded == 1
+    asys = System()
+    replay.start(ActorAddress("pixhawk"), asys)
+    assert replay.finished.wait(5)
+    assert isinstance(asys.told[0], DronekitReady)
+    assert [m.value for m in asys.told[1:]] == list(range(300))
+
+def test_pixhawk_records(tmp_path, drive):
+    path = str(tmp_path/"f.rec")
+    p = Pixhawk()
+    d = drive(p, "pixhawk")
+    d.deliver(Initialize(actor_system=ActorAddress("asys"),
+        flight_record=path))
+    d.deliver(DronekitReady(), ActorAddress("dk"))
+    d.deliver(PixhawkUpdate(None, {"heading": 1, "airspeed": 2.0}))
+    d.deliver(PixhawkProxyCommand("arm", True))
+    d.deliver(ActorExitRequest())
+    assert [(kind, payload) for t, kind, payload in read_recording(path)] \
+        == [(REC_UPDATE, (None, {"heading": 1, "airspeed": 2.0})),
+            (REC_COMMAND, ("arm", (True,)))]
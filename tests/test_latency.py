@@ -0,0 +1,78 @@
+import pytest
+from thespian.actors import ActorAddress
+
+from latency import *
+from pixhawk import Pixhawk
+from dk import DronekitTraced
+
+def trace(*stamps):
+    t = LatencyTrace()
+    for stage, at in stamps:
+        t.stamp(stage, at)
+    return t
+
+def test_trace_hops():
+    t = trace(("frame", 1.0), ("Navigation", 1.004), ("Pixhawk", 1.005))
+    assert [h for h, dt in t.hops()] == \
+        ["frame -> Navigation", "Navigation -> Pixhawk"]
+    assert [dt for h, dt in t.hops()] == \
+        pytest.approx([0.004, 0.001])
+    assert t.total() == pytest.approx(0.005)
+    assert LatencyTrace("frame", 1.0).total() == 0.0
+
+def test_trace_stamps_now(clock, monkeypatch):
+    import latency
+    monkeypatch.setattr(latency, "time", clock)
+    clock.now = 7.0
+    assert LatencyTrace("frame").stamps == [("frame", 7.0)]
+
+def test_histogram_buckets():
+    h = LatencyHistogram()
+    for ms in (0.05, 0.1, 0.15, 3, 3, 2000):
+        h.add(ms/1000)
+    assert h.count == 6
+    assert h.counts[0] == 2
+    assert h.counts[1] == 1
+    assert h.counts[LatencyHistogram.BUCKETS.index(5)] == 2
+    assert h.counts[-1] == 1
+    assert h.max == pytest.approx(2000)
+
+def test_histogram_percentile():
+    h = LatencyHistogram()
+    assert h.percentile(50) == 0.0
+    for i in range(99):
+        h.add(0.0015)
+    h.add(0.7)
+    assert h.percentile(50) == 2
+    assert h.percentile(99) == 2
+    assert h.percentile(100) == 1000
+    h.add(3.0)
+    assert h.percentile(100) == pytest.approx(3000)
+
+def test_stats_record():
+    s = LatencyStats()
+    s.record(trace(("frame", 0.0), ("Pixhawk", 0.002), ("MAVLink sent", 0.003)),
+        "urgent ")
+    s.record(LatencyTrace("frame", 0.0))
+    assert list(s.hists) == ["urgent frame -> Pixhawk",
+        "urgent Pixhawk -> MAVLink sent", "urgent total frame -> MAVLink sent"]
+    assert s.hists["urgent total frame -> MAVLink sent"].sum == \
+        pytest.approx(3.0)
+
+# what Pixhawk does with the traces coming back from Dronekit
+
+def test_pixhawk_records_finished_traces(drive):
+    p = Pixhawk()
+    d = drive(p, "pixhawk")
+    t = trace(("frame", 0.0), ("Pixhawk", 0.001), ("Dronekit", 0.002),
+        ("MAVLink sent", 0.004))
+    d.deliver(DronekitTraced(t, "urgent"), ActorAddress("dk"))
+    assert "urgent total frame -> MAVLink sent" in p.latency.hists
+    assert p.latency.hists["urgent Dronekit -> MAVLink sent"].count == 1
+
+def test_pixhawk_ignores_unfinished_traces(drive):
+    p = Pixhawk()
+    d = drive(p, "pixhawk")
+    t = trace(("frame", 0.0), ("Pixhawk", 0.001))
+    d.deliver(DronekitTraced(t), ActorAddress("dk"))
+    assert p.latency.hists == {}
@@ -0,0 +1,118 @@
+import math
+
+import numpy as np
+import pytest
+from thespian.actors import ActorAddress
+
+from nav import *
+from sense_template import SensorController
+
+# obstacle summaries (user-007)
+
+def summary(grid, fan=None):
+    s = SensorController(rows=len(grid), cols=len(grid[0])).summarize(
+        np.array(grid, dtype=np.float32), False, 1.5)
+    s.fan = fan
+    return s
+
+def test_summary_round_trip():
+    s = summary([[3.0, np.inf, 2.5], [1.25, 9.0, 80.0]])
+    assert s.rows == 2 and s.cols == 3
+    assert len(s.cells) == 2*6
+    # to the millimeter, and anything past NOTHING is nothing
+    assert s.distances() == [[3.0, math.inf, 2.5], [1.25, 9.0, math.inf]]
+    assert s.column_clearance() == [1.25, 9.0, 2.5]
+    assert s.nearest == 1.25
+    assert s.stamp == 1.5
+
+def test_summary_bearing():
+    s = summary([[5.0, 5.0, 5.0, 1.0]])
+    # the nearest is right of center, where its column looks
+    assert s.bearing == pytest.approx(s.column_bearing(3))
+    assert s.bearing > 0
+    assert s.column_bearing(0) == pytest.approx(-s.column_bearing(3))
+    assert abs(s.column_bearing(3)) < s.hfov/2
+
+def test_fan_clearance():
+    mm = np.full(36, 1000, dtype="<u2")
+    mm[20] = ObstacleSummary.NOTHING
+    s = summary([[1.0]], mm.tobytes())
+    fan = s.fan_clearance()
+    assert len(fan) == 36
+    assert fan[0] == (-180, 1.0)
+    assert fan[20] == (20, math.inf)
+    assert summary([[1.0]]).fan_clearance() is None
+
+def test_pick_escape_heading():
+    nav = Navigation()
+    assert nav.pick_escape_heading(90) is None
+    # the camera's columns, clear on the left only
+    nav.obstacles = summary([[6.0, 1.0, 1.0, 1.0]])
+    escape = nav.pick_escape_heading(90)
+    assert escape == pytest.approx(90+nav.obstacles.column_bearing(0))
+    nav.obstacles = summary([[1.0, 1.0]])
+    assert nav.pick_escape_heading(90) is None
+
+def test_pick_escape_heading_from_fan():
+    nav = Navigation()
+    mm = np.full(36, 1000, dtype="<u2")
+    # clear at 120 and -60, -60 is the smaller turn
+    mm[30] = 8000
+    mm[12] = 8000
+    nav.obstacles = summary([[1.0]], mm.tobytes())
+    assert nav.pick_escape_heading(10) == 10-60
+
+# yaw to the sensor (user-010)
+
+class Attitude:
+    def __init__(self, yaw):
+        self.yaw = yaw
+
+def test_yaw_rate_limited(drive, clock):
+    nav = Navigation()
+    d = drive(nav, "nav")
+    sensor = ActorAddress("sensor")
+    nav.sensor_addr = sensor
+    clock.now = 10.0
+    for i in range(10):
+        nav.attitude_changed("attitude", Attitude(i*0.1))
+        d.advance(0.005)
+    d.advance(1.0)
+    # the first right away, then only the newest one each 1/YAW_RATE
+    yaws = [m.yaw for m in d.received(sensor)]
+    assert yaws == pytest.approx([0.0, 0.6, 0.9])
+
+# turning (user-015)
+
+class Turning:
+    # a vehicle stuck facing one heading
+    def __init__(self, nav, heading, result=CMD_ACCEPTED):
+        self.nav = nav
+        self.heading = heading
+        self.result = result
+
+    async def set_heading(self, heading):
+        return self.result
+
+    async def wait_until(self, attr, cond):
+        while not cond(self.heading):
+            await self.nav.sleep(0.1)
+
+def turn(drive, heading, to, result=CMD_ACCEPTED):
+    nav = Navigation()
+    d = drive(nav, "nav")
+    nav.vehicle = Turning(nav, heading, result)
+    task = nav.create_task(nav.turn_to(to))
+    d.advance(nav.STOP_TIMEOUT+1)
+    return task.result
+
+def test_turn_to(drive):
+    assert turn(drive, 90.5, 90)
+    # either side of north
+    assert turn(drive, 359.5, 0.5)
+    assert turn(drive, 0.5, -1)
+    assert not turn(drive, 180, 0)
+
+def test_turn_to_not_happening(drive):
+    assert not turn(drive, 0, 0, CMD_REJECTED)
+    assert not turn(drive, 0, 0, CMD_TIMEOUT)
@@ -0,0 +1,281 @@
+import pytest
+from thespian.actors import ActorAddress
+
+import telemetry
+from coactor import CoActor
+from latency import LatencyTrace
+from messages import Initialize
+from pixhawk import *
+
+DK = ActorAddress("dk")
+SUB = ActorAddress("sub")
+
+def pixhawk(drive):
+    # a Pixhawk that's past msg_init
+    p = Pixhawk()
+    d = drive(p, "pixhawk")
+    p.register_cb(PixhawkUpdate, p.msg_dk_update)
+    p.register_cb(PixhawkUpdateRequest, p.msg_update_req)
+    return p, d
+
+def values(d, addr=SUB):
+    # every attribute value addr was sent, in order
+    got = []
+    for msg in d.received(addr):
+        if msg.attr_name is None:
+            got.extend(msg.value.items())
+        else:
+            got.append((msg.attr_name, msg.value))
+    return got
+
+# batching (user-017)
+
+def test_batched_subscriber(drive):
+    p, d = pixhawk(drive)
+    d.deliver(PixhawkUpdate("heading", 1), DK)
+    d.deliver(PixhawkUpdateRequest(batch=True), SUB)
+    d.deliver(PixhawkUpdate(None, {"heading": 2, "airspeed": 3.0}), DK)
+    assert values(d) == [("heading", 1), ("heading", 2), ("airspeed", 3.0)]
+
+def test_plain_subscriber_gets_no_envelopes(drive):
+    p, d = pixhawk(drive)
+    p.BATCH_SIZE = 2
+    d.deliver(PixhawkUpdateRequest(batch=False), SUB)
+    for i in range(5):
+        d.deliver(PixhawkUpdate("heading", i), DK)
+    sent = [m for addr, m in d.sent if addr == SUB]
+    assert all(isinstance(m, PixhawkUpdate) for m in sent)
+    assert values(d)[-1] == ("heading", 4)
+
+def test_snapshot_not_overtaken(drive, clock):
+    p, d = pixhawk(drive)
+    p.BATCH_DELAY = 0.1
+    d.deliver(PixhawkUpdateRequest(batch=True), SUB)
+    d.deliver(PixhawkUpdate("heading", 1), DK)
+    # still batched up when the subscription's replaced
+    assert d.received(SUB) == []
+    d.deliver(PixhawkUpdateRequest(batch=False), SUB)
+    d.deliver(PixhawkUpdate("heading", 2), DK)
+    d.advance(1.0)
+    assert [m.seq for m in d.received(SUB)] == [0, 1, 1, 2]
+    assert values(d) == [("heading", 1), ("heading", 1), ("heading", 2)]
+
+# the proxy's unpacked values (user-019)
+
+def proxy(drive):
+    owner = CoActor()
+    d = drive(owner, "owner")
+    p = VehicleProxy(owner, ActorAddress("pixhawk"))
+    owner.register_cb(PixhawkUpdate, p.process_update)
+    return p, d
+
+def test_proxy_unpacks_when_read(drive):
+    p, d = proxy(drive)
+    d.deliver(PixhawkUpdate(None, {
+        "attitude": (0.1, -1.5, 0.02),
+        "location.local_frame": (1.0, -2.0, -10.0),
+        "heading": 270,
+    }))
+    assert "attitude" not in p.__dict__
+    assert p.attitude.yaw == -1.5
+    assert p.location_local_frame.north == 1.0
+    assert p.heading == 270
+    d.deliver(PixhawkUpdate("attitude", (0.0, 0.5, 0.0)))
+    assert p.attitude.yaw == 0.5
+    with pytest.raises(AttributeError):
+        p.airspeed
+
+def test_proxy_merges_parameters(drive):
+    p, d = proxy(drive)
+    d.deliver(PixhawkUpdate(None, {
+        "parameters": telemetry.Encoded.of({"A": 1, "B": 2})}))
+    d.deliver(PixhawkUpdate("parameters", {"B": 3}))
+    assert p.parameters == {"A": 1, "B": 3}
+
+def test_proxy_callbacks_get_unpacked_values(drive):
+    p, d = proxy(drive)
+    got = []
+    p.register_cb("attitude", lambda a, v: got.append((a, v.yaw)))
+    d.deliver(PixhawkUpdate("attitude", (0.0, 0.5, 0.0)))
+    assert got == [("attitude", 0.5)]
+
+# subscriptions (user-020)
+
+def test_rate_limited_subscription(drive, clock):
+    p, d = pixhawk(drive)
+    d.deliver(PixhawkUpdateRequest(max_rate=1), SUB)
+    d.deliver(PixhawkUpdate("heading", 1), DK)
+    clock.now = 0.5
+    d.deliver(PixhawkUpdate("heading", 2), DK)
+    clock.now = 0.9
+    d.deliver(PixhawkUpdate("heading", 3), DK)
+    # 2 was held back, then replaced
+    assert values(d) == [("heading", 1)]
+    d.run_until(5.0)
+    assert values(d) == [("heading", 1), ("heading", 3)]
+
+def test_held_back_replaced_by_allowed_update(drive, clock):
+    p, d = pixhawk(drive)
+    d.deliver(PixhawkUpdateRequest(max_rate=1), SUB)
+    d.deliver(PixhawkUpdate("heading", 1), DK)
+    clock.now = 0.5
+    d.deliver(PixhawkUpdate("heading", 2), DK)
+    # the timer hasn't gone off yet when the next one's allowed
+    clock.now = 1.0
+    d.deliver(PixhawkUpdate("heading", 3), DK)
+    d.run_until(5.0)
+    assert values(d) == [("heading", 1), ("heading", 3)]
+
+def test_rates_per_attribute(drive, clock):
+    p, d = pixhawk(drive)
+    d.deliver(PixhawkUpdateRequest(rates={"location.*": 1}), SUB)
+    for i in range(3):
+        clock.now = i*0.1
+        d.deliver(PixhawkUpdate(None, {"heading": i,
+            "location.local_frame": (i, 0, 0)}), DK)
+    d.run_until(5.0)
+    assert [v for a, v in values(d) if a == "heading"] == [0, 1, 2]
+    assert [v for a, v in values(d) if a != "heading"] == \
+        [(0, 0, 0), (2, 0, 0)]
+
+def test_attribute_filter(drive):
+    p, d = pixhawk(drive)
+    d.deliver(PixhawkUpdate(None, {"heading": 1, "airspeed": 2.0,
+        "location.local_frame": (0, 0, 0)}), DK)
+    d.deliver(PixhawkUpdateRequest(attrs=["location.*", "heading"]), SUB)
+    d.deliver(PixhawkUpdate(None, {"heading": 3, "airspeed": 4.0}), DK)
+    assert dict(values(d)) == {"heading": 3,
+        "location.local_frame": (0, 0, 0)}
+    assert "airspeed" not in dict(values(d))
+
+def test_unsubscribe(drive, clock):
+    p, d = pixhawk(drive)
+    d.deliver(PixhawkUpdateRequest(max_rate=1), SUB)
+    d.deliver(PixhawkUpdate("heading", 1), DK)
+    clock.now = 0.5
+    d.deliver(PixhawkUpdate("heading", 2), DK)
+    d.deliver(PixhawkUpdateRequest(False), SUB)
+    d.deliver(PixhawkUpdate("heading", 3), DK)
+    d.run_until(5.0)
+    assert values(d) == [("heading", 1)]
+    assert p.subscriptions == []
+
+# catching up on what changed (user-021)
+
+def test_request_only_what_changed(drive):
+    p, d = pixhawk(drive)
+    d.deliver(PixhawkUpdate(None, {"heading": 1, "airspeed": 2.0}), DK)
+    d.deliver(PixhawkUpdateRequest(), SUB)
+    snap = d.received(SUB)[-1]
+    assert snap.epoch == p.store.epoch and snap.seq == 2
+    d.deliver(PixhawkUpdateRequest(False), SUB)
+    d.deliver(PixhawkUpdate("heading", 3), DK)
+    d.deliver(PixhawkUpdateRequest(since=(snap.epoch, snap.seq)), SUB)
+    assert d.received(SUB)[-1].value == {"heading": 3}
+    # from some other store, it gets everything
+    d.deliver(PixhawkUpdateRequest(since=("other", 1)), SUB)
+    assert d.received(SUB)[-1].value == {"heading": 3, "airspeed": 2.0}
+
+def test_proxy_asks_for_what_it_missed(drive):
+    p, d = proxy(drive)
+    pixhawk_addr = ActorAddress("pixhawk")
+    p.request_updates(max_rate=5)
+    first = d.received(pixhawk_addr)[-1]
+    assert first.since is None and first.max_rate == 5 and first.batch
+    d.deliver(PixhawkUpdate(None, {"heading": 1}, 7, "abcd"))
+    d.deliver(PixhawkUpdate("heading", 2, 8))
+    p.request_updates()
+    assert d.received(pixhawk_addr)[-1].since == ("abcd", 8)
+
+# the fast lane (user-022)
+
+ASYS = ActorAddress("asys")
+DK_FAST = ActorAddress("dk fast")
+
+def started(drive, fast_lane=True):
+    # a Pixhawk that's been through msg_init, with Dronekit up
+    p = Pixhawk()
+    d = drive(p, "pixhawk")
+    d.deliver(Initialize(actor_system=ASYS))
+    assert isinstance(d.received(ASYS)[0], PixhawkStartDronekit)
+    d.deliver(DronekitReady(), DK)
+    if fast_lane:
+        d.deliver(DronekitFastLane(), DK_FAST)
+    return p, d
+
+def test_urgent_commands_take_the_fast_lane(drive):
+    p, d = started(drive)
+    d.deliver(PixhawkProxyCommand("heading", 90), SUB)
+    d.deliver(PixhawkProxyCommand("mode", "BRAKE"), SUB)
+    d.deliver(PixhawkProxyCommand("arm", False), SUB)
+    fast = d.received(DK_FAST)
+    assert [(m.attr, m.value) for m in fast] == [("mode", "BRAKE")]
+    assert fast[0].after == 0
+    normal = d.received(DK)
+    assert isinstance(normal[0], DronekitSendCommand)
+    # the heading went first, the arm has to wait for the mode change
+    assert [m.after for m in normal] == [0, 1]
+
+def test_no_fast_lane_yet(drive):
+    p, d = started(drive, fast_lane=False)
+    d.deliver(PixhawkProxyCommand("mode", "BRAKE"), SUB)
+    assert [m.attr for m in d.received(DK)] == ["mode"]
+
+def test_commands_traced(drive):
+    p, d = started(drive)
+    trace = LatencyTrace("frame", 0.0)
+    d.deliver(PixhawkProxyCommand("mode", "BRAKE", trace=trace), SUB)
+    # the trace goes along, stamped on the way
+    out = d.received(DK_FAST)[0]
+    assert out.trace is trace
+    assert [s for s, t in trace.stamps] == ["frame", "Pixhawk"]
+    # untraced ones are still timed from here
+    d.deliver(PixhawkProxyCommand("arm", True), SUB)
+    assert [s for s, t in d.received(DK)[0].trace.stamps] == ["Pixhawk"]
+
+# command results (user-024)
+
+def test_proxy_command_answered(drive, clock):
+    p, d = proxy(drive)
+    d.actor.register_cb(PixhawkCommandAck, p.process_ack)
+    fut = p.command("heading", 90, timeout=2.0)
+    cmd = d.received(ActorAddress("pixhawk"))[-1]
+    assert (cmd.cmd, cmd.args, cmd.timeout) == ("heading", (90,), 2.0)
+    d.deliver(PixhawkCommandAck(cmd.cid, CMD_ACCEPTED))
+    assert fut.result == CMD_ACCEPTED
+    # the timeout's off
+    d.run_until(10.0)
+    assert fut.result == CMD_ACCEPTED
+
+def test_proxy_command_not_answered(drive, clock):
+    p, d = proxy(drive)
+    d.actor.register_cb(PixhawkCommandAck, p.process_ack)
+    fut = p.command("heading", 90)
+    cmd = d.received(ActorAddress("pixhawk"))[-1]
+    assert cmd.timeout == Dronekit.ACK_TIMEOUT
+    d.run_until(Dronekit.ACK_TIMEOUT+p.ACK_MARGIN-0.01)
+    assert not fut.has_result
+    d.advance(0.02)
+    assert fut.result == CMD_TIMEOUT
+    # too late
+    d.deliver(PixhawkCommandAck(cmd.cid, CMD_ACCEPTED))
+    assert fut.result == CMD_TIMEOUT
+
+def test_pixhawk_maps_command_ids(drive):
+    p, d = started(drive)
+    a, b = ActorAddress("a"), ActorAddress("b")
+    d.deliver(PixhawkProxyCommand("heading", 90, cid=1, timeout=2.0), a)
+    d.deliver(PixhawkProxyCommand("heading", 180, cid=1), b)
+    first, second = d.received(DK)
+    assert first.cid != second.cid
+    assert (first.timeout, second.timeout) == (2.0, None)
+    d.deliver(DronekitCommandAck(second.cid, CMD_REJECTED), DK)
+    d.deliver(DronekitCommandAck(first.cid, CMD_ACCEPTED), DK)
+    assert [(m.cid, m.result) for m in d.received(a)] == [(1, CMD_ACCEPTED)]
+    assert [(m.cid, m.result) for m in d.received(b)] == [(1, CMD_REJECTED)]
+
+def test_pixhawk_unknown_command(drive):
+    p, d = started(drive)
+    d.deliver(PixhawkProxyCommand("fly_to_the_moon", cid=3), SUB)
+    assert [(m.cid, m.result) for m in d.received(SUB)] == \
+        [(3, CMD_REJECTED)]
@@ -0,0 +1,50 @@
+import os
+import signal
+
+import numpy as np
+import pytest
+
+from sense_template import SensorController
+from sense_pool import SensorPool, POOL_FRAMES, POOL_TILES
+
+WIDTH = 160
+HEIGHT = 120
+
+def frame(seed):
+    rng = np.random.default_rng(seed)
+    depth = rng.integers(200, 10000, (HEIGHT, WIDTH), dtype=np.uint16)
+    depth[rng.random(depth.shape) < 0.3] = 0
+    return depth
+
+@pytest.mark.parametrize("mode", [POOL_FRAMES, POOL_TILES])
+def test_pool_matches_one_process(mode):
+    controller = SensorController()
+    with SensorPool(WIDTH, HEIGHT, 0.001, workers=2, mode=mode,
+            slots=3) as pool:
+        got = []
+        for i in range(8):
+            pool.submit(frame(i), i)
+            got += pool.poll()
+        got += pool.drain()
+        assert pool.in_flight == 0
+
+    # in order, and the same as doing it here
+    assert [seq for seq, stamp, grid in got] == list(range(8))
+    assert [stamp for seq, stamp, grid in got] == list(range(8))
+    for seq, stamp, grid in got:
+        meters = frame(seq).astype(np.float32)*np.float32(0.001)
+        assert np.array_equal(grid, controller.gridReduce(meters))
+
+def test_pool_dead_workers():
+    pool = SensorPool(WIDTH, HEIGHT, 0.001, workers=2)
+    pool.CHECK_EVERY = 0.1
+    pool.start()
+    try:
+        for p in pool._procs:
+            os.kill(p.pid, signal.SIGKILL)
+            p.join()
+        pool.submit(frame(0))
+        with pytest.raises(RuntimeError):
+            pool.drain()
+    finally:
+        pool.close()
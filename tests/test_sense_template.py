@@ -0,0 +1,253 @@
+import math
+import time
+
+import numpy as np
+import pytest
+
+from sense_template import *
+
+def noisy_frame(seed=0, invalid=0.3):
+    rng = np.random.default_rng(seed)
+    meters = rng.uniform(0.2, 10, (DEPTH_HEIGHT, DEPTH_WIDTH)).astype(np.float32)
+    meters[rng.random(meters.shape) < invalid] = 0
+    return meters
+
+def reference_grid(controller, meters, fn):
+    # reduce each cell the slow way, fn gets the valid pixels
+    cells = controller.gridCells(meters)
+    grid = np.empty((controller.rows, controller.cols), dtype=np.float32)
+    for r in range(controller.rows):
+        for c in range(controller.cols):
+            cell = cells[r, :, c, :]
+            grid[r, c] = fn(cell[cell > 0])
+    return grid
+
+# depth ingest (user-001)
+
+class Depth:
+    # a depth frame, as far as depth_to_meters cares
+    def __init__(self, data):
+        self.data = data
+
+    def get_data(self):
+        return memoryview(self.data)
+
+def test_depth_to_meters():
+    raw = np.array([[0, 1000], [2500, 65535]], dtype=np.uint16)
+    meters = depth_to_meters(Depth(raw), 0.001)
+    assert meters.dtype == np.float32
+    assert meters == pytest.approx(np.array([[0, 1.0], [2.5, 65.535]]))
+    # into an array that's already there
+    out = np.empty((2, 2), dtype=np.float32)
+    assert depth_to_meters(Depth(raw), 0.001, out=out) is out
+    assert np.array_equal(out, meters)
+
+# grid engine (user-002)
+
+def test_grid_min_ignores_invalid_pixels():
+    meters = noisy_frame()
+    c = SensorController()
+    expected = reference_grid(c, meters,
+        lambda v: v.min() if len(v) else np.inf)
+    assert np.array_equal(c.gridReduce(meters), expected)
+
+def test_grid_empty_cell_is_inf():
+    meters = noisy_frame()
+    meters[:DEPTH_HEIGHT//5, :DEPTH_WIDTH//5] = 0
+    grid = SensorController().gridReduce(meters)
+    assert grid[0, 0] == np.inf
+    assert np.isfinite(grid[1:, 1:]).all()
+
+@pytest.mark.parametrize("percentile", [0, 5, 50, 100])
+def test_grid_percentile_matches_sorting(percentile):
+    meters = noisy_frame(1, invalid=0.6)
+    c = SensorController(stat=GRID_PERCENTILE, percentile=percentile)
+    def pct(v):
+        if not len(v):
+            return np.inf
+        v = np.sort(v)
+        return v[max(0, int(math.ceil(percentile/100*len(v)))-1)]
+    assert np.array_equal(c.gridReduce(meters), reference_grid(c, meters, pct))
+
+def test_grid_count():
+    meters = noisy_frame(2)
+    c = SensorController(stat=GRID_COUNT, threshold=3.0)
+    cells = c.gridCells(meters)
+    expected = ((cells > 0) & (cells < 3.0)).sum(axis=(1, 3))
+    assert np.array_equal(c.gridReduce(meters), expected)
+
+def test_grid_rows_put_back_together():
+    # what the pool's tiles rely on
+    meters = noisy_frame(3)
+    c = SensorController(rows=6, cols=4, crop=1, stride=2)
+    whole = c.gridReduce(meters)
+    parts = []
+    for first, last in ((0, 2), (2, 5), (5, 6)):
+        start, stop = c.gridPixelRows(meters.shape, first, last)
+        band = np.zeros_like(meters)
+        band[start:stop] = meters[start:stop]
+        parts.append(c.gridReduce(band, first, last))
+    assert np.array_equal(np.concatenate(parts), whole)
+
+def test_grid_too_small():
+    with pytest.raises(ValueError):
+        SensorController(rows=10, cols=10).gridReduce(np.ones((5, 5)))
+
+def test_unknown_stat():
+    with pytest.raises(ValueError):
+        SensorController(stat="mean")
+
+# danger publishing (user-003)
+
+class Tells:
+    # records what would be sent through the actor system
+    def __init__(self):
+        self.msgs = []
+
+    def tell(self, addr, msg):
+        self.msgs.append(msg)
+
+def publisher(**kwargs):
+    asys = Tells()
+    kwargs.setdefault("keepalive", 100)
+    return DangerPublisher(asys, "nav", **kwargs), asys.msgs
+
+def test_danger_needs_to_hold_for_debounce():
+    p, msgs = publisher(enter_dist=1.0, debounce=0.1)
+    assert not p.update(5.0, 0.0)
+    # half the debounce to get into danger
+    assert not p.update(0.5, 1.0)
+    assert not p.update(0.5, 1.04)
+    assert p.update(0.5, 1.05)
+    assert p.danger
+    assert [m.danger for m in msgs] == [False, True]
+
+def test_danger_blip_is_ignored():
+    p, msgs = publisher(enter_dist=1.0, debounce=0.1)
+    p.update(5.0, 0.0)
+    p.update(0.5, 1.0)
+    p.update(5.0, 1.02)
+    p.update(0.5, 1.06)
+    assert not p.danger
+    assert len(msgs) == 1
+
+def test_danger_hysteresis():
+    p, msgs = publisher(enter_dist=1.0, exit_dist=1.3, debounce=0)
+    p.update(0.9, 0.0)
+    assert p.danger
+    # between the two, it stays in danger
+    assert not p.update(1.2, 1.0)
+    assert p.danger
+    assert p.update(1.4, 2.0)
+    assert not p.danger
+    # and stays safe until it's under enter_dist again
+    assert not p.update(1.2, 3.0)
+    assert [m.danger for m in msgs] == [True, False]
+
+def test_danger_from_time_to_collision():
+    p, msgs = publisher(enter_ttc=2.0, exit_ttc=3.0, debounce=0)
+    assert p.update(5.0, 0.0, ttc=1.5)
+    assert not p.update(5.0, 1.0, ttc=2.5)
+    assert p.update(5.0, 2.0, ttc=3.5)
+
+def test_danger_keepalive():
+    p, msgs = publisher(keepalive=1.0)
+    p.update(5.0, 0.0)
+    p.update(5.0, 0.5)
+    p.update(5.0, 1.0)
+    assert len(msgs) == 2
+
+# frame capture (user-005)
+
+class Frames:
+    # a pipeline with n frames, then ReplayFinished
+    def __init__(self, n):
+        self.n = n
+        self.i = 0
+
+    def wait_for_frames(self):
+        if self.i >= self.n:
+            raise ReplayFinished()
+        self.i += 1
+        return self
+
+    def get_depth_frame(self):
+        return self.i
+
+def take_all(capture):
+    got = []
+    try:
+        while True:
+            got.append(capture.get(5))
+            time.sleep(0.001)
+    except ReplayFinished:
+        pass
+    capture.stop()
+    return got
+
+def test_capture_keeps_only_the_newest():
+    capture = LatestFrameCapture(Frames(50))
+    capture.start()
+    got = take_all(capture)
+    assert got[-1] == 50
+    assert got == sorted(got)
+    assert capture.captured == 50
+    assert capture.dropped == 50-len(got)
+
+def test_capture_without_dropping():
+    recorded = []
+    capture = LatestFrameCapture(Frames(50), drop=False,
+        on_frame=recorded.append)
+    capture.start()
+    assert take_all(capture) == list(range(1, 51))
+    assert capture.dropped == 0
+    assert recorded == list(range(1, 51))
+
+def test_capture_timeout():
+    class Stuck:
+        def wait_for_frames(self):
+            time.sleep(10)
+    capture = LatestFrameCapture(Stuck())
+    capture.start()
+    assert capture.get(0.05) is None
+    capture.stop(0)
+
+# obstacle tracking (user-008)
+
+def test_tracker_closing_speed():
+    c = SensorController(rows=1, cols=2, alpha=0.5, beta=0.3)
+    # one cell closing at 2 m/s, the other standing still
+    for i in range(40):
+        ttc = c.trackUpdate([[10-2*i*0.05, 5.0]], i*0.05)
+    assert c.trackSpeed[0, 0] == pytest.approx(2.0, rel=0.01)
+    assert c.trackSpeed[0, 1] == pytest.approx(0.0, abs=1e-6)
+    dist = 10-2*39*0.05
+    assert ttc[0, 0] == pytest.approx(dist/2, rel=0.02)
+    assert ttc[0, 1] == np.inf
+
+def test_tracker_starts_over_on_a_jump():
+    c = SensorController(rows=1, cols=1, gate=1.0)
+    for i in range(10):
+        c.trackUpdate([[10-i*0.1]], i*0.1)
+    assert c.trackSpeed[0, 0] > 0
+    # something new and much closer
+    ttc = c.trackUpdate([[3.0]], 1.0)
+    assert c.trackDist[0, 0] == 3.0
+    assert c.trackSpeed[0, 0] == 0
+    assert ttc[0, 0] == np.inf
+
+def test_tracker_lost_cell():
+    c = SensorController(rows=1, cols=1)
+    c.trackUpdate([[5.0]], 0.0)
+    c.trackUpdate([[4.0]], 0.1)
+    ttc = c.trackUpdate([[np.inf]], 0.2)
+    assert c.trackSpeed[0, 0] == 0
+    assert ttc[0, 0] == np.inf
+
+def test_tracker_resets_when_time_goes_back():
+    c = SensorController(rows=1, cols=1)
+    c.trackUpdate([[5.0]], 1.0)
+    c.trackUpdate([[4.9]], 1.1)
+    c.trackUpdate([[7.0]], 0.5)
+    assert c.trackDist[0, 0] == 7.0
+    assert c.trackSpeed[0, 0] == 0
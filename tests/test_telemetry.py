@@ -0,0 +1,111 @@
+import pickle
+from types import SimpleNamespace
+
+import dronekit
+import pytest
+
+from telemetry import *
+
+# packing and unpacking (user-019)
+
+@pytest.mark.parametrize("attr_name, value", [
+    ("attitude", dronekit.Attitude(0.1, -1.5, 0.02)),
+    ("location.global_frame", dronekit.LocationGlobal(-35.1, 149.2, 584.0)),
+    ("location.global_relative_frame",
+        dronekit.LocationGlobalRelative(-35.1, 149.2, 10.0)),
+    ("location.local_frame", dronekit.LocationLocal(1.0, -2.0, -10.0)),
+    ("home_location", dronekit.LocationGlobal(-35.1, 149.2, 584.0)),
+    ("gps_0", dronekit.GPSInfo(121, 65535, 3, 10)),
+    ("battery", dronekit.Battery(12587, 0, 100)),
+    ("rangefinder", dronekit.Rangefinder(3.5, 0.8)),
+])
+def test_round_trip_fields(attr_name, value):
+    packed = encode(attr_name, value)
+    assert isinstance(packed, tuple)
+    got = decode(attr_name, pickle.loads(pickle.dumps(packed)))
+    for field in got._fields:
+        assert getattr(got, field) == getattr(value, field)
+
+def test_round_trip_location():
+    value = SimpleNamespace(
+        global_frame=dronekit.LocationGlobal(-35.1, 149.2, 584.0),
+        global_relative_frame=dronekit.LocationGlobalRelative(-35.1, 149.2,
+            10.0),
+        local_frame=dronekit.LocationLocal(1.0, -2.0, -10.0))
+    got = decode("location", encode("location", value))
+    assert got.global_frame.alt == 584.0
+    assert got.global_relative_frame.alt == 10.0
+    assert (got.local_frame.north, got.local_frame.east,
+        got.local_frame.down) == (1.0, -2.0, -10.0)
+
+def test_round_trip_names():
+    mode = decode("mode", encode("mode", dronekit.VehicleMode("GUIDED")))
+    assert mode == "GUIDED" and mode.name == "GUIDED"
+    status = decode("system_status",
+        encode("system_status", dronekit.SystemStatus("ACTIVE")))
+    assert status == "ACTIVE" and status.state == "ACTIVE"
+
+def test_round_trip_channels():
+    channels = {"2": 1500, "1": 1100, "10": 900}
+    packed = encode("channels", channels)
+    assert packed == (1100, 1500, 900)
+    assert decode("channels", packed) == {"1": 1100, "2": 1500, "3": 900}
+
+def test_plain_values_left_alone():
+    assert encode("heading", 271) == 271
+    assert decode("armed", True) is True
+    assert encode("attitude", None) is None
+    assert decode("attitude", None) is None
+
+def test_merge():
+    attrs = {}
+    merge(attrs, "heading", 1)
+    merge(attrs, "heading", 2)
+    merge(attrs, "parameters", {"A": 1, "B": 2})
+    merge(attrs, "parameters", Encoded.of({"B": 3}))
+    assert attrs == {"heading": 2, "parameters": {"A": 1, "B": 3}}
+
+def test_encoded():
+    enc = Encoded.of({"A": 1})
+    assert pickle.loads(pickle.dumps(enc)).decode() == {"A": 1}
+    assert enc.decode() is not enc.decode()
+
+# catching up (user-021)
+
+def test_store_since():
+    store = AttributeStore()
+    store.update("heading", 1)
+    seq = store.update("airspeed", 2.0)
+    assert seq == store.seq == 2
+    store.update("heading", 3)
+    store.update("groundspeed", 4.0)
+    assert store.since(seq) == {"heading": 3, "groundspeed": 4.0}
+    assert store.since(0) == {"heading": 3, "airspeed": 2.0,
+        "groundspeed": 4.0}
+    assert store.since(store.seq) == {}
+    assert store.since(0, lambda a: a == "airspeed") == {"airspeed": 2.0}
+
+def test_store_since_parameters():
+    store = AttributeStore()
+    store.update("parameters", {"A": 1, "B": 2})
+    seq = store.update("heading", 1)
+    store.update("parameters", {"B": 3})
+    # only the ones that changed
+    assert store.since(seq) == {"parameters": {"B": 3}}
+    assert store.since(0)["parameters"] == {"A": 1, "B": 3}
+
+def test_store_snapshot():
+    store = AttributeStore()
+    store.update("parameters", {"A": 1})
+    store.update("heading", 1)
+    snap = store.snapshot()
+    assert snap["heading"] == 1
+    assert snap["parameters"].decode() == {"A": 1}
+    # encoded once, until they change
+    assert store.snapshot()["parameters"] is snap["parameters"]
+    store.update("parameters", {"B": 2})
+    assert store.snapshot()["parameters"].decode() == {"A": 1, "B": 2}
+    assert store.snapshot(lambda a: a != "parameters") == {"heading": 1}
+
+def test_store_epochs_differ():
+    assert AttributeStore().epoch != AttributeStore().epoch
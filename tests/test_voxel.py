@@ -0,0 +1,69 @@
+import math
+
+import numpy as np
+import pytest
+
+from voxel import *
+
+def wall(dist, width=64, height=48):
+    # the camera looking straight at a wall dist meters away
+    projector = DepthProjector.from_fov(width, height, 87, stride=2)
+    return projector.project(np.full((height, width), dist, np.float32))
+
+def test_project_wall():
+    points = wall(3.0)
+    assert points.dtype == np.float32
+    assert np.all(points[:, 0] == 3.0)
+    # the edges of the image are at the edges of the field of view
+    right = points[:, 1].max()
+    assert math.degrees(math.atan2(right, 3.0)) == pytest.approx(87/2, abs=2)
+    assert points[:, 1].min() == pytest.approx(-right, abs=0.2)
+
+def test_project_leaves_out_invalid_and_far():
+    projector = DepthProjector.from_fov(4, 4, 90, stride=1)
+    depth = np.array([[0, 1000, 20000, 500]]*4, dtype=np.uint16)
+    points = projector.project(depth, 0.001, max_range=10.0)
+    assert len(points) == 8
+    assert sorted(set(points[:, 0])) == [0.5, 1.0]
+
+def test_clearance_up_to_the_wall():
+    m = VoxelMap()
+    m.integrate(wall(3.0), 0.0)
+    ahead = m.clearance([0], max_dist=6.0)[0]
+    assert 2.5 <= ahead <= 3.0
+    assert not m.corridor_clear(0, 4.0)
+    assert m.corridor_clear(0, 2.0)
+
+def test_unseen_is_not_clear():
+    m = VoxelMap()
+    m.integrate(wall(3.0), 0.0)
+    # nothing's been seen behind or beside the drone
+    assert m.clearance([90, 180], max_dist=6.0).max() < 0.5
+    # and nothing at all before any frames
+    assert VoxelMap().clearance([0])[0] < 0.5
+
+def test_map_decays():
+    m = VoxelMap(tau=1.0)
+    m.integrate(wall(3.0), 0.0)
+    assert m.occupancy.max() == 1.0
+    m.decay(1.0)
+    assert m.occupancy.max() == pytest.approx(math.exp(-1))
+    # long enough and it's forgotten, wall and seen space both
+    m.decay(10.0)
+    assert m.clearance([0])[0] < 0.5
+
+def test_map_remembers_with_yaw():
+    m = VoxelMap()
+    m.integrate(wall(3.0), 0.0, yaw=0.0)
+    # turned right, looking at a wall farther off
+    m.integrate(wall(5.0), 0.1, yaw=math.pi/2)
+    ahead, right = m.clearance([0, 90], max_dist=8.0)
+    assert 2.5 <= ahead <= 3.0
+    assert 4.5 <= right <= 5.0
+
+def test_map_without_yaw_forgets():
+    m = VoxelMap()
+    m.integrate(wall(3.0), 0.0)
+    m.integrate(wall(5.0), 0.1)
+    # headings are relative to the nose, and only the last frame counts
+    assert 4.5 <= m.clearance([0], max_dist=8.0)[0] <= 5.0
@@ -0,0 +1,251 @@
+# voxel occupancy map around the drone, built from depth frames
+# remembers obstacles the camera isn't looking at any more
+
+import math
+import numpy as np
+
+class DepthProjector:
+    """Turns depth images into point clouds in the body frame.
+
+    The rays through each pixel are worked out once from the camera
+    intrinsics, so each frame is just a few vectorized multiplies.
+    Points come out as (forward, right, down) in meters, with the
+    camera looking forward.
+    """
+
+    def __init__(self, width, height, fx, fy, ppx, ppy, stride=4):
+        """Initialize the projector.
+
+        width, height: size of the depth image
+        fx, fy: focal lengths, in pixels
+        ppx, ppy: principal point, in pixels
+        stride: only project every stride'th pixel in each direction
+        """
+
+        self.width = width
+        self.height = height
+        self.stride = stride
+        u = np.arange(0, width, stride, dtype=np.float32)
+        v = np.arange(0, height, stride, dtype=np.float32)
+        # right and down offsets per meter of depth
+        self._rx = ((u-ppx)/fx)[None, :]
+        self._ry = ((v-ppy)/fy)[:, None]
+
+    @classmethod
+    def from_intrinsics(cls, intrinsics, stride=4):
+        """Make a projector from an rs.intrinsics, e.g. from
+        profile.get_stream(rs.stream.depth)
+        .as_video_stream_profile().get_intrinsics()"""
+
+        i = intrinsics
+        return cls(i.width, i.height, i.fx, i.fy, i.ppx, i.ppy, stride)
+
+    @classmethod
+    def from_fov(cls, width, height, hfov, stride=4):
+        """Make a projector for an ideal camera with square pixels and
+        the given horizontal field of view, in degrees."""
+
+        f = (width/2)/math.tan(math.radians(hfov/2))
+        return cls(width, height, f, f, (width-1)/2, (height-1)/2, stride)
+
+    def project(self, depth, depth_scale=1.0, max_range=10.0):
+        """Project a depth image into points.
+
+        depth: the (height, width) image, in depth units or meters
+        depth_scale: meters per depth unit. 1.0 if depth is in meters.
+        max_range: points farther than this, in meters, are left out
+
+        returns: an (n, 3) float32 array of (forward, right, down) points
+        """
+
+        z = np.asanyarray(depth)[::self.stride, ::self.stride]
+        z = np.multiply(z, np.float32(depth_scale), dtype=np.float32)
+        valid = (z > 0) & (z < max_range)
+        forward = z[valid]
+        right = (z*self._rx)[valid]
+        down = (z*self._ry)[valid]
+        return np.stack((forward, right, down), axis=1)
+
+class VoxelMap:
+    """Bounded occupancy grid of voxels centered on the drone.
+
+    Each voxel has an occupancy score that goes up when points land in
+    it and decays away with time constant tau, so things seen a moment
+    ago are remembered but the map doesn't fill up with stale junk.
+    The grid never moves with the drone, so it's only good for things
+    the drone isn't flying far from, like looking around while hovering.
+
+    Space the camera hasn't looked at isn't assumed to be empty. Seen
+    space is tracked in 2D columns of the map, which are seen when a ray
+    from the drone to a point the camera got a return from passes
+    through them. It decays like the occupancy, and corridors are only
+    clear as far as they've been seen.
+
+    The map's axes are (x, y, z) = (forward, right, down) at yaw 0. If
+    integrate() is given the drone's yaw, points are rotated so the map
+    stays put while the drone turns, and headings in queries are on the
+    same compass. Without yaw there's no telling where old frames were
+    looking, so the map only holds the latest frame, and headings are
+    relative to the nose.
+    """
+
+    # number of bearing bins the camera's reach is worked out in
+    BEARING_BINS = 360
+
+    def __init__(self, radius=8.0, half_height=2.0, resolution=0.2,
+            tau=2.0, min_points=2, threshold=0.5):
+        """Initialize the map.
+
+        radius: how far forward/back and left/right the map goes, meters
+        half_height: how far up and down the map goes, meters
+        resolution: size of each voxel, meters
+        tau: time constant occupancy decays with, seconds
+        min_points: points a voxel needs in one frame to count as a hit
+        threshold: occupancy over which a voxel is considered occupied.
+          A single hit gives 1.0.
+        """
+
+        self.resolution = resolution
+        self.tau = tau
+        self.min_points = min_points
+        self.threshold = threshold
+
+        nxy = 2*int(math.ceil(radius/resolution))
+        nz = 2*int(math.ceil(half_height/resolution))
+        self.shape = (nxy, nxy, nz)
+        self.center = np.array([nxy//2, nxy//2, nz//2])
+        self.occupancy = np.zeros(self.shape, dtype=np.float32)
+        # how recently each column was seen, decaying like occupancy
+        self.seen = np.zeros(self.shape[:2], dtype=np.float32)
+        self._stamp = None
+
+        # samples along a ray down the middle of each bearing bin,
+        # as (bins, steps) x and y offsets and distances
+        a = np.radians(np.arange(self.BEARING_BINS)+0.5)[:, None]
+        self._ray_dist = np.arange(resolution/2, radius*math.sqrt(2),
+            resolution/2, dtype=np.float32)[None, :]
+        self._ray_x = np.cos(a)*self._ray_dist
+        self._ray_y = np.sin(a)*self._ray_dist
+        # the drone's in the middle, so that's never unknown
+        c = (np.arange(nxy)-self.center[0]+0.5)*resolution
+        self._near = np.hypot(c[:, None], c[None, :]) < resolution
+
+    def decay(self, now):
+        """Decay the occupancy up to time now, in seconds."""
+
+        if self._stamp is not None and now > self._stamp:
+            f = np.float32(math.exp(-(now-self._stamp)/self.tau))
+            self.occupancy *= f
+            self.seen *= f
+        self._stamp = now
+
+    def _indices(self, points):
+        # voxel index of each point and whether it's in the map
+        idx = np.floor(points/self.resolution).astype(np.intp)+self.center
+        inside = np.all((idx >= 0) & (idx < self.shape), axis=-1)
+        return idx, inside
+
+    def integrate(self, points, now, yaw=None):
+        """Add a frame's points to the map.
+
+        points: (n, 3) array of (forward, right, down) points in meters,
+          from DepthProjector.project
+        now: the frame's time, in seconds
+        yaw: if not None, the drone's yaw in radians, to turn the points
+          into the map's fixed compass. If None, everything from
+          earlier frames is forgotten.
+        """
+
+        self.decay(now)
+        if yaw is None:
+            self.occupancy[:] = 0
+            self.seen[:] = 0
+
+        if yaw is not None and len(points):
+            c, s = math.cos(yaw), math.sin(yaw)
+            f, r = points[:, 0], points[:, 1]
+            points = np.stack((f*c-r*s, f*s+r*c, points[:, 2]), axis=1)
+
+        # how far the camera saw along each bearing, 0 if not at all
+        if len(points):
+            x, y = points[:, 0], points[:, 1]
+            bins = np.floor(np.degrees(np.arctan2(y, x))).astype(np.intp) \
+                % self.BEARING_BINS
+            reach = np.zeros(self.BEARING_BINS, dtype=np.float32)
+            np.maximum.at(reach, bins, np.hypot(x, y))
+            # mark the columns the rays out that far pass through
+            on = self._ray_dist <= reach[:, None]
+            ix = np.floor(self._ray_x[on]/self.resolution).astype(np.intp) \
+                + self.center[0]
+            iy = np.floor(self._ray_y[on]/self.resolution).astype(np.intp) \
+                + self.center[1]
+            inside = (ix >= 0) & (ix < self.shape[0]) & \
+                (iy >= 0) & (iy < self.shape[1])
+            self.seen[ix[inside], iy[inside]] = 1.0
+
+        idx, inside = self._indices(points)
+        flat = np.ravel_multi_index(idx[inside].T, self.shape)
+        counts = np.bincount(flat, minlength=self.occupancy.size)
+        hits = (counts >= self.min_points).reshape(self.shape)
+        # one hit per voxel per frame, capped so decay can catch up
+        self.occupancy += hits
+        np.minimum(self.occupancy, 5.0, out=self.occupancy)
+
+    def clearance(self, headings, max_dist=10.0, radius=0.5,
+            half_height=0.5):
+        """Find how far corridors along some headings are clear.
+
+        headings: list of headings in degrees, on the map's compass
+        max_dist: farthest to look, meters
+        radius: half the width of the corridor, meters
+        half_height: half the height of the corridor, meters
+
+        returns: array of the clear distance along each heading, in meters,
+          up to the first thing in the corridor or the first part of its
+          middle that hasn't been seen, whichever's closer. It's max_dist
+          if the corridor is clear all the way. The map's edge counts
+          as not seen.
+        """
+
+        res = self.resolution
+        # squash the corridor's height range down into a 2D blocked map
+        # first, so the corridors only have to be sampled in 2D
+        lo = max(0, int(math.floor(-half_height/res))+self.center[2])
+        hi = min(self.shape[2],
+            int(math.floor(half_height/res))+self.center[2]+1)
+        blocked2d = (self.occupancy[:, :, lo:hi] > self.threshold).any(axis=2)
+        unseen2d = (self.seen <= self.threshold) & ~self._near
+
+        # sample points covering each corridor, (headings, along, across)
+        along = np.arange(res/2, max_dist, res/2, dtype=np.float32)
+        across = np.arange(-radius, radius+res/4, res/2, dtype=np.float32)
+        h = np.radians(np.asarray(headings, dtype=np.float32))
+        c = np.cos(h)[:, None, None]
+        s = np.sin(h)[:, None, None]
+        a = along[None, :, None]
+        x = across[None, None, :]
+        ix = np.floor((a*c-x*s)/res).astype(np.intp)+self.center[0]
+        iy = np.floor((a*s+x*c)/res).astype(np.intp)+self.center[1]
+        inside = (ix >= 0) & (ix < self.shape[0]) & \
+            (iy >= 0) & (iy < self.shape[1])
+        jx, jy = np.where(inside, ix, 0), np.where(inside, iy, 0)
+        blocked = (blocked2d[jx, jy] & inside).any(axis=2)
+        # the middle of the corridor has to have been seen too
+        mid = len(across)//2
+        blocked |= unseen2d[jx[:, :, mid], jy[:, :, mid]] | \
+            ~inside[:, :, mid]
+
+        first = np.where(blocked.any(axis=1), blocked.argmax(axis=1), -1)
+        return np.where(first >= 0,
+            along[np.maximum(first, 0)]-res/2, max_dist)
+
+    def corridor_clear(self, heading, dist, radius=0.5, half_height=0.5):
+        """Check if the corridor along a heading is clear.
+
+        heading: degrees, on the map's compass
+        dist: how far it needs to be clear, meters
+        radius, half_height: size of the corridor, as for clearance()
+        """
+
+        return bool(self.clearance([heading], dist, radius,
+            half_height)[0] >= dist)